@@ -119,10 +119,18 @@ PM_QUERIES = {
 
 #UMLS CONFIGURATION
 #we are allowed to do 20req/s, which means that we should wait at least 0.05s/req
-UMLS_API_SLEEP_TIME = 0.06 
-
-
-
-
-
+UMLS_API_SLEEP_TIME = 0.06
 
+#every annotation worker draws from the same request budget, the state of the token bucket
+#is kept in this file and guarded by a file lock (see SharedRateLimiter in modules/umls_api.py)
+UMLS_RATE_LIMIT_STATE = "cache/umls_rate_limit.state"
+#finished lookups and in-flight claims shared by all workers, so each string is requested only once
+UMLS_INFLIGHT_DIR = "cache/umls_inflight"
+#a published result older than this (seconds) is removed and requested again, the directory is also emptied
+#at the start of each annotation run, it only coalesces the lookups of a run (the normalization cache keeps them)
+UMLS_INFLIGHT_TTL = 3600
+#a worker waiting on a claim for more than this (seconds) stops waiting and requests the string itself (hung request),
+#the claim of a crashed worker is released by the system and taken over right away
+UMLS_CLAIM_TIMEOUT = 30
+#threads per process that wait on the UMLS API, the rate limiter keeps the global rate bounded anyway
+UMLS_SERVICE_WORKERS = 16
@@ -0,0 +1,20 @@
+#CLEAN STAGE (see scripts/transform/clean.py and modules/columnar_clean.py)
+#default cleaning engine: "pandas" (in memory) or "duckdb" (out of core, see modules/columnar_clean.py)
+CLEAN_ENGINE = "pandas"
+#dates of the CSV files for Neo4j, explicit so both engines (and every batch of the duckdb one) write them the same
+CLEAN_CSV_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+#node ids are the CUI of the entity, or for the entities without CUI this prefix and the MD5 of '<label>|<lowercased text>'
+CLEAN_TEXT_ID_PREFIX = "txt:"
+#the mentions of a relation (start, type, end) are one edge with their count, dates, and at most this number of
+#distinct pmids and pmcids (the first ones that mention it)
+CLEAN_EDGE_MAX_EVIDENCE = 20
+#separator of the pmids and pmcids of an edge in the relations CSV file (the array delimiter of neo4j-admin import)
+CLEAN_EVIDENCE_SEPARATOR = ";"
+#duckdb engine: memory above which its sorts, windows and joins spill to CLEAN_DUCKDB_TEMP_DIR,
+#number of threads (None = all the cores), and rows per batch written to the CSV files
+CLEAN_DUCKDB_MEMORY_LIMIT = "4GB"
+CLEAN_DUCKDB_TEMP_DIR = "data/duckdb_tmp"
+CLEAN_DUCKDB_THREADS = None
+CLEAN_CSV_BATCH_ROWS = 200_000
+#state of the cleans (part files and articles cleaned, node ids by CUI and name, relations), for clean --incremental
+CLEAN_STATE_PATH = "data/clean_state/state.pkl"
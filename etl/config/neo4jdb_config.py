@@ -16,6 +16,10 @@ NEO4J_LABELS = ['AMINO_ACID',
                 'SIMPLE_CHEMICAL',
                 'TISSUE']
 
+#label shared by all the entity nodes, their ids are unique under it (the CUI, or a hash of the NER label and the text),
+#so a node keeps its id when its NER label changes, and the relations match their nodes through its constraint
+NEO4J_ENTITY_LABEL = "Entity"
+
 #relations we defined in config/nlp_config
 NEO4J_REL_TYPES = ['PRODUCES',
                    'CONTAINS',
@@ -38,4 +42,15 @@ NEO4J_REL_TYPES = ['PRODUCES',
                    'TOXIC_TO',
                    'COMPONENT_OF',
                    'SECRETED_BY',
-                   'TREATS']
\ No newline at end of file
+                   'TREATS']
+
+#fingerprints of the nodes and relations already loaded, the rows that didn't change are skipped by 'load --incremental'
+#(see modules/load_state.py). Delete it after emptying the database.
+NEO4J_LOAD_STATE_PATH = "data/load_state/loaded.pkl"
+
+#bulk import (load --bulk-import, see modules/bulk_import.py): directory of the import files, rows per data file,
+#gzip compression of the data files, and database of the local Neo4j installation (NEO4J_HOME) replaced by the import
+NEO4J_IMPORT_DIR = "data/neo4j_import"
+NEO4J_IMPORT_PART_ROWS = 1_000_000
+NEO4J_IMPORT_COMPRESS = True
+NEO4J_IMPORT_DATABASE = "neo4j"
@@ -8,6 +8,69 @@ NER_MODEL = os.getenv("NER_MODEL")
 
 # TOKEN-BASED MATCHER PATTERNS
 # -------------------------------
+#the patterns are matched per sentence, and their {"OP": "*"} wildcards are compiled
+#to bounded gaps of at most MATCHER_MAX_GAP tokens (see modules/relation_matcher.py)
+MATCHER_MAX_GAP = 10
+
+#where the relation patterns profiler (annotate --profile-patterns) writes its stats and report
+PROFILING_DIR = "data/profiling"
+#minimum number of seconds between two saves of the pattern stats of a worker (the last one is always saved)
+PROFILING_SAVE_INTERVAL = 5
+
+#OUTPUT OF THE ANNOTATION STAGE (Parquet datasets, see modules/nlp_output.py)
+ENTITIES_OUTPUT_DIR = "data/extracted_entities"
+RELATIONS_OUTPUT_DIR = "data/extracted_relations"
+#rows after which a worker closes its part file and starts a new one (a part file is only readable once closed)
+PARQUET_ROWS_PER_FILE = 500_000
+
+#short forms defined in the article (e.g. "triple negative breast cancer (TNBC)") are normalized through
+#their long form, detected by scispacy's abbreviation detector
+NLP_RESOLVE_ABBREVIATIONS = True
+
+#NORMALIZATION CACHE (string -> concept), shared by the workers and the bulk normalization
+NORMALIZATION_CACHE_PATH = "cache/normalization_cache.pkl"
+
+#STORE OF THE PROCESSED DOCS (annotate --store-docs / --rematch, see modules/doc_store.py)
+DOC_STORE_DIR = "data/doc_store"
+#docs per DocBin shard, a shard is kept in the memory of its worker until it is written
+DOC_STORE_SHARD_SIZE = 500
+
+#LONG DOCUMENTS (see modules/chunking.py)
+#articles longer than this (PMC full texts) are split in chunks of at most this many characters,
+#annotated in parallel and stitched back
+NLP_CHUNK_CHARS = 100_000
+
+#ANNOTATION WORKERS (see modules/worker_pool.py)
+#a worker is replaced by a fresh one after this many articles (or chunks), 0 = never
+WORKER_MAX_TASKS = 2000
+#or as soon as its resident memory (shared model pages included) exceeds this, 0 = never
+WORKER_MAX_RSS_MB = 4096
+
+#ANNOTATION METRICS (see modules/metrics.py)
+#per process metrics files, and the snapshot written at the end of the run
+METRICS_DIR = "data/metrics"
+METRICS_SNAPSHOT_PATH = "data/metrics/annotate_metrics.json"
+#minimum number of seconds between two saves of the metrics of a worker
+METRICS_SAVE_INTERVAL = 5
+#upper bounds (seconds) of the latency histograms buckets
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+#SENTENCE MEMO CACHE (annotate --sentence-cache, see modules/sentence_cache.py)
+SENTENCE_CACHE_PATH = "cache/sentence_cache.sqlite"
+#size above which the least recently used sentences are evicted
+SENTENCE_CACHE_MAX_MB = 1024
+
+#DEDUPLICATION (see modules/dedup.py)
+#memory budget of each dedup table (entities, relations) of each annotation worker, 8 bytes per key slot
+DEDUP_MAX_BYTES = 64 * 1024 ** 2
+#optional on-disk Bloom filter of the entities and relations of the run, so the keys a table forgot when it reached its
+#budget, and the keys written by the workers that exited (recycled), are still skipped. Emptied by annotate at the
+#start of each run, None disables it.
+DEDUP_BLOOM_PATH = None
+#expected number of keys and false positive rate of the Bloom filter (~18 MB for 10M keys at 0.1%)
+DEDUP_BLOOM_CAPACITY = 10_000_000
+DEDUP_BLOOM_ERROR_RATE = 0.001
+
 MATCHER_PATTERNS = {
     "PRODUCES": [
         # Original pattern
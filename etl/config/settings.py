@@ -11,6 +11,11 @@ PM_API_KEY_EMAIL = {
 }
 
 UMLS_API_KEY = os.getenv("UMLS_API_KEY")
+#optional, directory of the offline UMLS index (see modules/umls_local.py), if set, no UMLS API calls are made
+UMLS_LOCAL_INDEX = os.getenv("UMLS_LOCAL_INDEX")
+#optional, directory of the approximate matching index (see modules/umls_ann.py), tried before the normalizer
+#(local index or UMLS API), it holds its own copy of the concept tables
+UMLS_ANN_INDEX = os.getenv("UMLS_ANN_INDEX")
 
 MONGO_CONNECTION_STR = os.getenv("MONGO_CONNECTION_STR")
 
@@ -19,4 +24,6 @@ NEO4J_AUTH = (
     os.getenv("NEO4J_USERNAME"),
     os.getenv("NEO4J_PASSWORD")
 )
+#optional, directory of a local Neo4j installation, needed by load --bulk-import (neo4j-admin)
+NEO4J_HOME = os.getenv("NEO4J_HOME")
 
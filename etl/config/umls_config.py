@@ -0,0 +1,88 @@
+#LOCAL UMLS (METATHESAURUS) CONFIGURATION
+#used to build and query the offline index from a licensed UMLS release (MRCONSO.RRF and MRSTY.RRF).
+
+#sources kept in the index, None keeps every source. restricting them makes the index (and its build) much smaller.
+UMLS_INDEX_SOURCES = None
+
+#when several concepts share the same string, the first criteria that differs decides:
+#1 - semantic type: concepts whose type is close to our NER labels win (types not listed come last)
+UMLS_PREFERRED_SEMANTIC_TYPES = [
+    'T191',  #Neoplastic Process
+    'T028',  #Gene or Genome
+    'T116',  #Amino Acid, Peptide, or Protein
+    'T126',  #Enzyme
+    'T192',  #Receptor
+    'T129',  #Immunologic Factor
+    'T025',  #Cell
+    'T026',  #Cell Component
+    'T024',  #Tissue
+    'T023',  #Body Part, Organ, or Organ Component
+    'T022',  #Body System
+    'T029',  #Body Location or Region
+    'T030',  #Body Space or Junction
+    'T031',  #Body Substance
+    'T018',  #Embryonic Structure
+    'T190',  #Anatomical Abnormality
+    'T109',  #Organic Chemical
+    'T121',  #Pharmacologic Substance
+    'T196',  #Element, Ion, or Isotope
+    'T197',  #Inorganic Chemical
+    'T123',  #Biologically Active Substance
+    'T047',  #Disease or Syndrome
+    'T046',  #Pathologic Function
+    'T204',  #Eukaryote
+    'T007',  #Bacterium
+    'T005',  #Virus
+]
+
+#2 - source vocabulary (not listed sources come last)
+UMLS_PREFERRED_SOURCES = ['MSH', 'NCI', 'SNOMEDCT_US', 'HGNC', 'GO', 'MTH', 'RXNORM', 'CHV', 'NCBI', 'OMIM', 'MEDLINEPLUS']
+
+#3 - term type inside the source (preferred terms first)
+UMLS_PREFERRED_TERM_TYPES = ['PT', 'PN', 'MH', 'NM', 'PEP', 'HT', 'SY', 'ET', 'AB', 'ACR']
+
+#the UMLS API returns urls of this form for CUIs, we build the same ones offline.
+UMLS_CONCEPT_URL = "https://uts-ws.nlm.nih.gov/rest/content/{release}/CUI/{cui}"
+
+#APPROXIMATE MATCHING (char 3-grams TF-IDF + nmslib HNSW index, see modules/umls_ann.py)
+#minimum cosine similarity between an entity and a concept name to accept the concept
+UMLS_ANN_MIN_SIMILARITY = 0.85
+#number of neighbours retrieved per query
+UMLS_ANN_K = 5
+#HNSW parameters, higher values give a better recall but a slower build / query
+UMLS_ANN_INDEX_PARAMS = {"M": 30, "efConstruction": 100, "post": 0}
+UMLS_ANN_QUERY_PARAMS = {"efSearch": 100}
+#threads per query batch, annotation workers already use one process per core
+UMLS_ANN_QUERY_THREADS = 1
+
+#MESH HEADINGS AND KEYWORDS (see modules/mesh_mapper.py)
+#NER label given to the concepts of each semantic type, the first type of a concept found in this mapping wins.
+#concepts without any of these types are not emitted (e.g. 'Humans', 'Female', 'Retrospective Studies').
+UMLS_TUI_LABELS = {
+    'T191': 'CANCER',                           #Neoplastic Process
+    'T028': 'GENE_OR_GENE_PRODUCT',             #Gene or Genome
+    'T116': 'GENE_OR_GENE_PRODUCT',             #Amino Acid, Peptide, or Protein
+    'T126': 'GENE_OR_GENE_PRODUCT',             #Enzyme
+    'T192': 'GENE_OR_GENE_PRODUCT',             #Receptor
+    'T129': 'GENE_OR_GENE_PRODUCT',             #Immunologic Factor
+    'T025': 'CELL',                             #Cell
+    'T026': 'CELLULAR_COMPONENT',               #Cell Component
+    'T024': 'TISSUE',                           #Tissue
+    'T023': 'ORGAN',                            #Body Part, Organ, or Organ Component
+    'T022': 'ANATOMICAL_SYSTEM',                #Body System
+    'T029': 'ORGANISM_SUBDIVISION',             #Body Location or Region
+    'T030': 'IMMATERIAL_ANATOMICAL_ENTITY',     #Body Space or Junction
+    'T031': 'ORGANISM_SUBSTANCE',               #Body Substance
+    'T018': 'DEVELOPING_ANATOMICAL_STRUCTURE',  #Embryonic Structure
+    'T190': 'PATHOLOGICAL_FORMATION',           #Anatomical Abnormality
+    'T109': 'SIMPLE_CHEMICAL',                  #Organic Chemical
+    'T121': 'SIMPLE_CHEMICAL',                  #Pharmacologic Substance
+    'T196': 'SIMPLE_CHEMICAL',                  #Element, Ion, or Isotope
+    'T197': 'SIMPLE_CHEMICAL',                  #Inorganic Chemical
+    'T123': 'SIMPLE_CHEMICAL',                  #Biologically Active Substance
+    'T204': 'ORGANISM',                         #Eukaryote
+    'T007': 'ORGANISM',                         #Bacterium
+    'T005': 'ORGANISM',                         #Virus
+}
+#MeSH term types preferred for the name of a descriptor (main heading, supplementary concept name)
+MESH_PREFERRED_TERM_TYPES = ['MH', 'NM']
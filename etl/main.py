@@ -5,10 +5,11 @@ import time
 
 from scripts.extract import extract_pubmed_to_mongo
 from scripts.transform.annotate import annotate_mongo_articles
-from scripts.transform.clean import prepare_data_for_neo4j
+from scripts.transform.clean import prepare_data_for_neo4j, delta_path
 from scripts.load import load_to_Neo4j
 
 from config.neo4jdb_config import NEO4J_LABELS, NEO4J_REL_TYPES
+from config.clean_config import CLEAN_ENGINE
 
 
 #TODO: CHECK THAT CLI ARGS SUPPORT ALL AVAILABLE OPTIONS, AND NO LONGER CONTAIN UNSUPPORTED ONES.
@@ -56,12 +57,16 @@ def extract_stage(article_content: bool = False,
 
 
 
-def annotate_stage():
+def annotate_stage(profile_patterns: bool = False, two_pass: bool = False, sentence_cache: bool = False,
+                   metrics_port: int = None, defer_normalization: bool = False,
+                   store_docs: bool = False, rematch: bool = False):
     """Step 2: Apply NER and RE to articles stored in MongoDB"""
     try:
         logging.info("Starting annotation stage.")
         print("Starting annotation stage...")
-        annotate_mongo_articles()
+        annotate_mongo_articles(profile_patterns=profile_patterns, two_pass=two_pass, sentence_cache=sentence_cache,
+                                metrics_port=metrics_port, defer_normalization=defer_normalization,
+                                store_docs=store_docs, rematch=rematch)
         logging.info(f"Annotation stage completed. Check data/ folder for created CSV files.")
         print("Annotation stage completed. Check data/ folder.")
         return True
@@ -76,12 +81,12 @@ def annotate_stage():
 
 
 
-def clean_stage():
+def clean_stage(engine: str = CLEAN_ENGINE, incremental: bool = False):
     """Step 3: Clean and prepare extracted data for Neo4j and return cleaned CSV paths."""
     try:
         logging.info("Starting cleaning stage.")
         print("Starting cleaning stage...")
-        ents_path, rels_path = prepare_data_for_neo4j()
+        ents_path, rels_path = prepare_data_for_neo4j(engine=engine, incremental=incremental)
         logging.info(f"Cleaning stage completed. Cleaned files: {ents_path}, {rels_path}")
         print("Cleaning stage completed.")
         return ents_path, rels_path
@@ -101,7 +106,9 @@ def load_stage(only_related = True,
                rels_clean_csv='data/ready_for_neo4j/relations4neo4j.csv',
                labels=NEO4J_LABELS,
                reltypes=NEO4J_REL_TYPES,
-               load_batch_size=1000):
+               load_batch_size=1000,
+               incremental: bool = False,
+               bulk_import: bool = False):
     """Step 4: Load entities and relations into Neo4j Neo4j."""
     try:
         logging.info("Starting loading stage.")
@@ -112,7 +119,9 @@ def load_stage(only_related = True,
             ents_clean_csv=ents_clean_csv,
             reltypes_to_load=reltypes,
             rels_clean_csv=rels_clean_csv,
-            load_batch_size=load_batch_size
+            load_batch_size=load_batch_size,
+            incremental=incremental,
+            bulk_import=bulk_import
         )
         logging.info("Loading stage completed.")
         print("Loading stage completed.")
@@ -133,7 +142,15 @@ def run_etl(article_content: bool = False,
     max_results: int = None,
     batch_size: int = 1000,
     bulk_size: int= 10000,
-    load_batch_size=1000):
+    load_batch_size=1000,
+    profile_patterns: bool = False,
+    two_pass: bool = False,
+    sentence_cache: bool = False,
+    metrics_port: int = None,
+    defer_normalization: bool = False,
+    store_docs: bool = False,
+    clean_engine: str = CLEAN_ENGINE,
+    incremental: bool = False):
     """Full ETL pipeline orchestrator."""
     try:
         # Step 1: Extract
@@ -147,20 +164,24 @@ def run_etl(article_content: bool = False,
             return False
         
         # Step 2: Annotate
-        if not annotate_stage():
+        if not annotate_stage(profile_patterns, two_pass, sentence_cache, metrics_port, defer_normalization, store_docs):
             print("ETL pipeline stopped: Annotation stage failed or was interrupted.")
             logging.error("ETL pipeline stopped: Annotation stage failed or was interrupted.")
             return False
         
         # Step 3: Clean
-        ents_path, rels_path = clean_stage()
+        ents_path, rels_path = clean_stage(clean_engine, incremental)
         if not ents_path or not rels_path:
             print("ETL pipeline stopped: Cleaning stage failed or was interrupted.")
             logging.error("ETL pipeline stopped: Cleaning stage failed or was interrupted.")
             return False
         
         # Step 4: Load
-        if not load_stage(only_related=only_related, ents_clean_csv=ents_path, rels_clean_csv=rels_path, load_batch_size=load_batch_size):
+        #an incremental run only loads what its clean added (the delta files)
+        if incremental:
+            ents_path, rels_path = delta_path(ents_path), delta_path(rels_path)
+        if not load_stage(only_related=only_related, ents_clean_csv=ents_path, rels_clean_csv=rels_path, load_batch_size=load_batch_size,
+                          incremental=incremental):
             print("ETL pipeline stopped: Loading stage failed or was interrupted.")
             logging.error("ETL pipeline stopped: Loading stage failed or was interrupted.")
             return False
@@ -223,6 +244,21 @@ No Flags Examples:
         default=1000,
         help="Batch size for loading nodes and relationships to Neo4j (default: 1000)"
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only clean the annotation output not cleaned yet (state in data/clean_state/), and only load the nodes and relationships that are new or changed since the last load (state in data/load_state/)"
+    )
+    parser.add_argument(
+        "--from-deltas",
+        action="store_true",
+        help="Load the delta files of the last clean (the nodes and relationships it added) instead of the full CSV files"
+    )
+    parser.add_argument(
+        "--bulk-import",
+        action="store_true",
+        help="Load only: rebuild the whole graph offline with neo4j-admin database import full (NEO4J_HOME, the database must be stopped) instead of transactional batches"
+    )
     parser.add_argument(
         "--bulk-size",
         type=int,
@@ -235,13 +271,57 @@ No Flags Examples:
         action="store_true",
         help="Extract full articles contents instead of abstracts only"
     )
+    parser.add_argument(
+        "--clean-engine",
+        choices=["pandas", "duckdb"],
+        default=CLEAN_ENGINE,
+        help=f"Engine of the cleaning stage: 'pandas' (in memory) or 'duckdb' (out of core, same output) (default: {CLEAN_ENGINE})"
+    )
     parser.add_argument(
         "--include-singletons",
         action="store_true",
         help="Load all nodes to Neo4j, even those that are isolated (have no relationship) Default: only load related nodes."
     )
+    parser.add_argument(
+        "--profile-patterns",
+        action="store_true",
+        help="Profile the relation patterns during annotation (time, matches, yield), report written to data/profiling/"
+    )
+    parser.add_argument(
+        "--two-pass",
+        action="store_true",
+        help="Annotate in two passes: NER on the whole text, then dependency parsing only of the sentences that can hold a relation"
+    )
+    parser.add_argument(
+        "--sentence-cache",
+        action="store_true",
+        help="Annotate sentence per sentence, and reuse the cached annotations of repeated sentences (cache/sentence_cache.sqlite)"
+    )
+    parser.add_argument(
+        "--defer-normalization",
+        action="store_true",
+        help="Annotate in two phases: NER and RE over the whole corpus first, then normalize the unique entity strings once, in bulk"
+    )
+    parser.add_argument(
+        "--store-docs",
+        action="store_true",
+        help="Store the processed Docs of the articles (data/doc_store/), so a later 'annotate --rematch' can apply changed patterns without NER"
+    )
+    parser.add_argument(
+        "--rematch",
+        action="store_true",
+        help="Annotate only: match the relation patterns and filter the generic entities again on the stored Docs, without NER nor parsing"
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve the live annotation metrics (Prometheus format) on localhost:PORT/metrics. A JSON snapshot is written to data/metrics/ in any case."
+    )
     
     args = parser.parse_args()
+    if args.bulk_import and (args.step != "load" or args.incremental or args.from_deltas):
+        parser.error("--bulk-import rebuilds the whole graph from the full CSV files: 'load' step only, without --incremental nor --from-deltas")
     
     success = False
     
@@ -254,22 +334,39 @@ No Flags Examples:
                 bulk_size = args.bulk_size
             )
         elif args.step == "annotate":
-            success = annotate_stage()
+            success = annotate_stage(profile_patterns=args.profile_patterns, two_pass=args.two_pass,
+                                     sentence_cache=args.sentence_cache, metrics_port=args.metrics_port,
+                                     defer_normalization=args.defer_normalization,
+                                     store_docs=args.store_docs, rematch=args.rematch)
         elif args.step == "clean":
-            ents_path, rels_path = clean_stage()
+            ents_path, rels_path = clean_stage(args.clean_engine, args.incremental)
             success = bool(ents_path and rels_path)
             if success:
                 print(f"Cleaned files ready: {ents_path}, {rels_path}")
         elif args.step == "load":
+            ents_csv, rels_csv = 'data/ready_for_neo4j/entities4neo4j.csv', 'data/ready_for_neo4j/relations4neo4j.csv'
+            if args.from_deltas:
+                ents_csv, rels_csv = delta_path(ents_csv), delta_path(rels_csv)
             success = load_stage(load_batch_size=args.load_batch_size,
-                                 only_related=not args.include_singletons)
+                                 only_related=not args.include_singletons,
+                                 incremental=args.incremental,
+                                 bulk_import=args.bulk_import,
+                                 ents_clean_csv=ents_csv, rels_clean_csv=rels_csv)
         else:
             success = run_etl(only_related=not args.include_singletons, 
                 max_results=args.max_results,
                 article_content= args.article_content,
                 batch_size=args.batch_size,
                 bulk_size=args.bulk_size,
-                load_batch_size=args.load_batch_size
+                load_batch_size=args.load_batch_size,
+                profile_patterns=args.profile_patterns,
+                two_pass=args.two_pass,
+                sentence_cache=args.sentence_cache,
+                metrics_port=args.metrics_port,
+                defer_normalization=args.defer_normalization,
+                store_docs=args.store_docs,
+                clean_engine=args.clean_engine,
+                incremental=args.incremental
             )
     
     except KeyboardInterrupt:
@@ -0,0 +1,161 @@
+import pandas as pd
+
+import gzip
+import logging
+import subprocess
+
+from pathlib import Path
+
+from config.clean_config import CLEAN_EVIDENCE_SEPARATOR
+from config.neo4jdb_config import (NEO4J_IMPORT_DIR, NEO4J_IMPORT_PART_ROWS, NEO4J_IMPORT_COMPRESS,
+                                   NEO4J_IMPORT_DATABASE, NEO4J_ENTITY_LABEL)
+
+"""Offline bulk import of the cleaned CSV files (load --bulk-import).
+The transactional loader (modules/neo4j.py) sends the nodes and relations in UNWIND/MERGE batches, each one an
+index lookup and a write transaction, which is what an incremental load needs but makes a rebuild of the whole graph
+take hours. neo4j-admin database import full writes the store files directly from CSV files, without transactions,
+but the database must be stopped and it is replaced by the import.
+The CSV files of the cleaning stage already use the import header conventions (:ID, :LABEL, :START_ID, :END_ID,
+:TYPE); they are rewritten here as one header file and data files (optionally gzip compressed, NEO4J_IMPORT_PART_ROWS
+rows each, so neo4j-admin reads them in parallel) per label and per relationship type, with the property types
+declared in the headers, and the same properties and filters as the transactional loader."""
+
+#columns of the nodes CSV file that are not node properties (as in Neo4jConnector._get_nodes_with_label)
+_NODE_DROPPED = [":LABEL", "pmid", "pmcid", "fetching_date"]
+#types of the relationship properties that are not strings (see clean.EDGE_COLUMNS)
+_RELATIONSHIP_TYPES = {"evidence_count": "long", "pmids": "string[]", "pmcids": "string[]"}
+_CHUNK_ROWS = 500_000
+
+
+class _PartWriter:
+    """Header file and data files of one label or relationship type, a new data file every part_rows rows."""
+    def __init__(self, directory: Path, option: str, group: str, header: list[str], compress: bool, part_rows: int):
+        self.directory, self.option, self.group = directory, option, group
+        self.compress, self.part_rows = compress, part_rows
+        self.header = directory / f"{option}-{group}-header.csv"
+        pd.DataFrame(columns=header).to_csv(self.header, index=False)
+        self.parts, self.rows, self._file = [], 0, None
+
+
+
+    def write(self, rows: pd.DataFrame):
+        while not rows.empty:
+            if self._file is None or self.rows == self.part_rows:
+                self._next_part()
+            batch = rows.iloc[:self.part_rows - self.rows]
+            batch.to_csv(self._file, header=False, index=False)
+            self.rows += len(batch)
+            rows = rows.iloc[len(batch):]
+
+
+
+    def _next_part(self):
+        self.close()
+        path = self.directory / f"{self.option}-{self.group}-part{len(self.parts):04d}.csv{'.gz' if self.compress else ''}"
+        self._file = (gzip.open(path, "wt", newline="", encoding="utf-8") if self.compress
+                      else open(path, "w", newline="", encoding="utf-8"))
+        self.parts.append(path)
+        self.rows = 0
+
+
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+
+    def argument(self) -> str:
+        """--nodes / --relationships argument of neo4j-admin for these files, the nodes also get the shared entity label."""
+        files = ",".join(str(path.resolve()) for path in [self.header, *self.parts])
+        group = f"{NEO4J_ENTITY_LABEL}:{self.group}" if self.option == "nodes" else self.group
+        return f"--{self.option}={group}={files}"
+
+
+
+
+def write_import_files(ents_csv: str, rels_csv: str, labels: list[str], reltypes: list[str], only_related: bool = True,
+                       import_dir: str = NEO4J_IMPORT_DIR, compress: bool = NEO4J_IMPORT_COMPRESS,
+                       part_rows: int = NEO4J_IMPORT_PART_ROWS) -> list[str]:
+    """Writes the import files of the nodes of the labels and the relationships of the types (read by chunks),
+    returns the --nodes and --relationships arguments of neo4j-admin.
+    Params:
+            ents_csv, rels_csv: cleaned CSV files.
+            labels, reltypes: labels and relationship types to import, the other ones are skipped.
+            only_related: if True, only the nodes with at least one relationship are imported.
+            import_dir: directory of the import files, its previous import files are deleted.
+            compress: gzip the data files.
+            part_rows: rows per data file."""
+    directory = Path(import_dir)
+    directory.mkdir(parents=True, exist_ok=True)
+    for old in [*directory.glob("*.csv"), *directory.glob("*.csv.gz")]:
+        old.unlink()
+
+    related = None
+    if only_related:
+        related = set()
+        for chunk in pd.read_csv(rels_csv, usecols=[":START_ID", ":END_ID"], dtype=str, chunksize=_CHUNK_ROWS):
+            related.update(chunk[":START_ID"])
+            related.update(chunk[":END_ID"])
+
+    #NODES, the values are written as they are in the CSV file (only empty fields are missing)
+    writers, imported = {}, set()
+    try:
+        for chunk in pd.read_csv(ents_csv, dtype=str, keep_default_na=False, na_values=[""], chunksize=_CHUNK_ROWS):
+            chunk = chunk[chunk[":LABEL"].isin(labels)]
+            if related is not None:
+                chunk = chunk[chunk[":ID"].isin(related)]
+            properties = chunk.drop(columns=[column for column in _NODE_DROPPED if column in chunk.columns])
+            for label, nodes in properties.groupby(chunk[":LABEL"], sort=False):
+                if label not in writers:
+                    header = ["id:ID" if column == ":ID" else column for column in nodes.columns]
+                    writers[label] = _PartWriter(directory, "nodes", label, header, compress, part_rows)
+                writers[label].write(nodes)
+            imported.update(chunk[":ID"])
+    finally:
+        for writer in writers.values():
+            writer.close()
+    arguments = [writer.argument() for writer in writers.values()]
+    logging.info(f"Bulk Import: {len(imported)} nodes of {len(writers)} labels written to {directory}.")
+
+    #RELATIONSHIPS, one file per type (no :TYPE column), only between imported nodes, the import fails otherwise
+    writers, count = {}, 0
+    try:
+        for chunk in pd.read_csv(rels_csv, dtype=str, keep_default_na=False, na_values=[""], chunksize=_CHUNK_ROWS):
+            chunk = chunk[chunk[":TYPE"].isin(reltypes) & chunk[":START_ID"].isin(imported)
+                          & chunk[":END_ID"].isin(imported)]
+            for reltype, relationships in chunk.drop(columns=":TYPE").groupby(chunk[":TYPE"], sort=False):
+                if reltype not in writers:
+                    header = [f"{column}:{_RELATIONSHIP_TYPES[column]}" if column in _RELATIONSHIP_TYPES else column
+                              for column in relationships.columns]
+                    writers[reltype] = _PartWriter(directory, "relationships", reltype, header, compress, part_rows)
+                writers[reltype].write(relationships)
+            count += len(chunk)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    arguments += [writer.argument() for writer in writers.values()]
+    logging.info(f"Bulk Import: {count} relationships of {len(writers)} types written to {directory}.")
+    return arguments
+
+
+
+def run_import(neo4j_home: str, arguments: list[str], database: str = NEO4J_IMPORT_DATABASE,
+               import_dir: str = NEO4J_IMPORT_DIR):
+    """Runs neo4j-admin database import full of the import files (arguments of write_import_files()) into the
+    database of the local Neo4j installation at neo4j_home, replacing it. The database must be stopped."""
+    if not neo4j_home:
+        raise ValueError("NEO4J_HOME is not set, the bulk import needs a local Neo4j installation.")
+    neo4j_admin = Path(neo4j_home) / "bin" / "neo4j-admin"
+    if not neo4j_admin.exists():
+        raise FileNotFoundError(f"{neo4j_admin} not found, is NEO4J_HOME the directory of a Neo4j installation?")
+    command = [str(neo4j_admin), "database", "import", "full", *arguments,
+               "--overwrite-destination=true",
+               "--id-type=string",
+               f"--array-delimiter={CLEAN_EVIDENCE_SEPARATOR}",
+               f"--report-file={(Path(import_dir) / 'import.report').resolve()}",
+               database]
+    logging.info(f"Bulk Import: running neo4j-admin database import full into '{database}'.")
+    subprocess.run(command, check=True)
+    logging.info(f"Bulk Import: '{database}' imported, start Neo4j to use it.")
@@ -0,0 +1,152 @@
+import pandas as pd
+
+import os
+import fcntl
+import pickle
+import hashlib
+import logging
+
+from tqdm import tqdm
+from concurrent.futures import as_completed
+
+from modules.umls_api import UMLSNormalizer, UMLSNormalizationService
+from modules.umls_local import LocalUMLSNormalizer
+from modules.umls_ann import ApproximateConceptLinker
+from modules.nlp_output import read_parts, readable_parts, replace_part, ENTITIES_SCHEMA
+from config.nlp_config import NORMALIZATION_CACHE_PATH
+
+"""Second phase of the two phase annotation (annotate --defer-normalization).
+In the first phase, the workers run NER and relation extraction only: the entities missing from the normalization
+cache are written without a concept, with the string they must be normalized under in their 'norm_text' column
+(their lemma, or the long form of an abbreviation). Once the whole corpus is annotated, the unique strings of
+all the articles are normalized in one pass (local tier first, then the rate limited UMLS API, every string once),
+and joined back to the entities, so the NLP never waits on the UMLS latency."""
+
+NORMALIZATION_COLUMNS = ["cui", "normalized_name", "normalization_source", "url"]
+
+
+def cache_key(text: str) -> str:
+    """MD5 key of a string in the normalization cache (shared with StreamingOptimizedNLP)."""
+    return hashlib.md5(text.lower().strip().encode()).hexdigest()
+
+
+def load_normalization_cache(path: str = NORMALIZATION_CACHE_PATH) -> dict:
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return {}
+    except (EOFError, pickle.UnpicklingError):
+        logging.warning("Bulk Normalization: cache file corrupted, starting fresh.")
+        return {}
+
+
+def save_normalization_cache(cache: dict, path: str = NORMALIZATION_CACHE_PATH):
+    """Atomic writing of the normalization cache."""
+    temp = f"{path}.tmp"
+    with open(temp, 'wb') as f:
+        pickle.dump(cache, f)
+    os.replace(temp, path)
+
+
+def merge_normalization_cache(cache: dict, path: str = NORMALIZATION_CACHE_PATH) -> dict:
+    """Merges the cache with the one on disk and saves the result under a file lock, returns the merged cache.
+    Every worker saves its own copy, so a worker must not erase the entries the others saved since it loaded it
+    (e.g. a worker of the recycling pool, forked from the parent's cache of the start of the run)."""
+    lock = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        merged = load_normalization_cache(path)
+        merged.update(cache)
+        save_normalization_cache(merged, path)
+        return merged
+    finally:
+        os.close(lock) #closing the descriptor releases the lock
+
+
+
+
+def normalize_strings(texts: list[str], cache: dict, normalizer: UMLSNormalizer | LocalUMLSNormalizer,
+                      local_linker: ApproximateConceptLinker = None, save_every: int = 1000):
+    """Normalize the strings missing from the cache, and add them to it (the strings the offline index doesn't know
+    are left out, so the cache can be used with the UMLS API later).
+    The local tier answers in one vectorized query, the rest goes to the normalizer
+    (through the shared rate limited service for the API)."""
+    missing = [text for text in texts if cache_key(text) not in cache]
+    logging.info(f"Bulk Normalization: {len(texts)} unique strings, {len(missing)} missing from the cache.")
+
+    if missing and local_linker is not None:
+        linked = local_linker.link_batch(missing)
+        for text, normalization_result in linked.items():
+            cache[cache_key(text)] = normalization_result
+        missing = [text for text in missing if text not in linked]
+
+    if not missing:
+        return cache
+
+    if not isinstance(normalizer, UMLSNormalizer):
+        for done, text in enumerate(tqdm(missing, desc="Normalizing unique entities:"), start=1):
+            #the misses of the offline index are not cached, the UMLS API of a later run may know them
+            normalization_result = normalizer.normalize(text)
+            if normalization_result:
+                cache[cache_key(text)] = normalization_result
+            if done % save_every == 0:
+                save_normalization_cache(cache)
+        return cache
+
+    service = UMLSNormalizationService(normalizer)
+    try:
+        future_to_text = {service.submit(text): text for text in missing}
+        for done, future in enumerate(tqdm(as_completed(future_to_text), total=len(future_to_text),
+                                           desc="Normalizing unique entities via UMLS API:"), start=1):
+            try:
+                cache[cache_key(future_to_text[future])] = future.result()
+            except Exception as e:
+                #not cached, it will be retried by the next run
+                logging.error(f"Bulk Normalization: failed to normalize '{future_to_text[future]}': {e}")
+            if done % save_every == 0:
+                save_normalization_cache(cache)
+    finally:
+        service.shutdown()
+    return cache
+
+
+
+def normalize_deferred_entities(entities_dir: str, normalizer: UMLSNormalizer | LocalUMLSNormalizer,
+                                local_linker: ApproximateConceptLinker = None) -> int:
+    """Normalize the entities written by the first phase without a concept, and rewrite the part files that have some.
+    Only the norm_text column of the dataset is read to collect the unique strings, then the part files are rewritten
+    one by one, so the memory follows the largest part file, not the corpus.
+    Returns the number of entities that were normalized."""
+    parts = readable_parts(entities_dir)
+    unique_texts = set()
+    for part in parts:
+        unique_texts.update(read_parts([part], columns=["norm_text"])["norm_text"].dropna())
+    if not unique_texts:
+        logging.info("Bulk Normalization: no deferred entities.")
+        return 0
+
+    unique_texts = sorted(unique_texts)
+    cache = load_normalization_cache()
+    normalize_strings(unique_texts, cache, normalizer, local_linker)
+    save_normalization_cache(cache)
+
+    #one row per unique string, joined to the entities by their norm_text
+    resolved = pd.DataFrame.from_records(
+        [{"norm_text": text, **{column: cache.get(cache_key(text), {}).get(column) for column in NORMALIZATION_COLUMNS}}
+         for text in unique_texts]).set_index("norm_text")
+    normalized = total = 0
+    for part in tqdm(parts, desc="Writing the normalized entities:"):
+        entities = read_parts([part])
+        deferred = entities["norm_text"].notna()
+        if not deferred.any():
+            continue
+        norm_texts = entities.loc[deferred, "norm_text"]
+        for column in NORMALIZATION_COLUMNS:
+            entities[column] = entities[column].astype(object)
+            entities.loc[deferred, column] = norm_texts.map(resolved[column]).values
+        replace_part(entities, part, ENTITIES_SCHEMA)
+        normalized += int(entities.loc[deferred, "cui"].fillna("").astype(bool).sum())
+        total += int(deferred.sum())
+    logging.info(f"Bulk Normalization: {normalized} of {total} deferred entities got a concept.")
+    return normalized
@@ -0,0 +1,148 @@
+import re
+import logging
+
+from modules.metrics import get_metrics
+from modules.nlp_output import ParquetStreamWriter, ENTITIES_SCHEMA, RELATIONS_SCHEMA
+from config.nlp_config import NLP_CHUNK_CHARS
+
+"""Long PMC bodies are split in chunks of bounded size, annotated in parallel by the workers,
+and stitched back by the parent process, so the latency and the peak memory of an article
+don't depend on its length. Chunks are cut at section (paragraph) boundaries first, then at
+sentence boundaries, and only at whitespaces for a sentence longer than a chunk.
+Chunks don't overlap: stitching orders the results by their offset in the whole text and
+deduplicates them per article, as the workers do for the articles they annotate whole."""
+
+_PARAGRAPHS = re.compile(r"\n\s*\n")
+_SENTENCES = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9(\[])")
+_WHITESPACES = re.compile(r"\s+")
+
+
+def _pieces(text: str, start: int, end: int, separators: list[re.Pattern], max_chars: int):
+    """Yields (start, end) of consecutive pieces of text[start:end], each one at most max_chars long
+    (unless it has no separator at all), using the first separator that splits it."""
+    if end - start <= max_chars:
+        yield start, end
+        return
+    if not separators:
+        logging.warning(f"Chunking: no boundary found in a {end - start} chars span, it is kept whole.")
+        yield start, end
+        return
+    separator, finer = separators[0], separators[1:]
+    piece_start = start
+    for match in separator.finditer(text, start, end):
+        yield from _pieces(text, piece_start, match.start(), finer, max_chars)
+        piece_start = match.end()
+    yield from _pieces(text, piece_start, end, finer, max_chars)
+
+
+def split_text(text: str, max_chars: int = NLP_CHUNK_CHARS) -> list[tuple[int, str]]:
+    """Returns (offset of the chunk in the text, chunk) pairs, consecutive pieces are packed
+    together as long as the chunk stays under max_chars."""
+    if len(text) <= max_chars:
+        return [(0, text)]
+
+    chunks = []
+    chunk_start = chunk_end = None
+    for start, end in _pieces(text, 0, len(text), [_PARAGRAPHS, _SENTENCES, _WHITESPACES], max_chars):
+        if chunk_start is not None and end - chunk_start > max_chars:
+            chunks.append((chunk_start, text[chunk_start:chunk_end]))
+            chunk_start = None
+        if chunk_start is None:
+            chunk_start = start
+        chunk_end = end
+    if chunk_start is not None:
+        chunks.append((chunk_start, text[chunk_start:chunk_end]))
+    return chunks
+
+
+
+
+class ChunkStitcher:
+    """Collects the results of the chunks of long articles in the parent process,
+    and writes each article once all its chunks are annotated.
+    Params:
+            entities_output_dir, relations_output_dir: the datasets the workers write to,
+            the parent writes its own part files next to theirs."""
+    def __init__(self, entities_output_dir: str, relations_output_dir: str, buffer_size: int = 1000):
+        self.entities_writer = ParquetStreamWriter(entities_output_dir, ENTITIES_SCHEMA)
+        self.relations_writer = ParquetStreamWriter(relations_output_dir, RELATIONS_SCHEMA)
+        self.buffer_size = buffer_size
+        self._pending = {}  #article id -> [number of missing chunks, {chunk index: (entities, relations)}]
+        self._entities = []
+        self._relations = []
+        self._next_id = 0
+
+
+
+    def expect(self, n_chunks: int) -> int:
+        """Registers an article split in n_chunks, returns its id."""
+        article_id = self._next_id
+        self._next_id += 1
+        self._pending[article_id] = [n_chunks, {}]
+        return article_id
+
+
+
+    def add(self, article_id: int, chunk_index: int, result: tuple[list[dict], list[dict]]):
+        """Stores the (entities, relations) of a chunk, the article is stitched with its last chunk."""
+        pending = self._pending[article_id]
+        pending[0] -= 1
+        pending[1][chunk_index] = result
+        if pending[0] == 0:
+            del self._pending[article_id]
+            self._stitch([pending[1][i] for i in sorted(pending[1])])
+            get_metrics().inc("documents_total")
+
+
+
+    def _stitch(self, results: list[tuple[list[dict], list[dict]]]):
+        entities = [entity for chunk_entities, _ in results for entity in chunk_entities]
+        #entities in the order of the text (curated terms have no offset and come first)
+        entities.sort(key=lambda entity: entity.get("start_char") or 0)
+        seen = set()
+        for entity in entities:
+            key = (entity["text"], entity["label"])
+            if key not in seen:
+                seen.add(key)
+                self._entities.append(entity)
+
+        seen = set()
+        for _, chunk_relations in results:
+            for relation in chunk_relations:
+                key = (relation["ent1"], relation["relation"], relation["ent2"])
+                if key not in seen:
+                    seen.add(key)
+                    self._relations.append(relation)
+        self.flush()
+
+
+
+    def flush(self, force: bool = False):
+        metrics = get_metrics()
+        if len(self._entities) >= self.buffer_size or force:
+            with metrics.timer("buffer_flush_seconds"):
+                self.entities_writer.write(self._entities)
+            metrics.inc("entities_total", len(self._entities))
+            self._entities = []
+        if len(self._relations) >= self.buffer_size or force:
+            with metrics.timer("buffer_flush_seconds"):
+                self.relations_writer.write(self._relations)
+            metrics.inc("relations_total", len(self._relations))
+            self._relations = []
+
+
+
+    def close(self):
+        if self._pending:
+            logging.warning(f"Chunking: {len(self._pending)} long articles were not complete, their results are dropped.")
+        self.flush(force=True)
+        self.entities_writer.close()
+        self.relations_writer.close()
+
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,132 @@
+import pandas as pd
+
+import os
+import pickle
+import logging
+
+from pathlib import Path
+
+from config.clean_config import CLEAN_STATE_PATH
+
+"""State of the cleaning stage between runs (clean --incremental).
+A full clean rereads all the annotation output. With the state of the previous cleans, a clean skips the part files
+it has already cleaned (identified by their name, size and modification time, so a part file rewritten by the bulk
+normalization is read again), and only keeps the rows of the articles it has not cleaned yet: annotate regenerates
+every part file under new names on each run, so the articles (pmcid, or pmid without pmcid) are the stable key.
+An article annotated again is not cleaned again (like the nodes already written, see clean_increment()).
+The new rows are deduplicated against:
+    - the CUIs and the names of the nodes already written, with their ids (the entity dictionary),
+    - the edges already written, keyed by their start node id, type and end node id.
+The new nodes and edges are appended to the CSV files, the new mentions of an edge already written are added to
+its evidence, and the nodes and edges added or updated are written to delta files for the loader.
+The state is rebuilt from the CSV files after each full clean, and ignored (full clean) when the cleaning
+columns or ids changed or the CSV files are missing."""
+
+
+#version of the state attributes, a state pickled by another version is not used (full clean)
+STATE_VERSION = 2
+
+
+def part_fingerprint(path: Path) -> str:
+    stat = Path(path).stat()
+    return f"{Path(path).name}|{stat.st_size}|{stat.st_mtime_ns}"
+
+
+def relation_keys(relations: pd.DataFrame) -> pd.Series:
+    """'<start id>|<type>|<end id>' of the edges (columns named for Neo4j)."""
+    return relations[":START_ID"] + "|" + relations[":TYPE"].fillna("") + "|" + relations[":END_ID"]
+
+
+
+
+class CleanState:
+    """Part files cleaned and entity dictionary of the CSV files for Neo4j.
+    Params:
+            path: pickle file of the state."""
+    def __init__(self, path: str = CLEAN_STATE_PATH):
+        self.path = Path(path)
+        self.version = STATE_VERSION
+        self.config = None     #fingerprint of the cleaning config that wrote the CSV files
+        self.parts = set()     #fingerprints of the existing part files cleaned
+        self.pmids = set()     #articles cleaned, by pmid (articles without pmcid)
+        self.pmcids = set()    #and by pmcid
+        self.cuis = set()      #CUIs of the nodes
+        self.names = {}        #lowercased name -> node id
+        self.relations = set() #'<start id>|<type>|<end id>'
+        self.related = set()   #ids of the nodes with at least one relation
+
+
+
+    @classmethod
+    def load(cls, path: str = CLEAN_STATE_PATH):
+        """The state of the previous cleans, None if there is none."""
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (EOFError, pickle.UnpicklingError):
+            logging.warning("Clean State: state file corrupted, ignored.")
+            return None
+        if state.__dict__.get("version") != STATE_VERSION:
+            logging.info("Clean State: state of an older version, ignored.")
+            return None
+        logging.info(f"Clean State: {len(state.parts)} part files, {len(state.pmids) + len(state.pmcids)} articles, "
+                     f"{len(state.names)} nodes "
+                     f"and {len(state.relations)} relations already cleaned.")
+        return state
+
+
+
+    @classmethod
+    def from_output(cls, parts: list[str], ents_csv: str, rels_csv: str, config: str, path: str = CLEAN_STATE_PATH):
+        """State of a full clean, from its CSV files (read by chunks, only the key columns)."""
+        state = cls(path)
+        state.config = config
+        state.parts = set(parts)
+        #only empty fields are missing values, a node named 'null' or 'nan' keeps its name
+        for chunk in pd.read_csv(ents_csv, usecols=[":ID", "name", "cui"], dtype=str, keep_default_na=False,
+                                 na_values=[""], chunksize=500_000):
+            state.add_nodes(chunk)
+        for chunk in pd.read_csv(rels_csv, usecols=[":START_ID", ":TYPE", ":END_ID"], dtype=str,
+                                 chunksize=500_000):
+            state.add_relations(chunk)
+        return state
+
+
+
+    def usable(self, config: str, csv_paths: tuple[str, ...]) -> bool:
+        return self.config == config and all(Path(path).exists() for path in csv_paths)
+
+
+
+    def add_articles(self, ids: tuple[set, set]):
+        """Records the articles cleaned, (pmids, pmcids) of nlp_output.article_ids()."""
+        pmids, pmcids = ids
+        self.pmids.update(pmids)
+        self.pmcids.update(pmcids)
+
+
+
+    def add_nodes(self, nodes: pd.DataFrame):
+        self.cuis.update(nodes["cui"].dropna())
+        self.names.update(zip(nodes["name"], nodes[":ID"]))
+
+
+
+    def add_relations(self, relations: pd.DataFrame):
+        self.relations.update(relation_keys(relations))
+        self.related.update(relations[":START_ID"])
+        self.related.update(relations[":END_ID"])
+
+
+
+    def save(self):
+        """Atomic writing of the state."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp = f"{self.path}.tmp"
+        with open(temp, 'wb') as f:
+            pickle.dump(self, f)
+        os.replace(temp, self.path)
+        logging.info(f"Clean State: saved ({len(self.parts)} part files, {len(self.names)} nodes, "
+                     f"{len(self.relations)} relations).")
@@ -0,0 +1,172 @@
+import duckdb
+import pandas as pd
+
+import os
+import logging
+
+from pathlib import Path
+
+from modules.nlp_output import readable_parts
+from modules.pattern_profiler import save_clean_counts, write_pattern_report
+from config.clean_config import (CLEAN_CSV_DATE_FORMAT, CLEAN_CSV_BATCH_ROWS, CLEAN_DUCKDB_MEMORY_LIMIT,
+                                 CLEAN_DUCKDB_TEMP_DIR, CLEAN_DUCKDB_THREADS, CLEAN_TEXT_ID_PREFIX,
+                                 CLEAN_EDGE_MAX_EVIDENCE, CLEAN_EVIDENCE_SEPARATOR)
+
+"""Out of core engine of the cleaning stage (clean --clean-engine duckdb).
+The pandas engine loads both annotation datasets in memory, then deduplicates, concatenates and merges them there,
+which caps the size of the corpus to the RAM. This engine runs the same steps as SQL in an embedded DuckDB
+database: the part files are scanned in parallel, the sorts, windows and joins spill to CLEAN_DUCKDB_TEMP_DIR above
+CLEAN_DUCKDB_MEMORY_LIMIT, and the results are streamed to the CSV files in batches of CLEAN_CSV_BATCH_ROWS rows
+(written by pandas, so the files are the same as the pandas engine's).
+The order of the rows (part files sorted by name, then rows of each file) is kept explicitly in a row number,
+so 'keep the first duplicate' means the same row in both engines."""
+
+#rows of the annotation output, numbered in the order the pandas engine reads them
+_NUMBERED_ROWS = "SELECT row_number() OVER (ORDER BY filename, file_row_number) AS rn, {columns} " \
+                 "FROM read_parquet(?, filename = true, file_row_number = true)"
+
+
+def _connect() -> duckdb.DuckDBPyConnection:
+    Path(CLEAN_DUCKDB_TEMP_DIR).mkdir(parents=True, exist_ok=True)
+    connection = duckdb.connect()
+    connection.execute(f"SET memory_limit = '{CLEAN_DUCKDB_MEMORY_LIMIT}'")
+    connection.execute(f"SET temp_directory = '{CLEAN_DUCKDB_TEMP_DIR}'")
+    #the order of the rows is explicit (rn), duckdb doesn't have to keep the insertion order, which costs memory
+    connection.execute("SET preserve_insertion_order = false")
+    if CLEAN_DUCKDB_THREADS:
+        connection.execute(f"SET threads = {int(CLEAN_DUCKDB_THREADS)}")
+    return connection
+
+
+
+def _write_csv(connection: duckdb.DuckDBPyConnection, query: str, path: str, header: list[str]):
+    """Streams the result of a query to a CSV file, batch per batch (header: CSV names of the query columns)."""
+    temp = f"{path}.tmp"
+    #header first, so an empty result still gives a valid file
+    pd.DataFrame(columns=header).to_csv(temp, index=False)
+    reader = connection.execute(query).fetch_record_batch(CLEAN_CSV_BATCH_ROWS)
+    for batch in reader:
+        batch.to_pandas().to_csv(temp, mode="a", header=False, index=False, date_format=CLEAN_CSV_DATE_FORMAT)
+    os.replace(temp, path)
+
+
+
+def clean_with_duckdb(raw_ents_path: str, raw_rels_path: str, ents_path: str, rels_path: str,
+                      entity_columns: dict, relation_columns: list[str], edge_columns: list[str],
+                      unresolved_path: str):
+    """Deduplicates the entities (by CUI, then by lowercased text), maps the relations to the ids of their entities,
+    aggregates them to one edge per (start, type, end), and writes the CSV files for Neo4j.
+    Params:
+            raw_ents_path, raw_rels_path: annotation datasets (directories of part files).
+            ents_path, rels_path: CSV files to write.
+            entity_columns: columns read from the entities -> their name for Neo4j.
+            relation_columns: columns read from the relations.
+            edge_columns: CSV names of the edge columns (see clean.aggregate_edges()).
+            unresolved_path: CSV file of the relation endpoints that are not entities (name, number of endpoints)."""
+    entity_parts = [str(part) for part in readable_parts(raw_ents_path)]
+    relation_parts = [str(part) for part in readable_parts(raw_rels_path)]
+
+    connection = _connect()
+    try:
+        #ENTITIES
+        #empty CUIs (skipped strings and failed lookups) are missing, as in clean.missing_cuis()
+        selected = ["nullif(trim(cui), '') AS cui" if column == "cui" else column for column in entity_columns]
+        connection.execute(f"CREATE TEMP TABLE raw_entities AS {_NUMBERED_ROWS.format(columns=', '.join(selected))}",
+                           [entity_parts])
+        before = connection.execute("SELECT count(*) FROM raw_entities").fetchone()[0]
+        print("entities records before:", before)
+        logging.info(f"Entities: Before Cleaning: {before}")
+        #one row per CUI (the rows without CUI are all kept), then one row per lowercased text, the rows with a CUI first,
+        #with the deterministic ids of clean.entity_ids() (the CUI, or a hash of the label and the lowercased text)
+        other_columns = [column for column in entity_columns if column not in ("text", "cui")]
+        connection.execute(f"""
+            CREATE TEMP TABLE entities AS
+            WITH unique_cui AS (
+                SELECT * FROM raw_entities
+                QUALIFY cui IS NULL OR row_number() OVER (PARTITION BY cui ORDER BY rn) = 1
+            )
+            SELECT coalesce(cui, '{CLEAN_TEXT_ID_PREFIX}' || md5(coalesce(label, '') || '|' || lower(text))) AS id,
+                   lower(text) AS text, cui, {', '.join(other_columns)},
+                   cui IS NULL AS missing_cui, rn
+            FROM unique_cui
+            QUALIFY row_number() OVER (PARTITION BY lower(text) ORDER BY cui IS NULL, rn) = 1""")
+        connection.execute("DROP TABLE raw_entities")
+        logging.info("Entities: Drop CUI duplicates.")
+        logging.info("Entities: Drop ['text'] Duplicates.")
+        after = connection.execute("SELECT count(*) FROM entities").fetchone()[0]
+        print("entities records after:", after)
+        logging.info(f"Entities: After Cleaning: {after}")
+
+        #RELATIONS
+        lowered = ["lower(ent1) AS ent1" if column == "ent1" else "lower(ent2) AS ent2" if column == "ent2" else column
+                   for column in relation_columns]
+        connection.execute(f"CREATE TEMP TABLE raw_relations AS {_NUMBERED_ROWS.format(columns=', '.join(lowered))}",
+                           [relation_parts])
+        before = connection.execute("SELECT count(*) FROM raw_relations").fetchone()[0]
+        print("relations records before:", before)
+        logging.info(f"Relations: Before Cleaning: {before}")
+        #mapping relations to the ids of their entities, each mention keeps its own pmid, pmcid and date
+        connection.execute("""
+            CREATE TEMP TABLE mapped_relations AS
+            SELECT s.id AS start_id, e.id AS end_id, r.relation, r.pmid, r.pmcid, r.fetching_date, r.pattern, r.rn
+            FROM raw_relations r
+            JOIN entities s ON r.ent1 = s.text
+            JOIN entities e ON r.ent2 = e.text""")
+        #endpoints that are not entities, their relations are dropped by the joins
+        _write_csv(connection, """
+            SELECT name, count(*) AS endpoints FROM (
+                SELECT ent1 AS name FROM raw_relations r WHERE NOT EXISTS (SELECT 1 FROM entities e WHERE e.text = r.ent1)
+                UNION ALL
+                SELECT ent2 AS name FROM raw_relations r WHERE NOT EXISTS (SELECT 1 FROM entities e WHERE e.text = r.ent2))
+            GROUP BY name ORDER BY endpoints DESC, name""", unresolved_path, ["name", "endpoints"])
+        dropped = before - connection.execute("SELECT count(*) FROM mapped_relations").fetchone()[0]
+        logging.info(f"Relations: {dropped} relations dropped, their endpoint is not an entity (see {unresolved_path}).")
+        logging.info("Relations: Map To Entities & Rename Columns.")
+        #relations extracted with --profile-patterns carry the pattern that produced them
+        if connection.execute("SELECT count(pattern) > 0 FROM raw_relations").fetchone()[0]:
+            count_query = "SELECT pattern, count(*) AS n FROM {} WHERE pattern IS NOT NULL GROUP BY pattern"
+            save_clean_counts(connection.execute(count_query.format("raw_relations")).df().set_index("pattern")["n"],
+                              connection.execute(count_query.format("mapped_relations")).df().set_index("pattern")["n"])
+            write_pattern_report()
+        connection.execute("DROP TABLE raw_relations")
+
+        #one edge per (start, type, end) in the order of its first mention, with the number of mentions, the dates
+        #of the first and last ones, and the first distinct pmids and pmcids that mention it
+        evidence = f"""
+            SELECT start_id, relation, end_id, string_agg({{column}}, '{CLEAN_EVIDENCE_SEPARATOR}' ORDER BY first_rn) AS {{column}}s
+            FROM (SELECT start_id, relation, end_id, {{column}}, min(rn) AS first_rn
+                  FROM mapped_relations WHERE {{column}} IS NOT NULL
+                  GROUP BY start_id, relation, end_id, {{column}}
+                  QUALIFY row_number() OVER (PARTITION BY start_id, relation, end_id ORDER BY min(rn))
+                          <= {int(CLEAN_EDGE_MAX_EVIDENCE)})
+            GROUP BY start_id, relation, end_id"""
+        connection.execute(f"""
+            CREATE TEMP TABLE edges AS
+            WITH counts AS (
+                SELECT start_id, relation, end_id, count(*) AS evidence_count,
+                       min(fetching_date) AS first_seen, max(fetching_date) AS last_seen, min(rn) AS rn
+                FROM mapped_relations
+                GROUP BY start_id, relation, end_id
+            ),
+            pmids AS ({evidence.format(column="pmid")}),
+            pmcids AS ({evidence.format(column="pmcid")})
+            SELECT c.*, p.pmids, m.pmcids
+            FROM counts c
+            LEFT JOIN pmids p USING (start_id, relation, end_id)
+            LEFT JOIN pmcids m USING (start_id, relation, end_id)""")
+        connection.execute("DROP TABLE mapped_relations")
+        logging.info("Relations: Aggregate Mentions To Edges.")
+        after = connection.execute("SELECT count(*) FROM edges").fetchone()[0]
+        print("relations records after:", after)
+        logging.info(f"Relations: After Cleaning: {after}")
+
+        #export, in the order of the pandas engine
+        _write_csv(connection,
+                   f"SELECT id, {', '.join(entity_columns)} FROM entities ORDER BY missing_cui, rn",
+                   ents_path, [":ID", *entity_columns.values()])
+        _write_csv(connection,
+                   "SELECT start_id, end_id, relation, evidence_count, pmids, pmcids, first_seen, last_seen "
+                   "FROM edges ORDER BY rn",
+                   rels_path, edge_columns)
+    finally:
+        connection.close()
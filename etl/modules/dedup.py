@@ -0,0 +1,231 @@
+import numpy as np
+
+import os
+import math
+import fcntl
+import hashlib
+import logging
+
+from pathlib import Path
+from multiprocessing.util import Finalize
+
+from config.nlp_config import DEDUP_MAX_BYTES, DEDUP_BLOOM_CAPACITY, DEDUP_BLOOM_ERROR_RATE
+
+"""Compact deduplication state of the annotation workers.
+The entities and relations already extracted used to be kept as Python sets of 4-5 tuples of strings,
+hundreds of bytes per entry, growing for the whole life of the worker. HashedKeySet keeps a 64 bits hash
+per key instead (8 bytes per slot) in a NumPy open addressing table, under a memory budget.
+A BloomFilter can be attached to also skip the keys the table forgot when it was cleared, and the keys of the workers
+that exited before (recycled workers): it lives on disk, each worker merges the keys it added into it when it exits,
+and annotate empties it at the start of each run (the outputs of the previous runs are removed too)."""
+
+_SEPARATOR = "\x1f"
+
+
+def key_hash(namespace: str, key: tuple) -> int:
+    """64 bits hash of a key, never 0 (0 marks the empty slots of the table)."""
+    data = _SEPARATOR.join([namespace, *map(str, key)]).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little") or 1
+
+
+
+
+class BloomFilter:
+    """Bloom filter of the keys of the run, stored in a file shared by all the workers.
+    The file is memory-mapped read-only (the pages are shared by the workers), the keys added by this
+    process go to a private bit array, OR-ed into the file under an exclusive lock by save().
+    Params:
+            path: the file of the filter, created on the first save.
+            capacity: expected number of keys.
+            error_rate: false positive rate at capacity (a false positive drops a new key)."""
+    def __init__(self, path: str, capacity: int = DEDUP_BLOOM_CAPACITY, error_rate: float = DEDUP_BLOOM_ERROR_RATE):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        n_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.n_words = (n_bits + 63) // 64
+        self.n_bits = self.n_words * 64
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+
+        self.previous = None
+        if self.path.exists():
+            if self.path.stat().st_size == self.n_words * 8:
+                self.previous = np.memmap(self.path, dtype=np.uint64, mode="r")
+            else:
+                logging.warning(f"Dedup: {self.path} was built with another capacity, it is ignored and will be replaced.")
+        self.added = np.zeros(self.n_words, dtype=np.uint64)
+        self._dirty = False
+        #ProcessPool workers exit without garbage collecting their globals, multiprocessing finalizers still run.
+        self._finalizer = Finalize(self, self.save, exitpriority=10)
+
+
+
+    def after_fork(self):
+        """Register the save at exit again in a worker forked from the process that created the filter
+        (multiprocessing drops the finalizers of the parent in its children)."""
+        self._finalizer = Finalize(self, self.save, exitpriority=10)
+
+
+
+    def _positions(self, hashed: int):
+        #double hashing: k positions from the two halves of the 64 bits hash
+        h1, h2 = hashed & 0xFFFFFFFF, (hashed >> 32) | 1
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+
+
+    @staticmethod
+    def _all_set(words: np.ndarray, positions: list[int]) -> bool:
+        return all(int(words[p >> 6]) >> (p & 63) & 1 for p in positions)
+
+
+
+    def __contains__(self, hashed: int) -> bool:
+        positions = self._positions(hashed)
+        return ((self.previous is not None and self._all_set(self.previous, positions))
+                or self._all_set(self.added, positions))
+
+
+
+    def add(self, hashed: int):
+        for p in self._positions(hashed):
+            self.added[p >> 6] |= np.uint64(1 << (p & 63))
+        self._dirty = True
+
+
+
+    def save(self):
+        """Merge the keys added by this process into the file."""
+        if not self._dirty:
+            return
+        lock = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            merged = self.added.copy()
+            if self.path.exists() and self.path.stat().st_size == self.n_words * 8:
+                merged |= np.fromfile(self.path, dtype=np.uint64)
+            #replace the file, workers that mapped the old one keep a consistent view
+            temp = self.path.with_suffix(".tmp")
+            merged.tofile(temp)
+            os.replace(temp, self.path)
+            self._dirty = False
+            logging.info(f"Dedup: Bloom filter saved to {self.path}.")
+        except OSError as e:
+            logging.error(f"Dedup: failed to save the Bloom filter: {e}")
+        finally:
+            os.close(lock)
+
+
+
+
+def reset_bloom_filter(path: str):
+    """Remove the Bloom filter of the previous run, called once by the parent before starting the workers."""
+    for file in [Path(path), Path(f"{path}.lock")]:
+        file.unlink(missing_ok=True)
+
+
+
+
+class HashedKeySet:
+    """Set of keys (tuples of strings) stored as 64 bits hashes in a linear probing NumPy table.
+    The table doubles when it is 70% full, as long as it fits in max_bytes. When the budget is reached,
+    the table is cleared (keys seen before are then only caught by the Bloom filter if there is one,
+    the remaining duplicates are dropped by the cleaning stage anyway).
+    Params:
+            namespace: prefix of the hashed keys, so several sets can share one Bloom filter.
+            max_bytes: memory budget of the table.
+            bloom: optional BloomFilter of the keys of the run."""
+    MAX_LOAD = 0.7
+
+    def __init__(self, namespace: str, max_bytes: int = DEDUP_MAX_BYTES, bloom: BloomFilter = None,
+                 initial_capacity: int = 1 << 16):
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.bloom = bloom
+        self.resets = 0
+        self._allocate(min(initial_capacity, self._max_capacity()))
+
+
+
+    def _max_capacity(self) -> int:
+        #largest power of two fitting in the budget
+        return 1 << max(4, (self.max_bytes // 8).bit_length() - 1)
+
+
+
+    def _allocate(self, capacity: int):
+        self.table = np.zeros(capacity, dtype=np.uint64)
+        self.mask = capacity - 1
+        self.size = 0
+
+
+
+    def _slot(self, hashed: int) -> int:
+        """Index of the slot holding the hash, or of the empty slot where it goes."""
+        i = hashed & self.mask
+        table = self.table
+        while True:
+            value = int(table[i])
+            if value == 0 or value == hashed:
+                return i
+            i = (i + 1) & self.mask
+
+
+
+    def _grow(self):
+        capacity = len(self.table)
+        if capacity * 2 > self._max_capacity():
+            self.resets += 1
+            logging.warning(f"Dedup: {self.namespace} table reached its budget ({self.occupancy()}), clearing it.")
+            self._allocate(capacity)
+            return
+        old = self.table[self.table != 0]
+        self._allocate(capacity * 2)
+        for hashed in old.tolist():
+            self.table[self._slot(hashed)] = hashed
+        self.size = len(old)
+        logging.info(f"Dedup: {self.namespace} table grown to {capacity * 2} slots.")
+
+
+
+    def add(self, key: tuple) -> bool:
+        """Add the key, returns True if it was not seen before."""
+        hashed = key_hash(self.namespace, key)
+        i = self._slot(hashed)
+        if self.table[i] != 0:
+            return False
+        if self.bloom is not None:
+            if hashed in self.bloom:
+                return False
+            self.bloom.add(hashed)
+
+        #the table grows (or is cleared) before the key goes in, so a reset doesn't lose it
+        if self.size + 1 > self.MAX_LOAD * len(self.table):
+            self._grow()
+            i = self._slot(hashed)
+        self.table[i] = hashed
+        self.size += 1
+        return True
+
+
+
+    def __contains__(self, key: tuple) -> bool:
+        hashed = key_hash(self.namespace, key)
+        return (self.table[self._slot(hashed)] != 0
+                or (self.bloom is not None and hashed in self.bloom))
+
+
+
+    def __len__(self) -> int:
+        return self.size
+
+
+
+    def occupancy(self) -> dict:
+        return {
+            "entries": self.size,
+            "capacity": len(self.table),
+            "load": round(self.size / len(self.table), 3),
+            "table_mb": round(self.table.nbytes / 1024 ** 2, 2),
+            "budget_mb": round(self.max_bytes / 1024 ** 2, 2),
+            "resets": self.resets,
+        }
@@ -0,0 +1,108 @@
+import os
+import uuid
+import shutil
+import hashlib
+import logging
+
+from pathlib import Path
+from datetime import datetime
+from multiprocessing.util import Finalize
+from spacy.tokens import DocBin
+
+from config.nlp_config import DOC_STORE_DIR, DOC_STORE_SHARD_SIZE
+
+"""Store of the processed Docs of the articles (annotate --store-docs), so the relation patterns and the generic
+entities can be changed and applied again (annotate --rematch) without running NER and parsing again.
+Each worker appends the Docs it processed (after merge_entities, with their abbreviations) to DocBin shards of
+DOC_STORE_SHARD_SIZE Docs, docs-<pid>-<uuid>.spacy. The metadata of the article (pmid, pmcid, date, MeSH headings
+and keywords) and its key (pmid and hash of the text) are kept in the user data of its Doc. The chunks of a long
+article (see modules/chunking.py) are stored as Docs of their own, with the key of the whole article, their index,
+the number of chunks and their offset, and are stitched again by the parent on --rematch.
+The Docs must be loaded with the vocab of the same model, and --rematch needs the options of the annotation
+that stored them (e.g. --two-pass Docs have no parse, the candidate sentences are parsed again)."""
+
+
+def doc_key(text: str, article_metadata: dict) -> str:
+    """Key of an article in the store: its pmid (or pmcid) and the hash of its text."""
+    article_id = article_metadata.get("pmid") or article_metadata.get("pmcid") or ""
+    return f"{article_id}:{hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()}"
+
+
+
+
+class DocStore:
+    """Writes the Docs of a worker to DocBin shards.
+    Params:
+            store_dir: directory of the shards.
+            shard_size: number of Docs after which a shard is written and a new one started."""
+    def __init__(self, store_dir: str = DOC_STORE_DIR, shard_size: int = DOC_STORE_SHARD_SIZE):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        self._doc_bin = DocBin(store_user_data=True)
+        #ProcessPool workers exit without garbage collecting their globals, multiprocessing finalizers still run.
+        self._finalizer = Finalize(self, self.flush, exitpriority=10)
+
+
+
+    def after_fork(self):
+        """Register the flush at exit again in a worker forked from the process that created the store."""
+        self._finalizer = Finalize(self, self.flush, exitpriority=10)
+
+
+
+    def add(self, doc, text: str, article_metadata: dict, mesh_headings: list = None, keywords: list = None,
+            chunk: dict = None):
+        """chunk: key of the article, index, number and offset of the chunks when the Doc is a chunk of a long article."""
+        doc.user_data["doc_store"] = {
+            "key": doc_key(text, article_metadata),
+            #the date goes through msgpack as a string
+            "article": {key: str(value) if key == "fetching_date" and value is not None else value
+                        for key, value in article_metadata.items()},
+            "mesh_headings": [list(heading) for heading in mesh_headings or []],
+            "keywords": list(keywords or []),
+        }
+        if chunk is not None:
+            doc.user_data["doc_store"]["chunk"] = dict(chunk)
+        self._doc_bin.add(doc)
+        if len(self._doc_bin) >= self.shard_size:
+            self.flush()
+
+
+
+    def flush(self):
+        """Write the current shard."""
+        if not len(self._doc_bin):
+            return
+        path = self.store_dir / f"docs-{os.getpid()}-{uuid.uuid4().hex[:8]}.spacy"
+        try:
+            self._doc_bin.to_disk(path)
+            logging.info(f"Doc Store: {len(self._doc_bin)} docs written to {path}.")
+        except OSError as e:
+            logging.error(f"Doc Store: failed to write {path}: {e}")
+        self._doc_bin = DocBin(store_user_data=True)
+
+
+
+
+def list_shards(store_dir: str = DOC_STORE_DIR) -> list[Path]:
+    return sorted(Path(store_dir).glob("docs-*.spacy"))
+
+
+
+def load_shard(path: str, vocab):
+    """Yields (doc, stored data) of the Docs of a shard, stored data being the dict DocStore.add() kept."""
+    doc_bin = DocBin(store_user_data=True).from_disk(path)
+    for doc in doc_bin.get_docs(vocab):
+        stored = doc.user_data.get("doc_store", {})
+        article = stored.get("article", {})
+        if isinstance(article.get("fetching_date"), str):
+            article["fetching_date"] = datetime.fromisoformat(article["fetching_date"])
+        yield doc, stored
+
+
+
+def reset_doc_store(store_dir: str = DOC_STORE_DIR):
+    """Remove the Docs of the previous run, called once by the parent before starting the workers."""
+    shutil.rmtree(store_dir, ignore_errors=True)
+    Path(store_dir).mkdir(parents=True, exist_ok=True)
@@ -0,0 +1,89 @@
+import os
+import json
+import pickle
+import hashlib
+import logging
+import threading
+
+from pathlib import Path
+
+from config.neo4jdb_config import NEO4J_LOAD_STATE_PATH
+
+"""State of the incremental loading (load --incremental).
+The node ids of the cleaning stage are deterministic (the CUI, or a hash of the label and the text, see
+scripts/transform/clean.py), so the MERGE of the loader updates the nodes of the previous runs instead of
+duplicating them, and a run only has to send what changed since the last one.
+LoadState keeps a fingerprint (MD5 of the properties sent to Neo4j) of every node and relation loaded,
+keyed by label and node id and by (start id, type, end id); the rows whose fingerprint is unchanged are skipped.
+The state is only updated for the rows Neo4j accepted, and saved once the load is done."""
+
+
+def fingerprint(row: dict) -> str:
+    return hashlib.md5(json.dumps(row, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def relation_key(relation: dict) -> str:
+    return f"{relation.get('start_id')}|{relation.get('type')}|{relation.get('end_id')}"
+
+
+
+
+class LoadState:
+    """Fingerprints of the nodes and relations already in Neo4j.
+    Params:
+            path: pickle file of the state."""
+    def __init__(self, path: str = NEO4J_LOAD_STATE_PATH):
+        self.path = Path(path)
+        self.nodes, self.relations = {}, {}
+        self._lock = threading.Lock() #labels and relation batches are loaded by threads
+        try:
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+            self.nodes, self.relations = state["nodes"], state["relations"]
+            logging.info(f"Load State: {len(self.nodes)} nodes and {len(self.relations)} relations already loaded.")
+        except FileNotFoundError:
+            logging.info("Load State: no previous load, everything will be loaded.")
+        except (EOFError, KeyError, pickle.UnpicklingError):
+            logging.warning("Load State: state file corrupted, everything will be loaded.")
+
+
+
+    def new_nodes(self, label: str, nodes: list[dict]) -> list[dict]:
+        """The nodes of the label that are not in Neo4j yet, or whose properties changed."""
+        return [node for node in nodes if self.nodes.get(f"{label}|{node['id']}") != fingerprint(node)]
+
+
+
+    def new_relations(self, relations: list[dict]) -> list[dict]:
+        return [relation for relation in relations
+                if self.relations.get(relation_key(relation)) != fingerprint(relation)]
+
+
+
+    def mark_nodes(self, label: str, nodes: list[dict]):
+        with self._lock:
+            self.nodes.update((f"{label}|{node['id']}", fingerprint(node)) for node in nodes)
+
+
+
+    def mark_relations(self, relations: list[dict]):
+        with self._lock:
+            self.relations.update((relation_key(relation), fingerprint(relation)) for relation in relations)
+
+
+
+    def clear(self):
+        """Forgets every load, after the graph was rebuilt without the loader (load --bulk-import)."""
+        with self._lock:
+            self.nodes, self.relations = {}, {}
+
+
+
+    def save(self):
+        """Atomic writing of the state."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp = f"{self.path}.tmp"
+        with self._lock, open(temp, 'wb') as f:
+            pickle.dump({"nodes": self.nodes, "relations": self.relations}, f)
+        os.replace(temp, self.path)
+        logging.info(f"Load State: saved ({len(self.nodes)} nodes, {len(self.relations)} relations).")
@@ -0,0 +1,109 @@
+import marisa_trie
+
+import json
+import logging
+import argparse
+
+from pathlib import Path
+
+from modules.umls_local import read_rrf, MRCONSO_COLUMNS, MRSTY_COLUMNS
+from config.umls_config import UMLS_TUI_LABELS, MESH_PREFERRED_TERM_TYPES, UMLS_CONCEPT_URL
+
+"""MeSH headings are curated concepts, they don't need NER nor a UMLS search.
+The tables are built from the same Metathesaurus release as the local UMLS index (and written in its directory):
+    - mesh.marisa: MeSH descriptor UI (e.g. D009369) -> 'CUI<TAB>label<TAB>preferred name'.
+    - cui_labels.marisa: CUI -> NER label, for the concepts whose semantic types are in UMLS_TUI_LABELS,
+      used to label the keywords resolved through the normalization cache."""
+
+
+
+
+class MeshMapper:
+    """Maps MeSH descriptors to entities, and CUIs to NER labels.
+    Params:
+            index_dir: directory of the local UMLS index, where MeshMapper.build_index() wrote its tables."""
+    def __init__(self, index_dir: str):
+        self.index_dir = Path(index_dir)
+        try:
+            self.descriptors = marisa_trie.BytesTrie().mmap(str(self.index_dir / "mesh.marisa"))
+            self.labels = marisa_trie.BytesTrie().mmap(str(self.index_dir / "cui_labels.marisa"))
+        except FileNotFoundError:
+            logging.error(f"MeSH Mapper: no MeSH tables found in {self.index_dir}, did you build them?")
+            raise
+        meta_path = self.index_dir / "meta.json"
+        self.release = json.loads(meta_path.read_text(encoding="utf-8")).get("release", "current") if meta_path.exists() else "current"
+        logging.info(f"MeSH Mapper: Initialized ({len(self.descriptors)} descriptors).")
+
+
+
+    def map_descriptor(self, ui: str) -> dict:
+        """Returns the entity dict (text, label and normalization fields) of a MeSH descriptor,
+        {} if it is unknown or its semantic types have no NER label."""
+        values = self.descriptors.get(ui) if ui else None
+        if not values:
+            return {}
+        cui, label, name = values[0].decode("utf-8").split("\t")
+        return {
+            "text": name.lower(),
+            "label": label,
+            "cui": cui,
+            "normalized_name": name,
+            "normalization_source": "MSH",
+            "url": UMLS_CONCEPT_URL.format(release=self.release, cui=cui),
+        }
+
+
+
+    def label_of(self, cui: str) -> str:
+        """NER label of a concept, None if its semantic types have none."""
+        values = self.labels.get(cui) if cui else None
+        return values[0].decode("utf-8") if values else None
+
+
+
+    @staticmethod
+    def build_index(meta_dir: str, index_dir: str):
+        """Builds the MeSH and CUI labels tables from MRCONSO.RRF and MRSTY.RRF (found in meta_dir)."""
+        meta_dir, index_dir = Path(meta_dir), Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        tui_rank = {tui: rank for rank, tui in enumerate(UMLS_TUI_LABELS)}
+
+        logging.info("MeSH Mapper: reading MRSTY.RRF.")
+        best_type = {}  #cui -> (rank, tui) of its first semantic type in UMLS_TUI_LABELS
+        for row in read_rrf(meta_dir / "MRSTY.RRF", MRSTY_COLUMNS):
+            rank = tui_rank.get(row['TUI'])
+            if rank is not None and rank < best_type.get(row['CUI'], (len(tui_rank),))[0]:
+                best_type[row['CUI']] = (rank, row['TUI'])
+        cui_labels = {cui: UMLS_TUI_LABELS[tui] for cui, (_, tui) in best_type.items()}
+
+        logging.info("MeSH Mapper: reading the MeSH atoms of MRCONSO.RRF.")
+        tty_rank = {tty: rank for rank, tty in enumerate(MESH_PREFERRED_TERM_TYPES)}
+        descriptors = {}  #descriptor ui -> (rank, cui, name)
+        for row in read_rrf(meta_dir / "MRCONSO.RRF", MRCONSO_COLUMNS):
+            if row['SAB'] != 'MSH' or not row['SDUI'] or row['CUI'] not in cui_labels:
+                continue
+            rank = tty_rank.get(row['TTY'], len(tty_rank))
+            current = descriptors.get(row['SDUI'])
+            if current is None or rank < current[0]:
+                descriptors[row['SDUI']] = (rank, row['CUI'], row['STR'])
+
+        logging.info(f"MeSH Mapper: writing {len(descriptors)} descriptors and {len(cui_labels)} concept labels.")
+        mesh = marisa_trie.BytesTrie((ui, f"{cui}\t{cui_labels[cui]}\t{name}".encode("utf-8"))
+                                     for ui, (_, cui, name) in descriptors.items())
+        mesh.save(str(index_dir / "mesh.marisa"))
+        labels = marisa_trie.BytesTrie((cui, label.encode("utf-8")) for cui, label in cui_labels.items())
+        labels.save(str(index_dir / "cui_labels.marisa"))
+        logging.info(f"MeSH Mapper: tables saved to {index_dir}.")
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the MeSH descriptors and concept labels tables used by MeshMapper.")
+    parser.add_argument("meta_dir", help="directory containing MRCONSO.RRF and MRSTY.RRF")
+    parser.add_argument("index_dir", help="directory of the local UMLS index (see modules/umls_local.py)")
+    args = parser.parse_args()
+
+    MeshMapper.build_index(args.meta_dir, args.index_dir)
+    mapper = MeshMapper(args.index_dir)
+    print("this is an example, mapping of 'Neoplasms' (D009369): ", mapper.map_descriptor("D009369"))
@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from pathlib import Path
+from contextlib import contextmanager
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from multiprocessing.util import Finalize
+
+from config.nlp_config import METRICS_DIR, METRICS_SAVE_INTERVAL, METRICS_LATENCY_BUCKETS
+
+"""Live metrics of the annotation stage.
+Each process (the annotation workers, and the parent for the chunks of long articles it stitches) counts
+what it does in its WorkerMetrics (get_metrics() returns the one of the current process), and saves it to
+METRICS_DIR/metrics-<pid>.json every METRICS_SAVE_INTERVAL seconds and when it exits.
+collect() sums the files of all the processes; the parent serves the sum in the Prometheus text format
+(annotate --metrics-port) and writes it as a JSON snapshot at the end of the run.
+Counters are totals since the start of the run, histograms have fixed buckets (METRICS_LATENCY_BUCKETS, seconds)."""
+
+PROMETHEUS_PREFIX = "medgraph_annotate_"
+
+COUNTERS = {
+    "documents_total": "Articles annotated (a long article counts once, when its chunks are stitched).",
+    "chunks_total": "Chunks of long articles annotated.",
+    "entities_total": "Entities written to the output.",
+    "relations_total": "Relations written to the output.",
+    "normalization_cache_hits_total": "Entity strings found in the normalization cache.",
+    "normalization_cache_misses_total": "Entity strings missing from the normalization cache.",
+    "umls_requests_total": "Requests sent to the UMLS API.",
+    "umls_request_errors_total": "UMLS API requests that failed or did not answer 200.",
+}
+
+HISTOGRAMS = {
+    "umls_request_seconds": "Latency of the UMLS API requests.",
+    "umls_rate_limit_wait_seconds": "Time spent waiting for a slot of the shared UMLS rate limit.",
+    "buffer_flush_seconds": "Time spent writing a buffer of entities or relations to Parquet.",
+}
+
+
+
+
+class WorkerMetrics:
+    """Counters and histograms of one process.
+    Params:
+            metrics_dir: where the process saves its metrics.
+            save_interval: minimum number of seconds between two saves (besides the last one)."""
+    def __init__(self, metrics_dir: str = METRICS_DIR, save_interval: float = METRICS_SAVE_INTERVAL):
+        self.metrics_dir = Path(metrics_dir)
+        self.metrics_dir.mkdir(parents=True, exist_ok=True)
+        self.save_interval = save_interval
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.counters = defaultdict(int)
+        #name -> [count per bucket (the last one is +Inf), sum, count]
+        self.histograms = defaultdict(lambda: [[0] * (len(METRICS_LATENCY_BUCKETS) + 1), 0.0, 0])
+        self._last_save = 0.0
+        self._lock = threading.Lock() #the normalization service observes from its threads
+        #ProcessPool workers exit without garbage collecting their globals, multiprocessing finalizers still run.
+        #(a lower priority than the annotator, so the flushes of its close() are counted)
+        self._finalizer = Finalize(self, self.save, kwargs={"force": True}, exitpriority=5)
+
+
+
+    def inc(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            histogram = self.histograms[name]
+            bucket = next((i for i, bound in enumerate(METRICS_LATENCY_BUCKETS) if seconds <= bound),
+                          len(METRICS_LATENCY_BUCKETS))
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+
+
+    @contextmanager
+    def timer(self, name: str):
+        """Observe the duration of the with block in the histogram name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+
+
+    def save(self, force: bool = False):
+        """Write the metrics of this process (they are cumulative, so the file is simply replaced)."""
+        now = time.time()
+        if not force and now - self._last_save < self.save_interval:
+            return
+        self._last_save = now
+        with self._lock:
+            data = {"pid": self.pid, "started": self.started, "saved": now,
+                    "counters": dict(self.counters), "histograms": dict(self.histograms)}
+        path = self.metrics_dir / f"metrics-{self.pid}.json"
+        temp = path.with_suffix(".tmp")
+        try:
+            temp.write_text(json.dumps(data), encoding="utf-8")
+            os.replace(temp, path)
+        except OSError as e:
+            logging.error(f"Metrics: failed to save the metrics of process {self.pid}: {e}")
+
+
+
+_metrics = None
+def get_metrics() -> WorkerMetrics:
+    "Metrics of the current process (a forked worker starts its own instead of the copy of its parent's)."
+    global _metrics
+    if _metrics is None or _metrics.pid != os.getpid():
+        _metrics = WorkerMetrics()
+    return _metrics
+
+
+
+
+def reset_metrics_dir(metrics_dir: str = METRICS_DIR):
+    """Remove the metrics of previous runs, called by the parent before starting the workers."""
+    for path in Path(metrics_dir).glob("metrics-*.json"):
+        path.unlink()
+
+
+
+def collect(metrics_dir: str = METRICS_DIR) -> dict:
+    """Sum of the metrics saved by all the processes of the run, with the derived rates."""
+    counters = dict.fromkeys(COUNTERS, 0)
+    histograms = {name: [[0] * (len(METRICS_LATENCY_BUCKETS) + 1), 0.0, 0] for name in HISTOGRAMS}
+    started, workers = None, 0
+    for path in Path(metrics_dir).glob("metrics-*.json"):
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError): #replaced while reading, it will be there next time
+            continue
+        workers += 1
+        started = min(started or data["started"], data["started"])
+        for name, value in data["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+        for name, (buckets, total, count) in data["histograms"].items():
+            histogram = histograms.setdefault(name, [[0] * len(buckets), 0.0, 0])
+            histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+            histogram[1] += total
+            histogram[2] += count
+
+    elapsed = time.time() - started if started else 0.0
+    lookups = counters["normalization_cache_hits_total"] + counters["normalization_cache_misses_total"]
+    umls = histograms["umls_request_seconds"]
+    return {
+        "processes": workers,
+        "elapsed_s": round(elapsed, 3),
+        "counters": counters,
+        "histograms": {name: {"buckets": buckets, "sum": total, "count": count}
+                       for name, (buckets, total, count) in histograms.items()},
+        "rates": {
+            "documents_per_s": round(counters["documents_total"] / elapsed, 3) if elapsed else None,
+            "entities_per_s": round(counters["entities_total"] / elapsed, 3) if elapsed else None,
+            "relations_per_s": round(counters["relations_total"] / elapsed, 3) if elapsed else None,
+            "normalization_cache_hit_ratio": round(counters["normalization_cache_hits_total"] / lookups, 3) if lookups else None,
+            "umls_mean_latency_s": round(umls[1] / umls[2], 4) if umls[2] else None,
+            "umls_error_rate": (round(counters["umls_request_errors_total"] / counters["umls_requests_total"], 4)
+                                if counters["umls_requests_total"] else None),
+        },
+    }
+
+
+
+def to_prometheus(snapshot: dict) -> str:
+    """Prometheus text exposition format of a collect() snapshot."""
+    lines = []
+    for name, value in snapshot["counters"].items():
+        metric = PROMETHEUS_PREFIX + name
+        lines += [f"# HELP {metric} {COUNTERS.get(name, name)}", f"# TYPE {metric} counter", f"{metric} {value}"]
+
+    for name, histogram in snapshot["histograms"].items():
+        metric = PROMETHEUS_PREFIX + name
+        lines += [f"# HELP {metric} {HISTOGRAMS.get(name, name)}", f"# TYPE {metric} histogram"]
+        cumulative = 0
+        for bound, count in zip([*METRICS_LATENCY_BUCKETS, "+Inf"], histogram["buckets"]):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+        lines += [f"{metric}_sum {histogram['sum']}", f"{metric}_count {histogram['count']}"]
+
+    for name, value in [("processes", snapshot["processes"]), ("elapsed_seconds", snapshot["elapsed_s"]),
+                        *snapshot["rates"].items()]:
+        if value is not None:
+            metric = PROMETHEUS_PREFIX + name
+            lines += [f"# TYPE {metric} gauge", f"{metric} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+
+def write_snapshot(path: str, metrics_dir: str = METRICS_DIR) -> dict:
+    """Write the final metrics of the run as JSON, returns them."""
+    snapshot = collect(metrics_dir)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    Path(path).write_text(json.dumps(snapshot, indent=2), encoding="utf-8")
+    logging.info(f"Metrics: snapshot written to {path}.")
+    return snapshot
+
+
+
+
+class MetricsServer:
+    """Serves the metrics of the run (collect() on each scrape) on http://<host>:<port>/metrics, from a daemon thread.
+    Params:
+            port: local port, host: interface to bind (localhost only by default)."""
+    def __init__(self, port: int, host: str = "127.0.0.1", metrics_dir: str = METRICS_DIR):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") not in ("", "/metrics"):
+                    self.send_error(404)
+                    return
+                #the parent process counts the long articles it stitches, make them visible right away
+                get_metrics().save(force=True)
+                body = to_prometheus(collect(metrics_dir)).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args): #no access log on stderr, it would break the progress bar
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+
+
+    def start(self):
+        self.thread.start()
+        logging.info(f"Metrics: serving on http://{self.server.server_address[0]}:{self.server.server_address[1]}/metrics")
+        return self
+
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
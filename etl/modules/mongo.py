@@ -167,15 +167,13 @@ class MongoConnector:
                 #add body, it can be missing if we only fetched abstracts.
                 if 'body' in doc and isinstance(doc['body'], str):
                     texts.append(doc['body']) 
-                #add keywords and MeSH to texts.
-                if 'keywords' in doc:
-                    keywords = [elt for elt in doc['keywords'] if isinstance(elt, str)]
-                    texts.extend(keywords)
-
-                if 'medical_subject_headings' in doc: 
-                    mesh = [elt for elt in doc['medical_subject_headings'] if isinstance(elt, str)]
-                    texts.extend(mesh)
-                
+                #keywords and MeSH headings are not added to the text, they are curated terms
+                #that are normalized directly (see StreamingOptimizedNLP.process_article)
+                article['keywords'] = [elt for elt in doc.get('keywords', []) if isinstance(elt, str)]
+                headings = doc.get('medical_subject_headings', [])
+                #articles fetched before the descriptors ids were stored only have the names
+                uis = doc.get('mesh_uis') or [None] * len(headings)
+                article['mesh_headings'] = [(ui, name) for ui, name in zip(uis, headings) if isinstance(name, str)]
 
                 article['text'] = " ".join(texts)
                 pbar.update(1)
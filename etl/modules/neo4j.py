@@ -11,7 +11,9 @@ import logging
 import os 
 from pathlib import Path
 
-from config.neo4jdb_config import NEO4J_LABELS, NEO4J_REL_TYPES
+from modules.load_state import LoadState
+from config.neo4jdb_config import NEO4J_LABELS, NEO4J_REL_TYPES, NEO4J_ENTITY_LABEL
+from config.clean_config import CLEAN_EVIDENCE_SEPARATOR
 
 """to load data to neo4j, we have multiple options:
     1 - load every entity or relation independently from others. 
@@ -32,11 +34,14 @@ from config.neo4jdb_config import NEO4J_LABELS, NEO4J_REL_TYPES
 
 
 class Neo4jConnector:
-    def __init__(self, uri: str, auth: tuple, load_batch_size = 1000):
-    
+    def __init__(self, uri: str, auth: tuple, load_batch_size = 1000, load_state: LoadState = None, incremental: bool = False):
+        """load_state = if set, records the nodes and relations loaded (see modules/load_state.py)
+        incremental = if True, only the nodes and relations the load_state doesn't have (or with other properties) are sent."""
         
         self.driver = GraphDatabase.driver(uri, auth=auth)
         self.load_batch_size = load_batch_size
+        self.load_state = load_state
+        self.incremental = incremental and load_state is not None
 
     #dunder methods for context management
     def __enter__(self):
@@ -70,15 +75,24 @@ class Neo4jConnector:
         def _worker(label):
             
                 try: #only one transaction per session
+                    nodes_with_label = self._get_nodes_with_label(label,ents_clean_csv, only_related, rels_clean_csv)
+                    if self.incremental:
+                        total = len(nodes_with_label)
+                        nodes_with_label = self.load_state.new_nodes(label, nodes_with_label)
+                        logging.info(f"Neo4jConnector: {len(nodes_with_label)} new or changed {label} nodes out of {total}.")
+                        if not nodes_with_label:
+                            return
                     with self.driver.session() as session: 
                         with session.begin_transaction() as transaction: 
-                            nodes_with_label = self._get_nodes_with_label(label,ents_clean_csv, only_related, rels_clean_csv)
                             self._ents_batch_load(label, nodes_batch=nodes_with_label, transaction= transaction)
+                    if self.load_state is not None:
+                        self.load_state.mark_nodes(label, nodes_with_label)
                     logging.info(f"Neo4jConnector: loaded {label} nodes")
 
                 except Exception as e:
                     logging.warning(f"Neo4jConnector: failed to load {label} nodes: {e}")
 
+        self._create_id_constraint()
         with ThreadPoolExecutor(min(100, os.cpu_count() * 4)) as executor: 
             futures = [executor.submit(_worker, label) for label in labels_to_load]
             for future in tqdm(as_completed(futures), desc="loading nodes:", total = len(labels_to_load)): 
@@ -89,8 +103,18 @@ class Neo4jConnector:
         
 
 
+    def _create_id_constraint(self):
+        """Uniqueness constraint (and its index) on the id of the entity nodes, the ids are global (a CUI can only be
+        one node, whatever its label), and the MERGE of a node and the MATCH of the relations are lookups, not scans."""
+        with self.driver.session() as session:
+            session.run(f"CREATE CONSTRAINT {NEO4J_ENTITY_LABEL.lower()}_id IF NOT EXISTS "
+                        f"FOR (n:{NEO4J_ENTITY_LABEL}) REQUIRE n.id IS UNIQUE")
+
+
+
     def _ents_batch_load(self, label: str, nodes_batch: list[dict], transaction: Transaction):
         """loads nodes batch to Neo4j using UNWIND cypher operation, so all nodes in the batch should have the same label.
+        The nodes are merged on their id under the shared entity label, their other NER labels (from a previous clean) are removed.
         Parameters:
         label = "the label for the nodes to load. (exp 'GENE')
         nodes_batch = list containing nodes to load, each is a dict, they must have the same label.
@@ -98,14 +122,18 @@ class Neo4jConnector:
 
         """
         
+        other_labels = "".join(f":{other}" for other in NEO4J_LABELS if other != label)
         query = f"""
             UNWIND $nodes AS row
-            MERGE (n:{label} {{id: row.id}})
+            MERGE (n:{NEO4J_ENTITY_LABEL} {{id: row.id}})
+            REMOVE n{other_labels}
+            SET n:{label}
             SET n += {{
                 name: row.name,
                 cui: row.cui,
                 normalized_name: row.normalized_name,
-                normalization_source: row.normalization_source
+                normalization_source: row.normalization_source,
+                url: row.url
             }}
             """
         try: 
@@ -153,6 +181,8 @@ class Neo4jConnector:
             #those will just create redundancy in the graph if kept
             to_drop = [col for col in [":LABEL", "pmid", "pmcid", "fetching_date"] if col in entities.columns]
             entities.drop(columns=to_drop, inplace=True)
+            #missing values are not set (a NaN would be stored as a float), as with the bulk import
+            entities = entities.astype(object).where(entities.notna(), None)
             entities_dict = entities.to_dict("records")  #convert to list of dicts
             return entities_dict
         else:
@@ -167,6 +197,10 @@ class Neo4jConnector:
             f"{reltypes_to_load} contains invalid relation type(s), valid: {NEO4J_REL_TYPES}"
 
         all_relations = self._all_relations_list(rels_clean_csv)
+        if self.incremental:
+            total = len(all_relations)
+            all_relations = self.load_state.new_relations(all_relations)
+            logging.info(f"Neo4jConnector: {len(all_relations)} new or changed relations out of {total}.")
         connexe_batches = self._create_connected_batches(all_relations)
         
         with ThreadPoolExecutor(min(100, os.cpu_count() * 4)) as executor:
@@ -183,17 +217,27 @@ class Neo4jConnector:
     def _relations_batch_load(self, batch: list[dict], reltypes_to_load: list[str]):
         "loads relations contained in the 'batch' if their Type appears in 'reltypes_to_load'."
         for reltype in reltypes_to_load: 
-            self._load_relations_of_type(batch, reltype)
+            loaded = self._load_relations_of_type(batch, reltype)
+            if self.load_state is not None:
+                self.load_state.mark_relations(loaded)
 
 
 
 
     def _load_relations_of_type(self, relations_list: list[dict], reltype: str):
-        """Loads relations from 'relations_list' of type 'reltype' to neo4j"""
+        """Loads relations from 'relations_list' of type 'reltype' to neo4j, returns the loaded relations
+        (only those Neo4j merged: a relation whose start or end node is not in the graph creates nothing)."""
         relations = self._get_relations_of_type(reltype, relations_list)
+        if not relations:
+            return relations
         try:
             with self.driver.session() as session:
-                session.execute_write(self._uow_write_rels, reltype, relations)
+                merged = set(session.execute_write(self._uow_write_rels, reltype, relations))
+            loaded = [relation for relation in relations if (relation["start_id"], relation["end_id"]) in merged]
+            if len(loaded) < len(relations):
+                logging.warning(f"Neo4jConnector: {len(relations) - len(loaded)} {reltype} relations not loaded, "
+                                f"their start or end node is not in Neo4j.")
+            return loaded
         #errors related to deadlocks
         except TransientError as e: 
             logging.error(f"Neo4jConnector: {e}")
@@ -201,18 +245,23 @@ class Neo4jConnector:
         
     def _uow_write_rels(self, tx: Transaction, reltype: str, relations: list[dict]):
             """unity of work called by neo4j's 'execute_write' method,
-              the tx variable is automatically assigned by neo4j's method."""
+              the tx variable is automatically assigned by neo4j's method.
+              returns the (start id, end id) of the relations merged."""
             query = f"""
             UNWIND $relations AS row
-            MATCH (start {{id: row.start_id}})
-            MATCH (end {{id: row.end_id}})
+            MATCH (start:{NEO4J_ENTITY_LABEL} {{id: row.start_id}})
+            MATCH (end:{NEO4J_ENTITY_LABEL} {{id: row.end_id}})
             MERGE (start)-[r:{reltype}]->(end)
             SET r += {{
-                pmid: row.pmid,
-                pmcid: row.pmcid
+                evidence_count: row.evidence_count,
+                pmids: row.pmids,
+                pmcids: row.pmcids,
+                first_seen: row.first_seen,
+                last_seen: row.last_seen
             }}
+            RETURN row.start_id AS start_id, row.end_id AS end_id
             """
-            tx.run(query, {"relations": relations})
+            return [(record["start_id"], record["end_id"]) for record in tx.run(query, {"relations": relations})]
 
         
 
@@ -242,16 +291,19 @@ class Neo4jConnector:
     def _all_relations_list(self, rels_clean_csv: str) -> list[dict]:
         """returns a list of dict, each dict represents a relation from the relations CSV file."""
         try: 
-            nodes_df = pd.read_csv(Path(rels_clean_csv))
+            nodes_df = pd.read_csv(Path(rels_clean_csv), dtype={"pmids": str, "pmcids": str,
+                                                                "first_seen": str, "last_seen": str})
         except FileNotFoundError as e:
             logging.error(f"Neo4jConnector: {e}")
             raise
 
         if not nodes_df.empty: 
             nodes_df.rename(columns={":ID": "id", ":START_ID": "start_id",":END_ID": "end_id", ":TYPE" : "type"}, inplace=True, errors='ignore')
-            #those will just create redundancy in the graph if kept
-            to_drop = [col for col in ["pmid", "fetching_date"] if col in nodes_df.columns]
-            nodes_df.drop(columns=to_drop, inplace=True)
+            #the evidence of an edge are lists in Neo4j, missing values are not set
+            for column in ["pmids", "pmcids"]:
+                if column in nodes_df.columns:
+                    nodes_df[column] = nodes_df[column].str.split(CLEAN_EVIDENCE_SEPARATOR)
+            nodes_df = nodes_df.astype(object).where(nodes_df.notna(), None)
             relations_list = nodes_df.to_dict("records")  #convert to list of dicts
             return relations_list
         else: return []
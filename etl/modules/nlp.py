@@ -1,37 +1,159 @@
-import pandas as pd
 import spacy
 import logging
 import pickle
-import hashlib
 import warnings
 import os
-from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor,  as_completed
-from spacy.matcher import Matcher, DependencyMatcher
+from bisect import bisect_left, bisect_right
+from concurrent.futures import as_completed
+from multiprocessing.util import Finalize
+from spacy.attrs import LEMMA, LOWER
+from spacy.pipeline import Sentencizer
+from scispacy.abbreviation import AbbreviationDetector  # noqa: F401 registers the "abbreviation_detector" factory
+
+from modules.umls_api import UMLSNormalizer, UMLSNormalizationService
+from modules.umls_local import LocalUMLSNormalizer
+from modules.umls_ann import ApproximateConceptLinker
+from modules.mesh_mapper import MeshMapper
+from modules.relation_matcher import SentenceRelationMatcher, DependencyRelationMatcher
+from modules.pattern_profiler import PatternProfiler
+from modules.dedup import HashedKeySet, BloomFilter
+from modules.nlp_output import ParquetStreamWriter, ENTITIES_SCHEMA, RELATIONS_SCHEMA
+from modules.sentence_cache import SentenceMemoCache, fingerprint
+from modules.metrics import get_metrics
+from modules.bulk_normalization import cache_key, merge_normalization_cache
+from modules.doc_store import DocStore, load_shard
+from config.nlp_config import (MATCHER_PATTERNS, DEPENDENCY_MATCHER_PATTERNS, GENERIC_ENTITIES, NER_MODEL,
+                               DEDUP_BLOOM_PATH, MATCHER_MAX_GAP, NLP_RESOLVE_ABBREVIATIONS, NORMALIZATION_CACHE_PATH)
+
+
+
+def _shift(entities: list[dict], offset: int) -> list[dict]:
+    """Adds the offset of a chunk in its article to the start_char of its entities."""
+    for entity in entities:
+        if entity.get("start_char") is not None:
+            entity["start_char"] += offset
+    return entities
+
+
+
+
+class DocEntityIndex:
+    """Entity index of a Doc, built once per document, so resolving entities does not rescan doc.ents.
+    - ent_of_token: token index -> index of the entity covering it (-1 if none), O(1) lookups.
+    - starts / ends: sorted boundaries of the entities (doc.ents never overlap),
+      the entities fully inside a matched span are found by bisection.
+    - lemmas: the normalized (stripped, lowercased) lemma of each entity, computed once.
+    - sentence_features(): entity labels and LEMMA/LOWER ids of a sentence, used to gate the relation matchers."""
+    def __init__(self, doc):
+        self.doc = doc
+        self._words = None #(n_tokens, 2) array of the LEMMA and LOWER ids, built on first use
+        self._sentence_features = {}
+        self.ents = list(doc.ents)
+        self.ent_of_token = [-1] * len(doc)
+        self.starts = [ent.start for ent in self.ents]
+        self.ends = [ent.end for ent in self.ents]
+        self.lemmas = [ent.lemma_.strip().lower() for ent in self.ents]
+        for i, ent in enumerate(self.ents):
+            self.ent_of_token[ent.start:ent.end] = [i] * (ent.end - ent.start)
+
+    def entities_in(self, start: int, end: int) -> range:
+        """Indices of the entities fully contained in the token span [start, end)."""
+        return range(bisect_left(self.starts, start), bisect_right(self.ends, end))
+
+    def lemma_of_token(self, token_i: int) -> str:
+        """Lemma of the entity covering the token, or of the token itself."""
+        ent_i = self.ent_of_token[token_i]
+        if ent_i >= 0:
+            return self.lemmas[ent_i]
+        return self.doc[token_i].lemma_.strip().lower()
+
+    def sentence_features(self, sent) -> tuple[set, set, set]:
+        """(entity labels, LEMMA ids, LOWER ids) of the sentence, computed once and shared by both matchers."""
+        features = self._sentence_features.get(sent.start)
+        if features is None:
+            if self._words is None:
+                self._words = self.doc.to_array([LEMMA, LOWER])
+            words = self._words[sent.start:sent.end]
+            features = ({self.ents[i].label_ for i in self.entities_in(sent.start, sent.end)},
+                        set(words[:, 0].tolist()), set(words[:, 1].tolist()))
+            self._sentence_features[sent.start] = features
+        return features
+
 
-from modules.umls_api import UMLSNormalizer
-from config.nlp_config import MATCHER_PATTERNS, DEPENDENCY_MATCHER_PATTERNS, GENERIC_ENTITIES, NER_MODEL
 
 class StreamingOptimizedNLP:
-    def __init__(self, normalizer: UMLSNormalizer, 
+    def __init__(self, normalizer: UMLSNormalizer | LocalUMLSNormalizer, 
                  entities_output_path: str,
                  relations_output_path: str,
                  batch_size: int = 50, 
-                 buffer_size: int = 1000):
+                 buffer_size: int = 1000,
+                 local_linker: ApproximateConceptLinker = None,
+                 profile_patterns: bool = False,
+                 two_pass: bool = False,
+                 sentence_cache: bool = False,
+                 mesh_mapper: MeshMapper = None,
+                 defer_normalization: bool = False,
+                 store_docs: bool = False):
 
        #supressing a future warning coming from inside spacy load 
         warnings.filterwarnings("ignore", category=FutureWarning, module="spacy")
         logging.info("NLP: Loading NER Model...")
         print("loading ner model...")
-        self.nlp_pipe = spacy.load(NER_MODEL) 
+        self.two_pass = two_pass
+        if two_pass:
+            # first pass: tokenization, NER and a rule based sentence splitter, no parser.
+            # the parser only runs in _parse_sentence(), on the sentences the dependency patterns can match.
+            self.nlp_pipe = spacy.load(NER_MODEL, disable=["parser"])
+            self.nlp_pipe.add_pipe("sentencizer", first=True)
+            # components run by the second pass, in pipeline order (tok2vec, tagger, lemmatizer, parser...)
+            self._parse_pipes = [pipe for name, pipe in self.nlp_pipe.components if name not in ("ner", "sentencizer")]
+        else:
+            self.nlp_pipe = spacy.load(NER_MODEL) 
         self.nlp_pipe.add_pipe("merge_entities", after="ner")
+        # abbreviations are detected on the tokens, before the entities are merged.
+        # serializable: their texts are stored in doc._.abbreviations, the spans would not survive the merge.
+        self.resolve_abbreviations = NLP_RESOLVE_ABBREVIATIONS
+        if self.resolve_abbreviations:
+            self.nlp_pipe.add_pipe("abbreviation_detector", before="merge_entities", config={"make_serializable": True})
         
         # Initialize matchers with model vocab
-        self.matcher = Matcher(self.nlp_pipe.vocab)
-        self.dep_matcher = DependencyMatcher(self.nlp_pipe.vocab)
-        
-        # Initialize the normalizer
+        # token patterns are matched per sentence, with bounded wildcards
+        # when profiling, each pattern gets its own matcher and its time, matches and yield are recorded
+        self.profiler = PatternProfiler() if profile_patterns else None
+        self.matcher = SentenceRelationMatcher(self.nlp_pipe.vocab, MATCHER_PATTERNS, profiler=self.profiler)
+        self.dep_matcher = DependencyRelationMatcher(self.nlp_pipe.vocab, DEPENDENCY_MATCHER_PATTERNS, profiler=self.profiler,
+                                                     parse_sentence=self._parse_sentence if two_pass else None)
+
+        # optional memo cache of the annotations of single sentences, repeated sentences skip the whole pipeline.
+        # the key includes a fingerprint of everything their annotations depend on.
+        self.sentence_cache = None
+        if sentence_cache:
+            self._sentencizer = Sentencizer()
+            self.sentence_cache = SentenceMemoCache(fingerprint(
+                NER_MODEL, self.nlp_pipe.meta.get("version"), MATCHER_PATTERNS, DEPENDENCY_MATCHER_PATTERNS,
+                MATCHER_MAX_GAP, two_pass, profile_patterns))
+        
+        # Initialize the normalizer, API lookups go through the shared service
+        # (one rate limit budget and coalesced requests for all the workers)
+        # a local normalizer answers in microseconds, so it is called directly.
         self.normalizer = normalizer
+        self.normalization_service = (UMLSNormalizationService(normalizer)
+                                      if isinstance(normalizer, UMLSNormalizer) else None)
+        # optional local tier (exact + approximate matching) tried before the normalizer
+        self.local_linker = local_linker
+        # maps the MeSH headings of the articles to concepts, without NER nor normalization
+        self.mesh_mapper = mesh_mapper
+        # two phase mode: the entities missing from the cache are written with their 'norm_text',
+        # and normalized once for the whole corpus after the annotation (see modules/bulk_normalization.py)
+        self.defer_normalization = defer_normalization
+        # processed Docs of the articles, to apply changed patterns again with rematch_shard()
+        # (sentence per sentence annotation has no Doc of the whole article to store)
+        self.doc_store = None
+        if store_docs:
+            if sentence_cache:
+                logging.warning("NLP: Docs can't be stored with the sentence cache, --store-docs is ignored.")
+            else:
+                self.doc_store = DocStore()
         
         # Performance optimization settings
         self.batch_size = batch_size
@@ -46,102 +168,106 @@ class StreamingOptimizedNLP:
         # Streaming buffers
         self._entities_buffer = []
         self._relations_buffer = []
+        # while a chunk of a long article is annotated, its (entities, relations) are collected here
+        # instead of being deduplicated and buffered, the parent stitches the chunks (see annotate_chunk)
+        self._collector = None
         
-        # Track if CSV headers have been written
-        self._entities_header_written = False
-        self._relations_header_written = False
+        # Parquet writers with a fixed schema, each flush is a row group of the part file of this process
+        # (the output directories are emptied by the parent process, see reset_output_dir)
+        self._entities_writer = ParquetStreamWriter(entities_output_path, ENTITIES_SCHEMA)
+        self._relations_writer = ParquetStreamWriter(relations_output_path, RELATIONS_SCHEMA)
         
         # Caching and deduplication
+        # the dedup state keeps 64 bits hashes of the keys, under a memory budget (see modules/dedup.py)
         self._normalization_cache = {}
-        self._entity_cache = set()
-        self._relation_cache = set()
+        self._saved_cache_size = 0
+        # strings the offline normalizer doesn't know, remembered for this run only: they are not cached,
+        # so a later run with the UMLS API still looks them up
+        self._offline_misses = set()
+        dedup_bloom = BloomFilter(DEDUP_BLOOM_PATH) if DEDUP_BLOOM_PATH else None
+        self._entity_cache = HashedKeySet("entities", bloom=dedup_bloom)
+        self._relation_cache = HashedKeySet("relations", bloom=dedup_bloom)
 
         # Load old cache to make sure we build cache each time we run the ETL and not losing old one.
         self._load_cache()
-        
-        # Initialize streaming CSV files
-
-        self._initialize_streaming_files()
-        
-        # Add patterns to matchers
-        for label, patterns in MATCHER_PATTERNS.items():
-            self.matcher.add(label, patterns)
 
-        for label, patterns in DEPENDENCY_MATCHER_PATTERNS.items():
-            self.dep_matcher.add(label, patterns)
+        # ProcessPool workers exit without garbage collecting the annotator (so __del__ never runs),
+        # multiprocessing finalizers still run: flush the buffers and close the part files there.
+        self._finalizer = Finalize(self, self.close, exitpriority=20)
+        # set by prepare_fork() in the parent process that preloads the annotator for its workers
+        self._template_pid = None
 
 
 
     
-    def _initialize_streaming_files(self):
-        """Initialize CSV files for streaming output."""
-        # Ensure directory exists
-        Path(self.entities_output_path).parent.mkdir(parents=True, exist_ok=True)
-        # Create/truncate the file
-        with open(self.entities_output_path, 'w', newline='', encoding='utf-8'):
-            pass  # Just create/truncate the file to 0 (empty it)
-        
-        Path(self.relations_output_path).parent.mkdir(parents=True, exist_ok=True)
-        with open(self.relations_output_path, 'w', newline='', encoding='utf-8'):
-            pass
+    def prepare_fork(self):
+        """Called in the parent process on an annotator loaded once for all the workers, before forking them
+        (they share its model and matchers pages copy-on-write, see annotate_mongo_articles).
+        The parent never annotates with it, so it must not write anything when it exits or when it's garbage
+        collected: its copy of the normalization cache is older than the workers' one."""
+        self._template_pid = os.getpid()
+        self._finalizer.cancel()
+        return self
+
+
+
     
+    def after_fork(self):
+        """Called in each worker forked from a preloaded annotator: multiprocessing drops the finalizers of
+        the parent in its children, register the ones that flush and close the output of this process again."""
+        self._finalizer = Finalize(self, self.close, exitpriority=20)
+        self._entities_writer.after_fork()
+        self._relations_writer.after_fork()
+        if self.doc_store is not None:
+            self.doc_store.after_fork()
+        if self._entity_cache.bloom is not None:
+            self._entity_cache.bloom.after_fork()
+        # the cache of the parent is the one of the start of the run, the workers that exited saved theirs since
+        # (workers replaced by the recycling pool are forked later)
+        self._load_cache()
+        return self
 
 
 
-    def _stream_entities_to_csv(self, entities_batch: list[dict]):
-        """Stream a batch of entities directly to CSV."""
+    
+    def _stream_entities(self, entities_batch: list[dict]):
+        """Stream a batch of entities to the Parquet part file of this process."""
         if not entities_batch:
             return
         
         try:
-            # Convert to DataFrame for easy CSV writing
-            df = pd.DataFrame(entities_batch)
-            
-            # Write header only once
-            write_header = not self._entities_header_written
-            mode = 'w' if write_header else 'a'
-            
-            df.to_csv(self.entities_output_path, mode=mode, header=write_header, index=False)
-            
-            if write_header:
-                self._entities_header_written = True
-            
-            logging.debug(f"NLP: Streamed {len(entities_batch)} entities to CSV")
+            with get_metrics().timer("buffer_flush_seconds"):
+                self._entities_writer.write(entities_batch)
+            get_metrics().inc("entities_total", len(entities_batch))
+            logging.debug(f"NLP: Streamed {len(entities_batch)} entities to Parquet")
             
         except Exception as e:
-            logging.error(f"NLP: Failed to stream entities to CSV: {e}")
+            logging.error(f"NLP: Failed to stream entities to Parquet: {e}")
 
 
 
     
-    def _stream_relations_to_csv(self, relations_batch: list[dict]):
-        """Stream a batch of relations directly to CSV."""
+    def _stream_relations(self, relations_batch: list[dict]):
+        """Stream a batch of relations to the Parquet part file of this process."""
         if not relations_batch:
             return
         
         try:
-            df = pd.DataFrame(relations_batch)
-            
-            write_header = not self._relations_header_written
-            mode = 'w' if write_header else 'a'
-            
-            df.to_csv(self.relations_output_path, mode=mode, header=write_header, index=False)
-            
-            if write_header:
-                self._relations_header_written = True
-            
-            logging.debug(f"NLP: Streamed {len(relations_batch)} relations to CSV")
+            with get_metrics().timer("buffer_flush_seconds"):
+                self._relations_writer.write(relations_batch)
+            get_metrics().inc("relations_total", len(relations_batch))
+            logging.debug(f"NLP: Streamed {len(relations_batch)} relations to Parquet")
             
         except Exception as e:
-            logging.error(f"NLP: Failed to stream relations to CSV: {e}")
+            logging.error(f"NLP: Failed to stream relations to Parquet: {e}")
 
 
 
     
     def _flush_entities_buffer(self, force: bool = False):
-        """Flush entities buffer to CSV when it reaches buffer_size or when force=True."""
+        """Flush entities buffer to Parquet when it reaches buffer_size or when force=True."""
         if (len(self._entities_buffer) >= self.buffer_size or force) and self._entities_buffer:
-            self._stream_entities_to_csv(self._entities_buffer)
+            self._stream_entities(self._entities_buffer)
             
             self._entities_buffer.clear()
     
@@ -149,9 +275,9 @@ class StreamingOptimizedNLP:
 
 
     def _flush_relations_buffer(self, force: bool = False):
-        """Flush relations buffer to CSV when it reaches buffer_size or when force=True."""
+        """Flush relations buffer to Parquet when it reaches buffer_size or when force=True."""
         if (len(self._relations_buffer) >= self.buffer_size or force) and self._relations_buffer:
-            self._stream_relations_to_csv(self._relations_buffer)
+            self._stream_relations(self._relations_buffer)
             
             self._relations_buffer.clear()
 
@@ -160,13 +286,14 @@ class StreamingOptimizedNLP:
     
     def _generate_cache_key(self, text: str) -> str:
         """Generate a MD5 hash unique key for caching normalized entities."""
-        return hashlib.md5(text.lower().strip().encode()).hexdigest()
+        return cache_key(text)
     
     def _load_cache(self):
         """Load normalization cache from disk if it exists."""
         try:
-            with open('cache/normalization_cache.pkl', 'rb') as f:
+            with open(NORMALIZATION_CACHE_PATH, 'rb') as f:
                 self._normalization_cache = pickle.load(f)
+            self._saved_cache_size = len(self._normalization_cache)
             logging.info(f"NLP: Loaded {len(self._normalization_cache)} cached normalizations.")
         except FileNotFoundError:
             logging.info("NLP: no cache found, starting fresh.")
@@ -174,13 +301,10 @@ class StreamingOptimizedNLP:
             logging.warning("NLP: cache file corrupted, starting fresh.")
     
     def _save_cache(self):
-        """Atomic writing of normalization cache to disk."""
-        temp = 'cache/normalization_cache.pkl.tmp'
-        final = 'cache/normalization_cache.pkl'
+        """Atomic writing of normalization cache to disk, merged with the entries the other workers saved."""
         try:
-            with open(temp, 'wb') as f:
-                pickle.dump(self._normalization_cache, f)
-            os.replace(temp, final) #only set it to the final file if it's fully written. 
+            self._normalization_cache = merge_normalization_cache(self._normalization_cache)
+            self._saved_cache_size = len(self._normalization_cache)
 
             logging.info(f"NLP: Saved {len(self._normalization_cache)} normalizations to cache")
         except Exception as e:
@@ -192,10 +316,12 @@ class StreamingOptimizedNLP:
         skip_patterns = GENERIC_ENTITIES | {'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by'}
         return len(text) >= 1 and text not in skip_patterns
     
-    def _batch_normalize_entities(self, entity_texts: list[str]) -> dict[str, dict]:
-        """Normalize entities in batches to reduce API calls."""
+    def _batch_normalize_entities(self, entity_texts: list[str], cached_only: bool = False) -> dict[str, dict]:
+        """Normalize entities in batches to reduce API calls.
+        cached_only = only return the cached results, the missing strings are left out."""
         results = {}
         to_normalize = []
+        cache_hits = 0
         
         
         for text in entity_texts:
@@ -205,39 +331,62 @@ class StreamingOptimizedNLP:
                 cache_key = self._generate_cache_key(text)
                 if cache_key in self._normalization_cache:
                     results[text] = self._normalization_cache[cache_key]
+                    cache_hits += 1
+                elif cache_key in self._offline_misses:
+                    results[text] = {}
+                    cache_hits += 1
                 else: to_normalize.append(text)
             else: # meaningless entity
                 results[text] = {"cui": "", "normalized_name": "", "normalization_source": ""}
+        get_metrics().inc("normalization_cache_hits_total", cache_hits)
+        get_metrics().inc("normalization_cache_misses_total", len(to_normalize))
         
-        if not to_normalize:
+        if not to_normalize or cached_only:
             return results
-        
-        #now we use the API to normalize entities that aren't in cache
-        logging.info(f"NLP: Normalizing {len(to_normalize)} new entities via UMLS API")
 
-        for i in range(0, len(to_normalize), self.batch_size):
-            batch = to_normalize[i:i + self.batch_size]
-            with ThreadPoolExecutor(max_workers=16) as executor:
-                future_to_text : dict = {
-                    executor.submit(self.normalizer.normalize, text) #key (a Future obj)
-                    :
-                    text for text in batch # value (text)
-                }
-                
-                for future in as_completed(future_to_text): 
-                    text = future_to_text[future]
-                    try:
-                        normalization_result = future.result()
-                        cache_key = self._generate_cache_key(text)
-                        
-                        self._normalization_cache[cache_key] = normalization_result
-                        results[text] = normalization_result
-                        
-                    except Exception:
-                        results[text] = {"cui": "", "normalized_name": "", "normalization_source": ""}
-            
-        #save cache to disk after each new 100 normalizations 
-        if len(self._normalization_cache) % 100 == 0:
+        #local tier: one vectorized query for all the unresolved strings of the chunk
+        if self.local_linker is not None:
+            linked = self.local_linker.link_batch(to_normalize)
+            for text, normalization_result in linked.items():
+                self._normalization_cache[self._generate_cache_key(text)] = normalization_result
+                results[text] = normalization_result
+            to_normalize = [text for text in to_normalize if text not in linked]
+
+        if to_normalize and self.normalization_service is None:
+            for text in to_normalize:
+                normalization_result = self.normalizer.normalize(text)
+                cache_key = self._generate_cache_key(text)
+                #the misses of the offline index are not cached, the UMLS API of a later run may know them
+                if normalization_result:
+                    self._normalization_cache[cache_key] = normalization_result
+                else:
+                    self._offline_misses.add(cache_key)
+                results[text] = normalization_result
+
+        elif to_normalize:
+            #now we use the API to normalize entities that aren't in cache
+            logging.info(f"NLP: Normalizing {len(to_normalize)} new entities via UMLS API")
+
+            future_to_text : dict = {
+                self.normalization_service.submit(text) #key (a Future obj)
+                :
+                text for text in to_normalize # value (text)
+            }
+
+            for future in as_completed(future_to_text):
+                text = future_to_text[future]
+                try:
+                    normalization_result = future.result()
+                    cache_key = self._generate_cache_key(text)
+
+                    self._normalization_cache[cache_key] = normalization_result
+                    results[text] = normalization_result
+
+                except Exception:
+                    results[text] = {"cui": "", "normalized_name": "", "normalization_source": ""}
+
+        #save cache to disk after each new 100 normalizations, whatever the tier that resolved them
+        if len(self._normalization_cache) - self._saved_cache_size >= 100:
             self._save_cache()
         
         return results
@@ -245,49 +394,230 @@ class StreamingOptimizedNLP:
 
 
     
+    def process_article(self, text: str, article_metadata: dict,
+                        mesh_headings: list[tuple[str, str]] = None, keywords: list[str] = None, chunk: dict = None):
+        """Run the pipeline once over the article, and extract both its entities and relations
+        from the same Doc and the same entity index (or sentence per sentence with the sentence cache).
+        mesh_headings ((descriptor UI, name) pairs) and keywords are curated terms, they are not run through
+        the pipeline, see _add_curated_terms().
+        chunk is the position of the text in its article when it is a chunk (see annotate_chunk()), stored with its Doc."""
+        if mesh_headings or keywords:
+            self._add_curated_terms(mesh_headings or [], keywords or [], article_metadata)
+        if self.sentence_cache is not None:
+            self._process_by_sentence(text, article_metadata)
+        else:
+            doc = self.nlp_pipe(text)
+            index = DocEntityIndex(doc)
+            self._entities_from_doc(doc, index, article_metadata)
+            self._relations_from_doc(doc, index, article_metadata)
+            if self.doc_store is not None:
+                self.doc_store.add(doc, text, article_metadata, mesh_headings, keywords, chunk)
+        if self.profiler is not None:
+            self.profiler.save()
+        #a chunk is counted by annotate_chunk(), its article by the parent once stitched
+        if self._collector is None:
+            get_metrics().inc("documents_total")
+        get_metrics().save()
+        return self
+
+
+
+    
+    def rematch_shard(self, path: str) -> list[tuple[str, int, int, tuple[list[dict], list[dict]]]]:
+        """Extract the entities and relations of the stored Docs of a shard again (annotate --rematch):
+        only the matchers, the generic entities filter and the normalization (mostly cached) run, no NER nor parsing.
+        The Docs of the chunks of long articles are collected as in annotate_chunk(), and returned as
+        (article key, chunk index, number of chunks, (entities, relations)) for the parent to stitch them."""
+        chunks = []
+        for doc, stored in load_shard(path, self.nlp_pipe.vocab):
+            article_metadata = stored.get("article", {})
+            mesh_headings = [tuple(heading) for heading in stored.get("mesh_headings", [])]
+            keywords = stored.get("keywords", [])
+            chunk = stored.get("chunk")
+            if chunk is not None:
+                self._collector = ([], [])
+            try:
+                if mesh_headings or keywords:
+                    self._add_curated_terms(mesh_headings, keywords, article_metadata)
+                index = DocEntityIndex(doc)
+                self._entities_from_doc(doc, index, article_metadata)
+                self._relations_from_doc(doc, index, article_metadata)
+                collected = self._collector
+            finally:
+                self._collector = None
+            if chunk is None:
+                get_metrics().inc("documents_total")
+                continue
+            get_metrics().inc("chunks_total")
+            entities, relations = collected
+            chunks.append((chunk["key"], chunk["index"], chunk["count"], (_shift(entities, chunk["offset"]), relations)))
+        if self.profiler is not None:
+            self.profiler.save()
+        get_metrics().save()
+        return chunks
+
+
+
+    
+    def annotate_chunk(self, text: str, offset: int, article_metadata: dict,
+                       mesh_headings: list[tuple[str, str]] = None, keywords: list[str] = None,
+                       chunk: dict = None) -> tuple[list[dict], list[dict]]:
+        """Annotate a chunk of a long article (see modules/chunking.py) and return its (entities, relations)
+        instead of writing them. They are not deduplicated against the other articles here, the ChunkStitcher
+        deduplicates them per article once all the chunks are annotated.
+        offset is the position of the chunk in the article, added to the start_char of its entities.
+        chunk ({"key": key of the article, "index": index of the chunk, "count": number of chunks}) is stored with
+        the Doc of the chunk, with its offset, so --rematch stitches the chunks again."""
+        self._collector = ([], [])
+        try:
+            self.process_article(text, article_metadata, mesh_headings, keywords,
+                                 chunk={**chunk, "offset": offset} if chunk else None)
+            entities, relations = self._collector
+        finally:
+            self._collector = None
+        get_metrics().inc("chunks_total")
+        return _shift(entities, offset), relations
+
+
+
+    
+    def _process_by_sentence(self, text: str, article_metadata: dict):
+        """Annotate the article sentence per sentence, only the sentences missing from the memo cache
+        go through the pipeline (NER, parsing and matching), the others reuse their cached annotations."""
+        tokens = self.nlp_pipe.make_doc(text)
+        sentences = [sent.text for sent in self._sentencizer(tokens).sents if sent.text.strip()]
+        #abbreviations are defined once per article, they are detected on its tokens (no model needed)
+        abbreviations = {}
+        if self.resolve_abbreviations:
+            abbreviations = self._abbreviations(self.nlp_pipe.get_pipe("abbreviation_detector")(tokens))
+        keys = [self.sentence_cache.key(sentence) for sentence in sentences]
+        annotations = self.sentence_cache.get_many(keys)
+
+        missing = {key: sentence for key, sentence in zip(keys, sentences) if key not in annotations}
+        computed = {}
+        disabled = ["abbreviation_detector"] if self.resolve_abbreviations else []
+        for key, doc in zip(missing, self.nlp_pipe.pipe(missing.values(), disable=disabled)):
+            index = DocEntityIndex(doc)
+            computed[key] = {"e": [[lemma, ent.label_] for ent, lemma in zip(index.ents, index.lemmas)],
+                             "r": [list(relation) for relation in self._match_relations(doc, index)]}
+        self.sentence_cache.put_many(computed)
+        annotations.update(computed)
+
+        self._add_entities([tuple(entity) for key in keys for entity in annotations[key]["e"]], article_metadata,
+                           abbreviations=abbreviations)
+        self._add_relations([tuple(relation) for key in keys for relation in annotations[key]["r"]], article_metadata)
+
+
+
+    
+    def _parse_sentence(self, sent):
+        """Second pass of the two pass mode: returns the parsed Doc of a sentence of a first pass Doc.
+        The sentence text goes through the components the first pass skipped (and the ones the parser depends on),
+        then its entities are copied from the first pass and merged, like the single pass pipeline does.
+        Returns None if the tokens don't line up with the tokens of the sentence."""
+        sent_doc = self.nlp_pipe.make_doc(sent.text)
+        for pipe in self._parse_pipes:
+            sent_doc = pipe(sent_doc)
+        ents = (sent_doc.char_span(ent.start_char - sent.start_char, ent.end_char - sent.start_char, label=ent.label_)
+                for ent in sent.ents)
+        sent_doc.ents = [ent for ent in ents if ent is not None]
+        sent_doc = self.nlp_pipe.get_pipe("merge_entities")(sent_doc)
+        if len(sent_doc) != len(sent):
+            logging.debug(f"NLP: second pass tokens don't match the sentence, skipped: {sent.text[:50]}")
+            return None
+        return sent_doc
+
+
+
+    
     def extract_and_normalize_entities(self, text: str, article_metadata: dict):
         """Extract recognized entities from text with 
         optimized normalization and streaming."""
         doc = self.nlp_pipe(text)
-        
-        if not doc.ents:
+        return self._entities_from_doc(doc, DocEntityIndex(doc), article_metadata)
+
+
+
+    
+    def _entities_from_doc(self, doc, index: 'DocEntityIndex', article_metadata: dict):
+        """Normalize and buffer the entities of an already processed Doc."""
+        return self._add_entities([(lemma, ent.label_) for ent, lemma in zip(index.ents, index.lemmas)], article_metadata,
+                                  start_chars=[ent.start_char for ent in index.ents],
+                                  abbreviations=self._abbreviations(doc))
+
+
+
+    
+    def _abbreviations(self, doc) -> dict[str, str]:
+        """short form -> long form (lowercased) of the abbreviations defined in the Doc,
+        a short form is normalized through its long form (one cache entry and one lookup for both)."""
+        if not self.resolve_abbreviations:
+            return {}
+        if not doc.has_extension("abbreviations") or not doc._.abbreviations:
+            return {}
+        return {abbreviation["short_text"].strip().lower(): " ".join(abbreviation["long_text"].lower().split())
+                for abbreviation in doc._.abbreviations}
+
+
+
+    
+    def _add_entities(self, entities: list[tuple[str, str]], article_metadata: dict, start_chars: list[int] = None,
+                      abbreviations: dict[str, str] = None):
+        """Normalize, deduplicate and buffer (lemma, label) entities of an article.
+        start_chars (position of each entity in the text) are kept in a 'start_char' key, used to stitch chunks
+        and written to the output.
+        abbreviations (short form -> long form) of the article: a short form entity keeps its text,
+        but is normalized (and cached) under its long form."""
+        abbreviations = abbreviations or {}
+        if not entities:
             return self
         
         entity_texts_to_normalize = set()
         extracted_entities = []
         
-        for ent in doc.ents:
-            lemma = ent.lemma_.strip().lower()
+        for (lemma, label), start_char in zip(entities, start_chars or [None] * len(entities)):
             #we have nothing to do with generic entities (e.g. 'cancer', 'tumor'...)
             if lemma not in GENERIC_ENTITIES:
                 if __name__ == "__main__": 
-                    print(f"entity: {lemma} --- label: {ent.label_}\n ******* ")
+                    print(f"entity: {lemma} --- label: {label}\n ******* ")
                 
                 
                 entity_dict = {
                     "text": lemma,
-                    "label": ent.label_,
+                    "label": label,
                     **article_metadata
                 }
+                if start_char is not None:
+                    entity_dict["start_char"] = start_char
                 
                 extracted_entities.append(entity_dict)
-                entity_texts_to_normalize.add(lemma)
+                entity_texts_to_normalize.add(abbreviations.get(lemma, lemma))
         
-        # Batch normalize all unique entity texts
-        normalization_results = self._batch_normalize_entities(list(entity_texts_to_normalize))
+        # Batch normalize all unique entity texts (only from the cache when normalization is deferred)
+        normalization_results = self._batch_normalize_entities(list(entity_texts_to_normalize),
+                                                               cached_only=self.defer_normalization)
         
-        # Apply normalization results to entities
-        final_entities = []
+        # Apply normalization results to entities, they are keyed by the same lowercased lemma
         for entity_dict in extracted_entities:
-            original_text = None
-            for ent in doc.ents:
-                if ent.lemma_.strip().lower() == entity_dict["text"]:
-                    original_text = ent.lemma_.strip()
-                    break
-            
-            if original_text and original_text in normalization_results:
-                entity_dict.update(normalization_results[original_text])
-            
+            normalization_key = abbreviations.get(entity_dict["text"], entity_dict["text"])
+            normalization_result = normalization_results.get(normalization_key)
+            if normalization_result:
+                entity_dict.update(normalization_result)
+            elif self.defer_normalization and normalization_key not in normalization_results:
+                entity_dict["norm_text"] = normalization_key
+        
+        return self._buffer_entities(extracted_entities)
+
+
+
+    
+    def _buffer_entities(self, entity_dicts: list[dict]):
+        """Deduplicate and buffer entity dicts."""
+        if self._collector is not None:
+            self._collector[0].extend(entity_dicts)
+            return self
+        final_entities = []
+        for entity_dict in entity_dicts:
             entity_key = (
                 entity_dict["text"], 
                 entity_dict["label"], 
@@ -295,8 +625,7 @@ class StreamingOptimizedNLP:
                 entity_dict.get("pmcid", "")
             )
             
-            if entity_key not in self._entity_cache:
-                self._entity_cache.add(entity_key)
+            if self._entity_cache.add(entity_key):
                 final_entities.append(entity_dict)
         
         #add to buffer instead of directly to entities list
@@ -312,72 +641,91 @@ class StreamingOptimizedNLP:
 
 
     
+    def _add_curated_terms(self, mesh_headings: list[tuple[str, str]], keywords: list[str], article_metadata: dict):
+        """Entities of the MeSH headings and keywords of the article, without any NLP:
+        - MeSH descriptors are mapped to their concept and label by the MeshMapper,
+        - keywords (and the headings that can't be mapped by id) only use the normalization cache,
+          they are kept if their concept is already known and has a label.
+        Without the MeSH tables (no offline UMLS index), the terms are labeled by NER, each one on its own
+        (they are not part of the text, so no relation is matched across them), and normalized like the
+        entities of the text."""
+        if self.mesh_mapper is None:
+            terms = [term for term in [*keywords, *(name for _, name in mesh_headings)] if term.strip()]
+            entities = []
+            for doc in self.nlp_pipe.pipe(terms):
+                index = DocEntityIndex(doc)
+                entities.extend((lemma, ent.label_) for ent, lemma in zip(index.ents, index.lemmas))
+            return self._add_entities(entities, article_metadata)
+
+        entity_dicts = []
+        terms = list(keywords)
+        for ui, name in mesh_headings:
+            if not ui:
+                terms.append(name)
+                continue
+            entity = self.mesh_mapper.map_descriptor(ui)
+            if entity:
+                entity_dicts.append({**entity, **article_metadata})
+        
+        for term in terms:
+            text = term.strip().lower()
+            normalization = self._normalization_cache.get(self._generate_cache_key(text))
+            label = self.mesh_mapper.label_of(normalization.get("cui")) if normalization else None
+            if label:
+                entity_dicts.append({"text": text, "label": label, **normalization, **article_metadata})
+        
+        return self._buffer_entities(entity_dicts)
+
+
+
+    
     def extract_relations(self, text: str, article_metadata: dict):
         """Extract relations with optimized deduplication and streaming."""
         doc = self.nlp_pipe(text)
+        return self._relations_from_doc(doc, DocEntityIndex(doc), article_metadata)
+
+
+
+    
+    def _relations_from_doc(self, doc, index: 'DocEntityIndex', article_metadata: dict):
+        """Match, deduplicate and buffer the relations of an already processed Doc."""
+        return self._add_relations(self._match_relations(doc, index), article_metadata)
+
+
+
+    
+    def _match_relations(self, doc, index: 'DocEntityIndex') -> list[tuple[str, str, str, str]]:
+        """(ent1, relation label, ent2, pattern) of the matches of both matchers in the Doc."""
+        matches = self.matcher(doc, index)
+        dep_matches = self.dep_matcher(doc, index)
         
-        matches = self.matcher(doc)
-        dep_matches = self.dep_matcher(doc)
-        
-        new_relations = []
+        found = []
         
         # Matcher-based relations
-        for match_id, start, end in matches:
-            entities_in_span = [ent for ent in doc.ents if ent.start >= start and ent.end <= end]
+        for relation_label, start, end, pattern in matches:
+            entities_in_span = index.entities_in(start, end)
             
             if len(entities_in_span) == 2:
                 ent1, ent2 = entities_in_span
-                relation_label = self.nlp_pipe.vocab.strings[match_id]
-                
-                if __name__ == "__main__":
-                    print(f"{ent1.lemma_} -[{relation_label}]-> {ent2.lemma_}\n*******")
-                
-                rel_dict = {
-                    "ent1": ent1.lemma_.strip().lower(),
-                    "relation": relation_label,
-                    "ent2": ent2.lemma_.strip().lower(),
-                    **article_metadata
-                }
-                
-                relation_key = (
-                    rel_dict["ent1"],
-                    rel_dict["relation"],
-                    rel_dict["ent2"],
-                    rel_dict.get("pmid", ""),
-                    rel_dict.get("pmcid", "")
-                )
-                
-                if relation_key not in self._relation_cache:
-                    self._relation_cache.add(relation_key)
-                    new_relations.append(rel_dict)
+                found.append((index.lemmas[ent1], relation_label, index.lemmas[ent2], pattern))
         
         # Dependency-matcher-based relations
-        for match_id, token_ids in dep_matches:
-            relation_label = self.nlp_pipe.vocab.strings[match_id]
-            ent1 = doc[token_ids[0]]
-            ent2 = doc[token_ids[-1]]
-            
-            if __name__ == "__main__":
-                print(f"{ent1.lemma_} -[{relation_label}]-> {ent2.lemma_}\n*******")
-            
-            rel_dict = {
-                "ent1": ent1.lemma_.strip().lower(),
-                "relation": relation_label,
-                "ent2": ent2.lemma_.strip().lower(),
-                **article_metadata
-            }
-            
-            relation_key = (
-                rel_dict["ent1"],
-                rel_dict["relation"],
-                rel_dict["ent2"],
-                rel_dict.get("pmid", ""),
-                rel_dict.get("pmcid", "")
-            )
-            
-            if relation_key not in self._relation_cache:
-                self._relation_cache.add(relation_key)
-                new_relations.append(rel_dict)
+        for relation_label, token_ids, pattern in dep_matches:
+            found.append((index.lemma_of_token(token_ids[0]), relation_label, index.lemma_of_token(token_ids[-1]), pattern))
+        
+        return found
+
+
+
+    
+    def _add_relations(self, relations: list[tuple[str, str, str, str]], article_metadata: dict):
+        """Deduplicate and buffer (ent1, relation label, ent2, pattern) relations of an article."""
+        new_relations = []
+        for ent1, relation_label, ent2, pattern in relations:
+            self._add_relation(ent1, relation_label, ent2, article_metadata, new_relations, pattern)
+        if self._collector is not None:
+            self._collector[1].extend(new_relations)
+            return self
         
         # Add to buffer instead of directly to relations list
         self._relations_buffer.extend(new_relations)
@@ -388,6 +736,37 @@ class StreamingOptimizedNLP:
         logging.info(f"NLP: Added {len(new_relations)} new unique relations to buffer")
         
         return self
+
+
+
+    
+    def _add_relation(self, ent1: str, relation_label: str, ent2: str, article_metadata: dict, new_relations: list[dict],
+                      pattern: str = None):
+        """Append the relation to new_relations if it was not already extracted.
+        pattern is the key of the pattern that matched, kept in a 'pattern' column when profiling."""
+        if __name__ == "__main__":
+            print(f"{ent1} -[{relation_label}]-> {ent2}\n*******")
+        
+        rel_dict = {
+            "ent1": ent1,
+            "relation": relation_label,
+            "ent2": ent2,
+            **article_metadata
+        }
+        
+        relation_key = (
+            rel_dict["ent1"],
+            rel_dict["relation"],
+            rel_dict["ent2"],
+            rel_dict.get("pmid", ""),
+            rel_dict.get("pmcid", "")
+        )
+        
+        if self._collector is not None or self._relation_cache.add(relation_key):
+            if self.profiler is not None:
+                rel_dict["pattern"] = pattern
+                self.profiler.record_yield(pattern)
+            new_relations.append(rel_dict)
     
 
 
@@ -401,8 +780,7 @@ class StreamingOptimizedNLP:
             metadata = {k: v for k, v in article.items() if k != 'text'}
             
             if text:
-                self.extract_and_normalize_entities(text, metadata)
-                self.extract_relations(text, metadata)
+                self.process_article(text, metadata)
         
         # Force flush buffers after processing batch
         self.flush_all_buffers()
@@ -413,10 +791,13 @@ class StreamingOptimizedNLP:
 
 
     def flush_all_buffers(self):
-        """Force flush all buffers to CSV files."""
+        """Force flush all buffers to the Parquet part files."""
         self._flush_entities_buffer(force=True)
         self._flush_relations_buffer(force=True)
-        logging.info("NLP: Flushed all buffers to CSV files")
+        logging.info("NLP: Flushed all buffers to Parquet files")
+        logging.info(f"NLP: Dedup occupancy, entities: {self._entity_cache.occupancy()}, relations: {self._relation_cache.occupancy()}")
+        if self.sentence_cache is not None:
+            logging.info(f"NLP: Sentence cache {self.sentence_cache.stats()}")
     
 
 
@@ -425,11 +806,14 @@ class StreamingOptimizedNLP:
     def get_info(self) -> dict:
         """Get processing statistics."""
         return {
-            "total_entities": len(self.entities) + len(self._entities_buffer),
-            "total_relations": len(self.relations) + len(self._relations_buffer),
+            "total_entities": get_metrics().counters["entities_total"] + len(self._entities_buffer),
+            "total_relations": get_metrics().counters["relations_total"] + len(self._relations_buffer),
             "cached_normalizations": len(self._normalization_cache),
             "unique_entity_texts": len(self._entity_cache),
             "unique_relations": len(self._relation_cache),
+            "entities_dedup": self._entity_cache.occupancy(),
+            "relations_dedup": self._relation_cache.occupancy(),
+            "sentence_cache": self.sentence_cache.stats() if self.sentence_cache is not None else None,
             "entities_in_buffer": len(self._entities_buffer),
             "relations_in_buffer": len(self._relations_buffer),
         }
@@ -437,12 +821,29 @@ class StreamingOptimizedNLP:
 
 
 
+    def close(self):
+        """Save cache, flush buffers and close the part files (they are only readable once closed)."""
+        if getattr(self, "_template_pid", None) == os.getpid():
+            return
+        #the cache only grows, nothing to save if its size didn't change since the last save (e.g. closed twice)
+        if self._normalization_cache and len(self._normalization_cache) != getattr(self, "_saved_cache_size", None):
+            self._save_cache()
+        self.flush_all_buffers()
+        self._entities_writer.close()
+        self._relations_writer.close()
+        if self.profiler is not None:
+            self.profiler.save(force=True)
+        if self.doc_store is not None:
+            self.doc_store.flush()
+        if self._entity_cache.bloom is not None:
+            self._entity_cache.bloom.save()
+
+
+
+
     def __del__(self):
         """Save cache and flush buffers when object is destroyed."""
-        if hasattr(self, '_normalization_cache') and self._normalization_cache:
-            self._save_cache()
-        
-        if hasattr(self, '_entities_buffer') or hasattr(self, '_relations_buffer'):
-            self.flush_all_buffers()
+        if hasattr(self, '_relations_writer'):
+            self.close()
 
 
@@ -0,0 +1,179 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pandas as pd
+
+import os
+import uuid
+import shutil
+import logging
+
+from pathlib import Path
+from multiprocessing.util import Finalize
+
+from config.nlp_config import PARQUET_ROWS_PER_FILE
+
+"""Output of the annotation stage: one Parquet dataset (a directory of part files) for the entities,
+one for the relations, with an explicit schema, so every row has the same typed columns whatever keys
+its dict has, and the next stages read them by name (and only the columns they need).
+Each annotation worker writes its own part files (part-<pid>-<uuid>.parquet), one row group per flush,
+the directories are emptied by the parent process before the workers start."""
+
+#categorical columns are dictionary encoded
+_CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+ENTITIES_SCHEMA = pa.schema([
+    ("text", pa.string()),
+    ("label", _CATEGORY),
+    ("pmid", pa.string()),
+    ("pmcid", pa.string()),
+    ("fetching_date", pa.timestamp("ms")),
+    ("cui", pa.string()),
+    ("normalized_name", pa.string()),
+    ("normalization_source", _CATEGORY),
+    ("url", pa.string()),
+    #string the entity is normalized under, only set by annotate --defer-normalization (see modules/bulk_normalization.py)
+    ("norm_text", pa.string()),
+    #position of the entity in the text of its article (the whole text for the chunks), null for the curated terms
+    ("start_char", pa.int32()),
+])
+
+RELATIONS_SCHEMA = pa.schema([
+    ("ent1", pa.string()),
+    ("relation", _CATEGORY),
+    ("ent2", pa.string()),
+    ("pmid", pa.string()),
+    ("pmcid", pa.string()),
+    ("fetching_date", pa.timestamp("ms")),
+    #key of the pattern that produced the relation, only filled with annotate --profile-patterns
+    ("pattern", _CATEGORY),
+])
+
+
+
+
+def to_table(rows: list[dict], schema: pa.Schema) -> pa.Table:
+    """Builds a table of the schema from dicts, missing keys are nulls and extra keys are ignored."""
+    columns = []
+    for field in schema:
+        values = [row.get(field.name) for row in rows]
+        if pa.types.is_dictionary(field.type):
+            columns.append(pa.array(values, type=field.type.value_type).dictionary_encode())
+        else:
+            columns.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+
+
+class ParquetStreamWriter:
+    """Appends batches of rows to the part file of this process, each batch is a row group.
+    A part file is closed (its footer written) after rows_per_file rows, on close() and when the process exits.
+    Params:
+            output_dir: directory of the dataset.
+            schema: pyarrow schema of the rows."""
+    def __init__(self, output_dir: str, schema: pa.Schema, rows_per_file: int = PARQUET_ROWS_PER_FILE):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.schema = schema
+        self.rows_per_file = rows_per_file
+        self._writer = None
+        self._rows_in_file = 0
+        #ProcessPool workers exit without garbage collecting their globals, multiprocessing finalizers still run.
+        self._finalizer = Finalize(self, self.close, exitpriority=10)
+
+
+
+    def after_fork(self):
+        """Register the close at exit again in a worker forked from the process that created the writer
+        (multiprocessing drops the finalizers of the parent in its children)."""
+        self._finalizer = Finalize(self, self.close, exitpriority=10)
+
+
+
+    def write(self, rows: list[dict]):
+        if not rows:
+            return
+        if self._writer is None:
+            path = self.output_dir / f"part-{os.getpid()}-{uuid.uuid4().hex[:8]}.parquet"
+            self._writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+        self._writer.write_table(to_table(rows, self.schema))
+        self._rows_in_file += len(rows)
+        if self._rows_in_file >= self.rows_per_file:
+            self.close()
+
+
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._rows_in_file = 0
+
+
+
+
+def reset_output_dir(output_dir: str):
+    """Remove the output of previous runs, called once by the parent before starting the workers."""
+    shutil.rmtree(output_dir, ignore_errors=True)
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+
+
+def replace_part(df: pd.DataFrame, part: Path, schema: pa.Schema):
+    """Replaces a part file with the rows of a DataFrame (written next to it, then swapped), one part file at a time
+    so a dataset is rewritten without loading it whole."""
+    part = Path(part)
+    #not matched by the part-*.parquet pattern of the readers
+    temp = part.with_name(f".{part.name}.tmp")
+    pq.write_table(pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False), temp, compression="zstd")
+    os.replace(temp, part)
+
+
+
+def read_output(output_dir: str, columns: list[str] = None) -> pd.DataFrame:
+    """Reads the part files of a dataset (only the given columns) into one DataFrame.
+    Part files that can't be read (a worker killed before closing its file) are skipped with an error."""
+    return read_parts(readable_parts(output_dir), columns)
+
+
+
+def read_parts(parts: list[Path], columns: list[str] = None, filters: pc.Expression = None) -> pd.DataFrame:
+    """Reads the given part files (in this order) into one DataFrame, only the rows matching filters if set."""
+    tables = [pq.read_table(part, columns=columns, filters=filters) for part in parts]
+    return pa.concat_tables(tables).unify_dictionaries().to_pandas()
+
+
+
+def unseen_articles(pmids: set, pmcids: set) -> pc.Expression:
+    """Filter of the rows of the articles that are not in the given ids, an article is identified by its pmcid,
+    or by its pmid if it has none (see article_ids())."""
+    pmid, pmcid = pc.field("pmid"), pc.field("pmcid")
+    return ((pmcid.is_valid() & ~pmcid.isin(pa.array(list(pmcids), pa.string())))
+            | (~pmcid.is_valid() & ~pmid.isin(pa.array(list(pmids), pa.string()))))
+
+
+
+def article_ids(rows: pd.DataFrame) -> tuple[set, set]:
+    """(pmids, pmcids) identifying the articles of the rows, the pmid only for the articles without pmcid."""
+    with_pmcid = rows["pmcid"].notna()
+    return set(rows.loc[~with_pmcid, "pmid"].dropna()), set(rows.loc[with_pmcid, "pmcid"])
+
+
+
+def readable_parts(output_dir: str) -> list[Path]:
+    """Sorted part files of a dataset whose footer can be read, the others are skipped with an error."""
+    parts = sorted(Path(output_dir).glob("part-*.parquet"))
+    if not parts:
+        raise FileNotFoundError(f"no part files found in {output_dir}")
+
+    readable = []
+    for part in parts:
+        try:
+            pq.read_metadata(part)
+            readable.append(part)
+        except (pa.ArrowInvalid, OSError) as e:
+            logging.error(f"NLP Output: unreadable part file {part} skipped: {e}")
+    if not readable:
+        raise FileNotFoundError(f"no readable part files in {output_dir}")
+    return readable
@@ -0,0 +1,121 @@
+import pandas as pd
+
+import os
+import time
+import logging
+
+from pathlib import Path
+from collections import defaultdict
+
+from config.nlp_config import PROFILING_DIR, PROFILING_SAVE_INTERVAL
+
+"""Instrumentation of the relation extraction, to know which patterns dominate the runtime and which ones yield relations.
+Each annotation worker records, per pattern (key 'LABEL#index', prefixed with 'dep:' for dependency patterns):
+    - match_time_s: time spent running the pattern (in profiling mode each pattern has its own matcher),
+    - matches: number of matches,
+    - unique_relations: relations it added after deduplication.
+Workers save their stats to PROFILING_DIR/patterns-<pid>.csv, the cleaning stage saves the number of relations
+each pattern still has after cleaning to PROFILING_DIR/patterns-clean.csv, and write_pattern_report() combines
+them in PROFILING_DIR/relation_patterns_report.csv (sorted by time, so the costly patterns come first)."""
+
+STATS_COLUMNS = ["pattern", "match_time_s", "matches", "unique_relations"]
+
+
+def pattern_key(label: str, index: int, dependency: bool = False) -> str:
+    return f"{'dep:' if dependency else ''}{label}#{index}"
+
+
+
+
+class PatternProfiler:
+    """Per process counters of the relation patterns.
+    Params:
+            profiling_dir: where the process saves its stats.
+            save_interval: minimum number of seconds between two saves (besides the last one)."""
+    def __init__(self, profiling_dir: str = PROFILING_DIR, save_interval: float = PROFILING_SAVE_INTERVAL):
+        self.profiling_dir = Path(profiling_dir)
+        self.profiling_dir.mkdir(parents=True, exist_ok=True)
+        self.save_interval = save_interval
+        self.stats = defaultdict(lambda: [0.0, 0, 0]) #pattern -> [match_time_s, matches, unique_relations]
+        self._last_save = 0.0
+
+
+
+    def timed(self, key: str, match_function, *args, **kwargs):
+        """Call match_function(*args, **kwargs) and record its duration and its number of matches."""
+        start = time.perf_counter()
+        matches = match_function(*args, **kwargs)
+        stats = self.stats[key]
+        stats[0] += time.perf_counter() - start
+        stats[1] += len(matches)
+        return matches
+
+
+
+    def record_yield(self, key: str):
+        self.stats[key][2] += 1
+
+
+
+    def save(self, force: bool = False):
+        """Write the stats of this process (they are cumulative, so the file is simply replaced)."""
+        now = time.time()
+        if not force and now - self._last_save < self.save_interval:
+            return
+        self._last_save = now
+        path = self.profiling_dir / f"patterns-{os.getpid()}.csv"
+        df = pd.DataFrame([[key, *values] for key, values in self.stats.items()], columns=STATS_COLUMNS)
+        temp = path.with_suffix(".tmp")
+        df.to_csv(temp, index=False)
+        os.replace(temp, path)
+
+
+
+
+def reset_profiling_dir(profiling_dir: str = PROFILING_DIR):
+    """Remove the stats of previous runs."""
+    for path in Path(profiling_dir).glob("patterns-*.csv"):
+        path.unlink()
+
+
+
+def save_clean_stats(relations_before: pd.DataFrame, relations_after: pd.DataFrame, profiling_dir: str = PROFILING_DIR):
+    """Called by the cleaning stage with the raw and the cleaned relations, both having a 'pattern' column."""
+    save_clean_counts(relations_before.groupby("pattern", observed=True).size(),
+                      relations_after.groupby("pattern", observed=True).size(), profiling_dir)
+
+
+
+def save_clean_counts(before: pd.Series, after: pd.Series, profiling_dir: str = PROFILING_DIR):
+    """Same as save_clean_stats() from the number of relations per pattern (pattern -> count) before and after cleaning,
+    for the cleaning engines that count them without loading the relations."""
+    clean_stats = (pd.concat([before.rename("raw_relations"), after.rename("relations_after_clean")], axis=1)
+                     .fillna(0).astype(int).sort_index().reset_index(names="pattern"))
+    Path(profiling_dir).mkdir(parents=True, exist_ok=True)
+    clean_stats.to_csv(Path(profiling_dir) / "patterns-clean.csv", index=False)
+
+
+
+def write_pattern_report(profiling_dir: str = PROFILING_DIR) -> str:
+    """Combine the stats of all the workers (and of the cleaning stage if it ran) into one sortable report."""
+    profiling_dir = Path(profiling_dir)
+    worker_files = [path for path in profiling_dir.glob("patterns-*.csv") if path.name != "patterns-clean.csv"]
+    if not worker_files:
+        logging.warning(f"Pattern Profiler: no stats found in {profiling_dir}.")
+        return None
+
+    report = (pd.concat([pd.read_csv(path) for path in worker_files])
+                .groupby("pattern", as_index=False).sum())
+    report["match_time_per_1k_matches_s"] = (1000 * report["match_time_s"] / report["matches"]).where(report["matches"] > 0)
+
+    clean_path = profiling_dir / "patterns-clean.csv"
+    if clean_path.exists():
+        report = report.merge(pd.read_csv(clean_path), on="pattern", how="left")
+        report[["raw_relations", "relations_after_clean"]] = report[["raw_relations", "relations_after_clean"]].fillna(0)
+        report["dropped_in_clean_share"] = (1 - report["relations_after_clean"] / report["raw_relations"]).where(report["raw_relations"] > 0)
+
+    report.sort_values("match_time_s", ascending=False, inplace=True)
+    report_path = profiling_dir / "relation_patterns_report.csv"
+    report.to_csv(report_path, index=False)
+    logging.info(f"Pattern Profiler: report written to {report_path}.")
+    return str(report_path)
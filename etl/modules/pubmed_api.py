@@ -195,11 +195,17 @@ to batch PubMed search results automatically so that an arbitrary number can be
                         article_pmcid = article_id
                         if article_pmcid is not None: break
                 
+                #MeSH descriptors (name and unique id) and author keywords, they are annotated apart from the text
+                mesh_descriptors = article.findall('.//MeshHeading/DescriptorName')
+
                 parsed_data = {
                     'pmid': article_pmid.text if article_pmid is not None else None, 
                     'pmcid': article_pmcid.text.replace("PMC", "") if article_pmcid is not None else None,
                     'title': article_title.text if article_title is not None else None,
                     'abstract': article_abstract.text if article_abstract is not None else None,
+                    'medical_subject_headings': [mesh.text for mesh in mesh_descriptors],
+                    'mesh_uis': [mesh.get('UI') for mesh in mesh_descriptors],
+                    'keywords': [keyword.text for keyword in article.findall('.//Keyword') if keyword.text],
                 }
 
                 articles.append(parsed_data)
@@ -99,12 +99,16 @@ class NewPMCAPI(NewPubMedAPI):
                         body_parts.append(text)
             body_text = "\n\n".join(body_parts) if body_parts else None
 
+            # Extract author keywords (PMC articles have no MeSH headings)
+            keywords = [self._get_all_text(kwd) for kwd in article.findall('.//kwd-group/kwd')]
+
             parsed_data = {
                 'pmid': pmid,
                 'pmcid': pmcid,
                 'title': title,
                 'abstract': abstract,
                 'body': body_text,  # Full text
+                'keywords': [keyword for keyword in keywords if keyword],
             }
 
             articles.append(parsed_data)
@@ -0,0 +1,225 @@
+import logging
+
+from spacy.matcher import Matcher, DependencyMatcher
+from spacy.vocab import Vocab
+
+from modules.pattern_profiler import PatternProfiler, pattern_key
+from config.nlp_config import MATCHER_PATTERNS, DEPENDENCY_MATCHER_PATTERNS, MATCHER_MAX_GAP
+
+"""Almost every token pattern has the form ENT, {"OP": "*"}, trigger, {"OP": "*"}, ENT.
+Run over a whole document, the unbounded wildcards make the matching cost explode on long PMC bodies,
+and the matches span unrelated sentences. So the SentenceRelationMatcher:
+    - runs the matchers sentence per sentence,
+    - compiles the unbounded wildcards into bounded gaps ({"OP": "{0,MATCHER_MAX_GAP}"}),
+    - skips the sentences with less than two entities, and the pattern groups whose
+      entity types are absent from the sentence.
+Most sentences contain none of the trigger words the patterns need ("produce", "bind", "regulate"...).
+The trigger words are derived from the LEMMA/LOWER constraints of the patterns, and both matchers
+(token and dependency) only run the groups whose triggers appear in the sentence (set lookups on the token ids).
+When a PatternProfiler is given, both matchers use one matcher per pattern,
+so the time and the matches of each pattern can be measured."""
+
+#token attributes used as trigger words, in the order of DocEntityIndex.sentence_features()
+TRIGGER_ATTRS = ("LEMMA", "LOWER")
+
+
+def compile_pattern(pattern: list[dict], max_gap: int = MATCHER_MAX_GAP) -> list[dict]:
+    """Returns a copy of the pattern where each {"OP": "*"} wildcard becomes a gap of at most max_gap tokens."""
+    return [{"OP": f"{{0,{max_gap}}}"} if token == {"OP": "*"} else token for token in pattern]
+
+
+def literal_values(value):
+    """Set of the strings accepted by a token attribute: a string, or {"IN": [...]}.
+    None for the other predicates (REGEX, NOT_IN...), that can't be looked up in a set."""
+    if isinstance(value, str):
+        return {value}
+    if isinstance(value, dict) and set(value) == {"IN"}:
+        return set(value["IN"])
+    return None
+
+
+def pattern_requirements(pattern: list[dict], dependency: bool = False) -> tuple[list[set], list[tuple[str, set]]]:
+    """What a pattern needs to find in a sentence to fire:
+        - entity types: one set of accepted labels per token constrained on ENT_TYPE,
+        - trigger words: one (attribute, accepted words) per token constrained on LEMMA or LOWER.
+    Optional tokens (wildcards, '?', '!') are not required, so they are ignored."""
+    types, triggers = [], []
+    for token in pattern:
+        attrs = token.get("RIGHT_ATTRS", {}) if dependency else token
+        if attrs.get("OP", "1") not in ("1", "+"):
+            continue
+        ent_types = literal_values(attrs.get("ENT_TYPE"))
+        if ent_types:
+            types.append(ent_types)
+        for attr in TRIGGER_ATTRS:
+            words = literal_values(attrs.get(attr))
+            if words:
+                triggers.append((attr, words))
+    return types, triggers
+
+
+def group_patterns(patterns: dict, per_pattern: bool, dependency: bool = False):
+    """Yields (group key, label, [(index, pattern), ...]), one group per label, or one per pattern."""
+    for label, label_patterns in patterns.items():
+        if per_pattern:
+            for i, pattern in enumerate(label_patterns):
+                yield pattern_key(label, i, dependency), label, [(i, pattern)]
+        else:
+            yield label, label, list(enumerate(label_patterns))
+
+
+
+
+class PatternGroup:
+    """Patterns sharing one spaCy Matcher (or DependencyMatcher), with what each of them needs to fire.
+    Params:
+            key: the key of the group, its label, or 'LABEL#index' when profiling.
+            name: the label of the relation (the match key of the patterns).
+            patterns: list of (index of the pattern in the patterns of its label, pattern).
+            max_gap: maximum number of tokens matched by a wildcard (token patterns only)."""
+    def __init__(self, vocab: Vocab, key: str, name: str, patterns: list[tuple[int, list[dict]]],
+                 dependency: bool = False, max_gap: int = MATCHER_MAX_GAP):
+        self.key = key
+        self.name = name
+        self.indices = [i for i, _ in patterns]
+        if dependency:
+            self.matcher = DependencyMatcher(vocab)
+            self.matcher.add(name, [pattern for _, pattern in patterns])
+        else:
+            self.matcher = Matcher(vocab)
+            self.matcher.add(name, [compile_pattern(pattern, max_gap) for _, pattern in patterns])
+        #per pattern: (entity types sets, [(position of the attribute in the sentence features, trigger ids)])
+        self.requirements = []
+        for _, pattern in patterns:
+            types, triggers = pattern_requirements(pattern, dependency)
+            self.requirements.append((types, [(TRIGGER_ATTRS.index(attr) + 1, frozenset(vocab.strings.add(w) for w in words))
+                                              for attr, words in triggers]))
+
+    def can_fire(self, features: tuple[set, set, set]) -> bool:
+        """True if at least one pattern finds its entity types and its trigger words in the sentence.
+        features is (entity labels, LEMMA ids, LOWER ids) of the sentence, see DocEntityIndex.sentence_features()."""
+        sentence_types = features[0]
+        return any(all(t & sentence_types for t in types) and all(ids & features[pos] for pos, ids in triggers)
+                   for types, triggers in self.requirements)
+
+
+
+
+class TriggerGate:
+    """Union of the trigger words of all the patterns: a sentence that contains none of them is skipped
+    before looking at the groups. Disabled (always open) if one of the patterns has no trigger word."""
+    def __init__(self, groups: list[PatternGroup]):
+        self.words = [set(), set()] #LEMMA ids, LOWER ids
+        self.enabled = True
+        for group in groups:
+            for _, triggers in group.requirements:
+                if not triggers:
+                    self.enabled = False
+                    continue
+                #a pattern needs all its trigger tokens, so its smallest set of words is enough to keep the sentence
+                pos, ids = min(triggers, key=lambda trigger: len(trigger[1]))
+                self.words[pos - 1] |= ids
+
+    def is_open(self, features: tuple[set, set, set]) -> bool:
+        return not self.enabled or bool(self.words[0] & features[1] or self.words[1] & features[2])
+
+
+
+def gated_groups(groups: list[PatternGroup], gate: TriggerGate, index, sent) -> list[PatternGroup]:
+    """The groups that can fire in the sentence."""
+    features = index.sentence_features(sent)
+    if not gate.is_open(features):
+        return []
+    return [group for group in groups if group.can_fire(features)]
+
+
+
+
+class SentenceRelationMatcher:
+    """Sentence scoped token matcher for relation extraction.
+    Params:
+            vocab: the vocab of the nlp pipeline.
+            patterns: {relation label: list of token patterns}
+            max_gap: maximum number of tokens matched by a wildcard.
+            profiler: if given, each pattern gets its own matcher and is timed."""
+    def __init__(self, vocab: Vocab, patterns: dict = MATCHER_PATTERNS, max_gap: int = MATCHER_MAX_GAP,
+                 profiler: PatternProfiler = None):
+        self.max_gap = max_gap
+        self.profiler = profiler
+        self.groups = [PatternGroup(vocab, key, label, group, max_gap=max_gap)
+                       for key, label, group in group_patterns(patterns, per_pattern=profiler is not None)]
+        self.gate = TriggerGate(self.groups)
+        logging.info(f"Relation Matcher: {sum(len(g.indices) for g in self.groups)} patterns in {len(self.groups)} groups, "
+                     f"max gap {max_gap}, trigger gate {'on' if self.gate.enabled else 'off'}.")
+
+
+
+    def __call__(self, doc, index) -> list[tuple[str, int, int, str]]:
+        """Returns (relation label, start, end, group key) of the matches, with token offsets relative to the doc.
+        index is the DocEntityIndex of the doc (used to get the entities of each sentence without rescanning doc.ents)."""
+        matches = []
+        for sent in doc.sents:
+            #a relation needs two entities
+            if len(index.entities_in(sent.start, sent.end)) < 2:
+                continue
+
+            for group in gated_groups(self.groups, self.gate, index, sent):
+                #as_spans gives offsets relative to the doc (plain tuples would be relative to the sentence)
+                if self.profiler is None:
+                    spans = group.matcher(sent, as_spans=True)
+                else:
+                    spans = self.profiler.timed(group.key, group.matcher, sent, as_spans=True)
+                for span in spans:
+                    matches.append((group.name, span.start, span.end, group.key))
+        return matches
+
+
+
+
+class DependencyRelationMatcher:
+    """Sentence scoped DependencyMatcher of the relation patterns: one matcher per label,
+    or one per pattern when profiling, run only on the sentences with two entities of the types
+    the patterns use, and where the trigger gate lets them fire.
+    Params:
+            vocab: the vocab of the nlp pipeline.
+            patterns: {relation label: list of dependency patterns}
+            profiler: if given, each pattern gets its own matcher and is timed.
+            parse_sentence: function returning the parsed Doc of a sentence, or None to skip it (two pass mode),
+                            by default the sentence is already parsed and is copied with Span.as_doc()."""
+    def __init__(self, vocab: Vocab, patterns: dict = DEPENDENCY_MATCHER_PATTERNS, profiler: PatternProfiler = None,
+                 parse_sentence=None):
+        self.vocab = vocab
+        self.profiler = profiler
+        self.parse_sentence = parse_sentence
+        self.groups = [PatternGroup(vocab, key, label, group, dependency=True)
+                       for key, label, group in group_patterns(patterns, per_pattern=profiler is not None, dependency=True)]
+        self.gate = TriggerGate(self.groups)
+        #entity types used by at least one pattern
+        self.entity_types = {label for group in self.groups for types, _ in group.requirements
+                             for ent_types in types for label in ent_types}
+
+
+
+    def __call__(self, doc, index) -> list[tuple[str, list[int], str]]:
+        """Returns (relation label, matched token ids, group key) of the matches, token ids are relative to the doc.
+        A dependency tree never crosses a sentence, so matching sentence per sentence loses nothing."""
+        matches = []
+        for sent in doc.sents:
+            relevant_entities = [i for i in index.entities_in(sent.start, sent.end) if index.ents[i].label_ in self.entity_types]
+            if len(relevant_entities) < 2:
+                continue
+            groups = gated_groups(self.groups, self.gate, index, sent)
+            if not groups:
+                continue
+            #the DependencyMatcher copies a Span to a new Doc anyway, do it once for all the groups
+            sent_doc = sent.as_doc() if self.parse_sentence is None else self.parse_sentence(sent)
+            if sent_doc is None:
+                continue
+            for group in groups:
+                if self.profiler is None:
+                    group_matches = group.matcher(sent_doc)
+                else:
+                    group_matches = self.profiler.timed(group.key, group.matcher, sent_doc)
+                for match_id, token_ids in group_matches:
+                    matches.append((group.name, [sent.start + i for i in token_ids], group.key))
+        return matches
@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+
+from pathlib import Path
+
+from config.nlp_config import SENTENCE_CACHE_PATH, SENTENCE_CACHE_MAX_MB
+
+"""Memo cache of the annotations of single sentences.
+Keywords, MeSH headings, disclaimers and copyright notices repeat across thousands of articles,
+so the annotator splits the text in sentences and only runs NER, parsing and matching on the sentences
+it has never seen. A sentence is keyed by the hash of its normalized text and of a fingerprint of the
+model and the patterns (changing one of them invalidates the whole cache), and its value is the raw
+annotations: [[entity lemma, label], ...] and [[ent1, relation, ent2, pattern], ...], without any article metadata.
+The cache is a SQLite database shared by all the workers (WAL mode), bounded in size with LRU eviction."""
+
+#share of the entries removed when the database exceeds its size
+_EVICTION_SHARE = 0.1
+#number of new entries after which the size of the database is checked
+_EVICTION_CHECK_EVERY = 1000
+
+
+def fingerprint(*parts) -> str:
+    """Hash of everything the annotations of a sentence depend on (model name and version, patterns, options)."""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def normalize_sentence(sentence: str) -> str:
+    return " ".join(sentence.split())
+
+
+
+
+class SentenceMemoCache:
+    """Persistent LRU cache of sentence annotations.
+    Params:
+            fingerprint: fingerprint of the model and the patterns, part of every key.
+            path: the SQLite database.
+            max_mb: size above which the least recently used sentences are evicted."""
+    def __init__(self, fingerprint: str, path: str = SENTENCE_CACHE_PATH, max_mb: int = SENTENCE_CACHE_MAX_MB):
+        self.fingerprint = fingerprint
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_mb * 1024 ** 2
+        self.hits = 0
+        self.misses = 0
+        self._inserted = 0
+        self._connection = None
+        self._pid = None
+
+
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        #sqlite connections must not cross a fork, each process opens its own
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS sentences (
+                                            key BLOB PRIMARY KEY,
+                                            annotations TEXT NOT NULL,
+                                            last_used REAL NOT NULL)""")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS sentences_last_used ON sentences(last_used)")
+            self._pid = os.getpid()
+        return self._connection
+
+
+
+    def key(self, sentence: str) -> bytes:
+        return hashlib.blake2b(f"{self.fingerprint}\x1f{normalize_sentence(sentence)}".encode("utf-8"),
+                               digest_size=16).digest()
+
+
+
+    def get_many(self, keys: list[bytes]) -> dict[bytes, dict]:
+        """Returns {key: annotations} of the cached keys, and marks them as recently used."""
+        unique_keys = list(dict.fromkeys(keys))
+        found = {}
+        #SQLite limits the number of parameters of a query
+        for i in range(0, len(unique_keys), 500):
+            chunk = unique_keys[i:i + 500]
+            rows = self.connection.execute(
+                f"SELECT key, annotations FROM sentences WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            found.update((key, json.loads(annotations)) for key, annotations in rows)
+
+        self.hits += sum(key in found for key in keys)
+        self.misses += sum(key not in found for key in keys)
+        if found:
+            now = time.time()
+            with self.connection:
+                self.connection.executemany("UPDATE sentences SET last_used = ? WHERE key = ?",
+                                            [(now, key) for key in found])
+        return found
+
+
+
+    def put_many(self, annotations: dict[bytes, dict]):
+        if not annotations:
+            return
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO sentences VALUES (?, ?, ?)",
+                                        [(key, json.dumps(value, separators=(",", ":")), now)
+                                         for key, value in annotations.items()])
+        self._inserted += len(annotations)
+        if self._inserted >= _EVICTION_CHECK_EVERY:
+            self._inserted = 0
+            self.evict()
+
+
+
+    def size_bytes(self) -> int:
+        """Bytes of the pages in use (deleted entries leave free pages that are reused)."""
+        page_size, = self.connection.execute("PRAGMA page_size").fetchone()
+        page_count, = self.connection.execute("PRAGMA page_count").fetchone()
+        free_pages, = self.connection.execute("PRAGMA freelist_count").fetchone()
+        return (page_count - free_pages) * page_size
+
+
+
+    def evict(self):
+        """Remove the least recently used sentences while the database is above its size."""
+        while self.size_bytes() > self.max_bytes:
+            count, = self.connection.execute("SELECT COUNT(*) FROM sentences").fetchone()
+            if not count:
+                return
+            with self.connection:
+                self.connection.execute("""DELETE FROM sentences WHERE key IN
+                                           (SELECT key FROM sentences ORDER BY last_used LIMIT ?)""",
+                                        (max(1, int(count * _EVICTION_SHARE)),))
+            logging.info(f"Sentence Cache: evicted the {_EVICTION_SHARE:.0%} least recently used sentences.")
+
+
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+        }
@@ -0,0 +1,130 @@
+import nmslib
+import joblib
+import marisa_trie
+
+import shutil
+import logging
+import argparse
+
+from pathlib import Path
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from modules.umls_local import LocalUMLSNormalizer, normalize_string
+from config.umls_config import (UMLS_ANN_MIN_SIMILARITY, UMLS_ANN_K, UMLS_ANN_INDEX_PARAMS,
+                                UMLS_ANN_QUERY_PARAMS, UMLS_ANN_QUERY_THREADS)
+
+"""Local candidate generator for entities that have no exact match in UMLS (spelling variants, plurals, hyphens...).
+Concept names of the local UMLS index are vectorized with char 3-grams TF-IDF, and an nmslib HNSW index
+serves the nearest neighbours queries (cosine similarity). The index files are:
+    - ann_names.marisa: the indexed names, the id of a name in this trie is its id in the HNSW index.
+    - ann_vectorizer.joblib: the fitted TfidfVectorizer.
+    - ann_hnsw.bin: the nmslib index.
+    - a copy of the concept tables of the local UMLS index (CONCEPT_TABLES), to map the matched names to concepts,
+      so the tier can run in front of the UMLS API without the whole offline normalization (UMLS_LOCAL_INDEX)."""
+
+#files of the local UMLS index the linker needs, copied in the index directory
+CONCEPT_TABLES = ["strings.marisa", "concepts.marisa", "meta.json"]
+
+
+
+
+class ApproximateConceptLinker:
+    """Local normalization tier, answers before any remote call.
+    link_batch() first tries exact lookups in the local UMLS index, then sends all the unresolved strings
+    in one vectorized nearest neighbours query.
+    Params:
+            local_normalizer: LocalUMLSNormalizer, its index is used to map matched names to concepts.
+            ann_dir: directory created by ApproximateConceptLinker.build_index()
+            min_similarity: minimum cosine similarity to accept a candidate."""
+    def __init__(self, local_normalizer: LocalUMLSNormalizer, ann_dir: str,
+                 min_similarity: float = UMLS_ANN_MIN_SIMILARITY, k: int = UMLS_ANN_K):
+        self.local_normalizer = local_normalizer
+        self.ann_dir = Path(ann_dir)
+        self.min_similarity = min_similarity
+        self.k = k
+        try:
+            self.names = marisa_trie.Trie().mmap(str(self.ann_dir / "ann_names.marisa"))
+            self.vectorizer : TfidfVectorizer = joblib.load(self.ann_dir / "ann_vectorizer.joblib")
+            self.index = self._new_index()
+            self.index.loadIndex(str(self.ann_dir / "ann_hnsw.bin"), load_data=True)
+            self.index.setQueryTimeParams(UMLS_ANN_QUERY_PARAMS)
+        except (FileNotFoundError, RuntimeError) as e:
+            logging.error(f"ANN Linker: unable to load the index from {self.ann_dir}: {e}")
+            raise
+        logging.info(f"ANN Linker: Initialized ({len(self.names)} names).")
+
+
+
+    def link_batch(self, texts: list[str]) -> dict[str, dict]:
+        """Returns {text: normalization dict} for the texts resolved locally, unresolved texts are absent."""
+        results = {}
+        unresolved = []
+        for text in texts:
+            exact = self.local_normalizer.normalize(text)
+            if exact:
+                results[text] = exact
+            else:
+                unresolved.append(text)
+
+        if not unresolved:
+            return results
+
+        vectors = self.vectorizer.transform([normalize_string(text) for text in unresolved])
+        neighbours = self.index.knnQueryBatch(vectors, k=self.k, num_threads=UMLS_ANN_QUERY_THREADS)
+        for text, (ids, distances) in zip(unresolved, neighbours):
+            #cosine distance, neighbours are sorted by increasing distance
+            if len(ids) and 1 - distances[0] >= self.min_similarity:
+                match = self.local_normalizer.normalize(self.names.restore_key(int(ids[0])))
+                if match:
+                    results[text] = match
+
+        logging.info(f"ANN Linker: {len(results)}/{len(texts)} entities resolved locally.")
+        return results
+
+
+
+    @staticmethod
+    def _new_index():
+        return nmslib.init(method="hnsw", space="cosinesimil_sparse", data_type=nmslib.DataType.SPARSE_VECTOR)
+
+
+
+    @staticmethod
+    def build_index(umls_index_dir: str, ann_dir: str, num_threads: int = 4):
+        """Builds the approximate matching index from the names of the local UMLS index (see modules/umls_local.py)."""
+        ann_dir = Path(ann_dir)
+        ann_dir.mkdir(parents=True, exist_ok=True)
+        local_normalizer = LocalUMLSNormalizer(umls_index_dir)
+        for table in CONCEPT_TABLES:
+            shutil.copyfile(Path(umls_index_dir) / table, ann_dir / table)
+
+        #the trie assigns the ids, vectors are added in the same order so HNSW ids == trie ids
+        names = marisa_trie.Trie(local_normalizer.strings.keys())
+        names.save(str(ann_dir / "ann_names.marisa"))
+        ordered_names = [names.restore_key(i) for i in range(len(names))]
+
+        logging.info(f"ANN Linker: vectorizing {len(ordered_names)} names.")
+        vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=(3, 3), min_df=2, dtype="float32")
+        vectors = vectorizer.fit_transform(ordered_names)
+        joblib.dump(vectorizer, ann_dir / "ann_vectorizer.joblib")
+
+        logging.info("ANN Linker: building the HNSW index.")
+        index = ApproximateConceptLinker._new_index()
+        index.addDataPointBatch(vectors)
+        index.createIndex({**UMLS_ANN_INDEX_PARAMS, "indexThreadQty": num_threads}, print_progress=True)
+        index.saveIndex(str(ann_dir / "ann_hnsw.bin"), save_data=True)
+        logging.info(f"ANN Linker: index saved to {ann_dir}.")
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the approximate matching index used by ApproximateConceptLinker.")
+    parser.add_argument("umls_index_dir", help="directory of the local UMLS index (built by modules/umls_local.py)")
+    parser.add_argument("ann_dir", help="directory where the approximate matching index is written")
+    parser.add_argument("--threads", type=int, default=4, help="threads used to build the HNSW index")
+    args = parser.parse_args()
+
+    ApproximateConceptLinker.build_index(args.umls_index_dir, args.ann_dir, num_threads=args.threads)
+    linker = ApproximateConceptLinker(LocalUMLSNormalizer(args.ann_dir), args.ann_dir)
+    print("this is an example, approximate normalization of 'humans': ", linker.link_batch(["humans"]))
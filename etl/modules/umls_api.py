@@ -1,44 +1,99 @@
 import requests as rq
 
+import os
+import json
+import fcntl
+import struct
+import hashlib
 import logging
-import time 
+import threading
+import time
 
-from config.apis_config import UMLS_API_SLEEP_TIME
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from modules.metrics import get_metrics
+from config.apis_config import (UMLS_API_SLEEP_TIME, UMLS_RATE_LIMIT_STATE, UMLS_INFLIGHT_DIR,
+                                UMLS_CLAIM_TIMEOUT, UMLS_SERVICE_WORKERS, UMLS_INFLIGHT_TTL)
 from config.settings import UMLS_API_KEY
 
 
 
 
+class SharedRateLimiter:
+    """Token bucket shared by every process of the machine.
+    The state of the bucket (the time at which the next request is allowed) is stored in a small file,
+    and an exclusive file lock serializes the processes reading and updating it,
+    so N annotation workers together never exceed the UMLS API rate limit (20req/s).
+    Params:
+            state_path: path of the file holding the bucket state.
+            interval: minimum number of seconds between two requests of the whole fleet."""
+    def __init__(self, state_path: str = UMLS_RATE_LIMIT_STATE, interval: float = UMLS_API_SLEEP_TIME):
+        self.state_path = Path(state_path)
+        self.interval = interval
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+
+
+
+    def acquire(self):
+        """Block until the caller owns the next request slot."""
+        fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            raw = os.pread(fd, 8, 0)
+            next_slot = struct.unpack("d", raw)[0] if len(raw) == 8 else 0.0
+            now = time.time()
+            #reserve our slot, then release the lock before sleeping so others can reserve theirs
+            slot = max(now, next_slot)
+            os.pwrite(fd, struct.pack("d", slot + self.interval), 0)
+        finally:
+            os.close(fd) #closing the descriptor releases the lock
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+
+
 class UMLSNormalizer:
-    def __init__(self):
+    def __init__(self, rate_limiter: SharedRateLimiter = None):
         self.key = UMLS_API_KEY
         self.base_url = "https://uts-ws.nlm.nih.gov/rest"
+        self.rate_limiter = rate_limiter or SharedRateLimiter()
         logging.info("Normalizer: Initialized.")
 
 
 
     def normalize(self, string: str):
+        """Returns the best concept of the string, {} if the UMLS has none.
+        Raises requests.HTTPError on an error response (429, 5xx...), so a failed lookup is not taken for a miss."""
         search_url = f"{self.base_url}/search/current"
         params = {
             "apiKey" : self.key,
         #I don't lower because that might affect the search, especially for drugs and mutations
-            "string" : string.strip() 
+            "string" : string.strip()
                   }
-        
-        
-        response = rq.get(search_url, params= params)
+
+        #wait for a slot of the global budget instead of sleeping 0.06s per process
+        metrics = get_metrics()
+        with metrics.timer("umls_rate_limit_wait_seconds"):
+            self.rate_limiter.acquire()
+        metrics.inc("umls_requests_total")
+        try:
+            with metrics.timer("umls_request_seconds"):
+                response = rq.get(search_url, params= params)
+        except rq.RequestException:
+            metrics.inc("umls_request_errors_total")
+            raise
         status_code = response.status_code
-        #waiting 0.06 between calls. 
-        logging.info(f"Normalizer: UMLS API: Sleeping For {UMLS_API_SLEEP_TIME}s.")
-        time.sleep(UMLS_API_SLEEP_TIME)
 
-        if status_code == 200: 
+        if status_code == 200:
             logging.info("Normalizer: UMLS API: Response OK.")
             json_output = response.json()
             results = json_output['result']['results']
             #return None if results = [] or no CUI for the term (CUI is a universal id)
             if not results or results[0][ "ui"] == "NONE":
-                
+
                 return {}
             else:
                 best_match : dict = results[0]
@@ -48,17 +103,193 @@ class UMLSNormalizer:
                 best_match['normalization_source'] = best_match.pop('rootSource')
                 best_match['url'] = best_match.pop('uri')
                 return best_match
-        else: 
+        else:
+            metrics.inc("umls_request_errors_total")
             logging.error(f"Normalizer: UMLS API: Response Not OK: {status_code}.")
-            return {}
+            raise rq.HTTPError(f"UMLS API: Response Not OK: {status_code}.", response=response)
+
+
+
+
+def reset_inflight_dir(inflight_dir: str = UMLS_INFLIGHT_DIR):
+    """Removes the results and claims of the previous runs, called once by the parent before the workers start."""
+    directory = Path(inflight_dir)
+    if directory.exists():
+        for path in directory.iterdir():
+            path.unlink(missing_ok=True)
+
+
+
+
+class UMLSNormalizationService:
+    """Asynchronous normalization front shared by all the annotation workers.
+    - submit() returns a Future, requests are executed by one long-lived thread pool per process
+      (instead of a new ThreadPoolExecutor per batch).
+    - identical lookups are coalesced: inside a process through the table of pending futures,
+      and across processes through claim files, the first worker that claims a string (exclusive lock on its claim
+      file) calls the API and publishes the result, a concept or a miss (an error raises and is not shared),
+      the others wait for it and claim the string in turn if nothing was published. The lock of a crashed worker
+      is released by the system, so its claim is taken over atomically.
+    - the wrapped normalizer takes its slots from the SharedRateLimiter, so the whole fleet respects the API rate limit.
+    Params:
+            normalizer: the UMLSNormalizer (or any object with a normalize(string) method) to call.
+            inflight_dir: directory of the claims and published results.
+            max_workers: threads per process waiting on the API.
+            claim_timeout: seconds after which a worker stops waiting on a claim (hung request) and calls the API itself.
+            result_ttl: seconds after which a published result is requested again."""
+    def __init__(self, normalizer: UMLSNormalizer,
+                 inflight_dir: str = UMLS_INFLIGHT_DIR,
+                 max_workers: int = UMLS_SERVICE_WORKERS,
+                 claim_timeout: float = UMLS_CLAIM_TIMEOUT,
+                 result_ttl: float = UMLS_INFLIGHT_TTL,
+                 poll_interval: float = 0.05):
+        self.normalizer = normalizer
+        self.inflight_dir = Path(inflight_dir)
+        self.inflight_dir.mkdir(parents=True, exist_ok=True)
+        self.max_workers = max_workers
+        self.claim_timeout = claim_timeout
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+
+        #the pool is created lazily, threads do not survive a fork
+        self._executor = None
+        self._pending : dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+
+
+    def submit(self, text: str) -> Future:
+        """Schedule the normalization of text, and return a Future of its result dict."""
+        key = self._key(text)
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = self._get_executor().submit(self._resolve, text, key)
+                self._pending[key] = future
+                new = True
+            else:
+                new = False
+        #outside of the lock: the callback runs right away in this thread if the future is already done,
+        #and _forget() takes the lock
+        if new:
+            future.add_done_callback(lambda _, key=key: self._forget(key))
+        return future
+
+
+
+    def normalize(self, string: str) -> dict:
+        """Blocking version of submit, same interface as UMLSNormalizer.normalize."""
+        return self.submit(string).result()
+
+
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+
+
+    def _forget(self, key: str):
+        with self._lock:
+            self._pending.pop(key, None)
+
+
+
+    def _key(self, text: str) -> str:
+        return hashlib.md5(text.lower().strip().encode()).hexdigest()
+
+
+
+    def _resolve(self, text: str, key: str) -> dict:
+        """Return the published result of text, or claim it and call the API."""
+        result_path = self.inflight_dir / f"{key}.json"
+        claim_path = self.inflight_dir / f"{key}.claim"
+
+        waiting_since = time.time()
+        while True:
+            result = self._read_result(result_path)
+            if result is not None:
+                return result
+
+            fd = os.open(claim_path, os.O_CREAT | os.O_RDWR, 0o644)
+            try:
+                try: #the lock is the claim, only one process holds it, and it is released if the process dies
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    if time.time() - waiting_since > self.claim_timeout:
+                        logging.warning(f"Normalizer: '{text}' claimed for more than {self.claim_timeout}s, requesting it.")
+                        return self._request(text, result_path)
+                    time.sleep(self.poll_interval)
+                    continue
+                #the previous owner removes the claim file before releasing it, a lock on a removed file is no claim
+                if not self._is_claim(fd, claim_path):
+                    continue
+                try:
+                    #another process may have published between our read and our claim
+                    result = self._read_result(result_path)
+                    return result if result is not None else self._request(text, result_path)
+                finally:
+                    claim_path.unlink(missing_ok=True)
+            finally:
+                os.close(fd) #closing the descriptor releases the lock
+
+
+
+    def _request(self, text: str, result_path: Path) -> dict:
+        """Call the API and publish the result, a miss ({}) too, an error response raises and is not published."""
+        result = self.normalizer.normalize(text)
+        self._write_result(result_path, result)
+        return result
+
+
+
+    @staticmethod
+    def _is_claim(fd: int, claim_path: Path) -> bool:
+        try:
+            return os.fstat(fd).st_ino == claim_path.stat().st_ino
+        except FileNotFoundError:
+            return False
+
+
+
+    def _read_result(self, result_path: Path):
+        try:
+            if time.time() - result_path.stat().st_mtime > self.result_ttl:
+                result_path.unlink(missing_ok=True)
+                return None
+            with open(result_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError:
+            logging.warning(f"Normalizer: corrupted result {result_path.name}, requesting it again.")
+            result_path.unlink(missing_ok=True)
+            return None
+
+
+
+    def _write_result(self, result_path: Path, result: dict):
+        """Atomic publication of a result, readers never see a partially written file."""
+        temp = result_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(temp, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        os.replace(temp, result_path)
+
+
 
 
 
-            
-        
 
 
 if __name__ == "__main__":
     normalizer = UMLSNormalizer()
     #example wssf
-    print("this is an example, normalization of 'human': ", normalizer.normalize("human "))
\ No newline at end of file
+    print("this is an example, normalization of 'human': ", normalizer.normalize("human "))
@@ -0,0 +1,151 @@
+import marisa_trie
+
+import re
+import json
+import logging
+import argparse
+
+from pathlib import Path
+
+from config.umls_config import (UMLS_INDEX_SOURCES, UMLS_PREFERRED_SEMANTIC_TYPES, UMLS_PREFERRED_SOURCES,
+                                UMLS_PREFERRED_TERM_TYPES, UMLS_CONCEPT_URL)
+
+"""Offline alternative to the UMLS API.
+The index is built once from a licensed Metathesaurus release and is made of two marisa tries:
+    - strings.marisa: normalized string -> 'CUI<TAB>SAB' of the best concept for that string.
+    - concepts.marisa: CUI -> preferred name of the concept.
+marisa tries are memory-mapped, compact (the whole English UMLS fits in a few hundred MB)
+and answer lookups in microseconds, with no network."""
+
+#MRCONSO.RRF and MRSTY.RRF columns, see https://www.ncbi.nlm.nih.gov/books/NBK9685/
+MRCONSO_COLUMNS = ['CUI', 'LAT', 'TS', 'LUI', 'STT', 'SUI', 'ISPREF', 'AUI', 'SAUI', 'SCUI',
+                   'SDUI', 'SAB', 'TTY', 'CODE', 'STR', 'SRL', 'SUPPRESS', 'CVF']
+MRSTY_COLUMNS = ['CUI', 'TUI', 'STN', 'STY', 'ATUI', 'CVF']
+
+_WHITESPACES = re.compile(r"\s+")
+
+
+def normalize_string(string: str) -> str:
+    """The key under which strings are indexed and looked up."""
+    return _WHITESPACES.sub(" ", string).strip().lower()
+
+
+def read_rrf(path: Path, columns: list[str]):
+    """Yields each row of a '|' separated UMLS RRF file as a dict."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            yield dict(zip(columns, line.rstrip("\n").split("|")))
+
+
+
+
+class LocalUMLSNormalizer:
+    """Same interface as UMLSNormalizer, but answers from the local index.
+    Params:
+            index_dir: directory created by LocalUMLSNormalizer.build_index()"""
+    def __init__(self, index_dir: str):
+        self.index_dir = Path(index_dir)
+        try:
+            self.strings = marisa_trie.BytesTrie().mmap(str(self.index_dir / "strings.marisa"))
+            self.concepts = marisa_trie.BytesTrie().mmap(str(self.index_dir / "concepts.marisa"))
+            with open(self.index_dir / "meta.json", "r", encoding="utf-8") as f:
+                self.meta = json.load(f)
+        except FileNotFoundError:
+            logging.error(f"Local Normalizer: no UMLS index found in {self.index_dir}, did you build it?")
+            raise
+        logging.info(f"Local Normalizer: Initialized ({self.meta.get('strings')} strings, release {self.meta.get('release')}).")
+
+
+
+    def normalize(self, string: str) -> dict:
+        """Returns the same dict as UMLSNormalizer.normalize, {} if the string is unknown."""
+        values = self.strings.get(normalize_string(string))
+        if not values:
+            return {}
+        return self.concept(*values[0].decode("utf-8").split("\t"))
+
+
+
+    def concept(self, cui: str, source: str = "") -> dict:
+        """Builds the normalization dict of a CUI."""
+        names = self.concepts.get(cui)
+        return {
+            "cui": cui,
+            "normalized_name": names[0].decode("utf-8") if names else "",
+            "normalization_source": source,
+            "url": UMLS_CONCEPT_URL.format(release=self.meta.get("release", "current"), cui=cui),
+        }
+
+
+
+    @staticmethod
+    def build_index(meta_dir: str, index_dir: str, release: str = "current", sources: list[str] = UMLS_INDEX_SOURCES):
+        """Builds the index from MRCONSO.RRF and MRSTY.RRF (found in meta_dir, usually <release>/META).
+        Only English, non suppressible atoms are kept. When a string belongs to several concepts,
+        the concept is chosen by semantic type, then source, then term type preference (see config/umls_config.py).
+        NOTE: the build keeps one entry per distinct string in memory, restrict 'sources' on small machines."""
+        meta_dir, index_dir = Path(meta_dir), Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        sources = set(sources) if sources else None
+
+        sty_rank = {tui: rank for rank, tui in enumerate(UMLS_PREFERRED_SEMANTIC_TYPES)}
+        sab_rank = {sab: rank for rank, sab in enumerate(UMLS_PREFERRED_SOURCES)}
+        tty_rank = {tty: rank for rank, tty in enumerate(UMLS_PREFERRED_TERM_TYPES)}
+
+        logging.info("Local Normalizer: reading MRSTY.RRF.")
+        concept_rank = {}  #cui -> rank of its best semantic type
+        for row in read_rrf(meta_dir / "MRSTY.RRF", MRSTY_COLUMNS):
+            rank = sty_rank.get(row['TUI'], len(sty_rank))
+            if rank < concept_rank.get(row['CUI'], len(sty_rank) + 1):
+                concept_rank[row['CUI']] = rank
+
+        logging.info("Local Normalizer: reading MRCONSO.RRF.")
+        best_concept = {}  #normalized string -> (rank, cui, sab)
+        best_name = {}     #cui -> (rank, name)
+        for row in read_rrf(meta_dir / "MRCONSO.RRF", MRCONSO_COLUMNS):
+            if row['LAT'] != 'ENG' or row['SUPPRESS'] != 'N':
+                continue
+            if sources and row['SAB'] not in sources:
+                continue
+
+            cui, sab = row['CUI'], row['SAB']
+            atom_rank = (sab_rank.get(sab, len(sab_rank)), tty_rank.get(row['TTY'], len(tty_rank)))
+            #preferred atom of the preferred term of the concept
+            is_preferred = (row['TS'] == 'P' and row['STT'] == 'PF' and row['ISPREF'] == 'Y')
+
+            name_rank = (not is_preferred, *atom_rank)
+            current = best_name.get(cui)
+            if current is None or name_rank < current[0]:
+                best_name[cui] = (name_rank, row['STR'])
+
+            key = normalize_string(row['STR'])
+            rank = (concept_rank.get(cui, len(sty_rank)), *atom_rank)
+            current = best_concept.get(key)
+            if current is None or rank < current[0]:
+                best_concept[key] = (rank, cui, sab)
+
+        logging.info(f"Local Normalizer: writing {len(best_concept)} strings and {len(best_name)} concepts.")
+        strings = marisa_trie.BytesTrie((key, f"{cui}\t{sab}".encode("utf-8"))
+                                        for key, (_, cui, sab) in best_concept.items())
+        strings.save(str(index_dir / "strings.marisa"))
+        concepts = marisa_trie.BytesTrie((cui, name.encode("utf-8")) for cui, (_, name) in best_name.items())
+        concepts.save(str(index_dir / "concepts.marisa"))
+
+        with open(index_dir / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({"release": release, "strings": len(best_concept), "concepts": len(best_name),
+                       "sources": sorted(sources) if sources else None}, f)
+        logging.info(f"Local Normalizer: index saved to {index_dir}.")
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the offline UMLS index used by LocalUMLSNormalizer.")
+    parser.add_argument("meta_dir", help="directory containing MRCONSO.RRF and MRSTY.RRF")
+    parser.add_argument("index_dir", help="directory where the index is written")
+    parser.add_argument("--release", default="current", help="UMLS release name used in concept urls (e.g. 2025AA)")
+    args = parser.parse_args()
+
+    LocalUMLSNormalizer.build_index(args.meta_dir, args.index_dir, release=args.release)
+    normalizer = LocalUMLSNormalizer(args.index_dir)
+    print("this is an example, normalization of 'human': ", normalizer.normalize("human "))
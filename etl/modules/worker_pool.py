@@ -0,0 +1,252 @@
+import psutil
+
+import os
+import pickle
+import logging
+import threading
+import traceback
+import multiprocessing
+
+from collections import deque
+from multiprocessing import connection
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+from config.nlp_config import WORKER_MAX_TASKS, WORKER_MAX_RSS_MB
+
+"""Process pool for multi-hour annotation runs, with a bounded memory per worker.
+A spaCy worker only grows: every new token string stays in its Vocab/StringStore, and its caches and dedup
+tables fill up, so with a ProcessPoolExecutor the RSS of the workers rises for the whole run.
+RecyclingWorkerPool retires a worker after max_tasks tasks, or as soon as its RSS exceeds max_rss_mb:
+the worker calls the on_exit hook (flush the buffers, save the caches, close the part files) and exits,
+and the supervisor thread of the parent starts a fresh one (forked from the warm parent, see annotate.py).
+A worker that dies without exiting cleanly (killed by the OOM killer...) is replaced as well, the future
+of the task it was handed gets a BrokenProcessPool exception. A task that raises fails its future with the
+original exception (its traceback in the worker as __cause__), like ProcessPoolExecutor."""
+
+#messages of the workers to the supervisor
+_DONE, _FAILED, _EXITED = range(3)
+
+
+class _RemoteTraceback(Exception):
+    """Traceback of a task that failed in a worker, the __cause__ of the exception re-raised in the parent
+    (as ProcessPoolExecutor does)."""
+    def __init__(self, tb: str):
+        self.tb = tb
+
+    def __str__(self):
+        return self.tb
+
+
+def _picklable(exception: BaseException) -> BaseException:
+    """The exception itself if it can be sent to the parent, a RuntimeError with its message otherwise."""
+    try:
+        pickle.dumps(exception)
+        return exception
+    except Exception:
+        return RuntimeError(f"{type(exception).__name__}: {exception}")
+
+
+def _worker_loop(inbox, results, initializer, initargs, on_exit, max_tasks: int, max_rss_mb: float):
+    if initializer is not None:
+        initializer(*initargs)
+    pid = os.getpid()
+    process = psutil.Process(pid)
+    done, reason = 0, "shutdown"
+    while True:
+        #the supervisor recorded the task as ours before putting it in our inbox
+        task = inbox.get()
+        if task is None: #shutdown sentinel
+            break
+        task_id, function, args = task
+        try:
+            message, payload = _DONE, function(*args)
+        except BaseException as e:
+            message, payload = _FAILED, (_picklable(e), traceback.format_exc())
+        done += 1
+        rss_mb = process.memory_info().rss / 1024 ** 2
+        if max_tasks and done >= max_tasks:
+            reason = f"recycled after {done} tasks"
+        elif max_rss_mb and rss_mb >= max_rss_mb:
+            reason = f"recycled after {done} tasks at {rss_mb:.0f}MB RSS"
+        retiring = reason != "shutdown"
+        #a retiring worker says so with its result, so no new task is handed to it
+        results.put((message, pid, task_id, payload, retiring))
+        if retiring:
+            break
+
+    #explicit cleanup, instead of relying on finalizers and garbage collection
+    if on_exit is not None:
+        on_exit()
+    results.put((_EXITED, pid, None, reason, True))
+
+
+
+
+class RecyclingWorkerPool:
+    """Pool of worker processes that are replaced after max_tasks tasks or above max_rss_mb of RSS.
+    submit() returns a concurrent.futures.Future, so the pool can be used with as_completed() like a ProcessPoolExecutor.
+    Tasks are handed to idle workers one at a time, each through its own inbox, and recorded as running on that
+    worker first, so whenever a worker dies its task is known and its future fails.
+    Params:
+            max_workers: number of worker processes (default: the number of CPUs).
+            initializer, initargs: called in each worker when it starts.
+            on_exit: called in each worker before it exits (recycled or at shutdown), to persist its state.
+            max_tasks: tasks after which a worker is recycled (0 = never).
+            max_rss_mb: resident memory (MB) above which a worker is recycled (0 = never).
+            mp_context: multiprocessing context of the workers."""
+    def __init__(self, max_workers: int = None, initializer=None, initargs: tuple = (), on_exit=None,
+                 max_tasks: int = WORKER_MAX_TASKS, max_rss_mb: float = WORKER_MAX_RSS_MB, mp_context=None):
+        self.max_workers = max_workers or os.cpu_count()
+        self.context = mp_context or multiprocessing.get_context()
+        self._worker_args = (initializer, initargs, on_exit, max_tasks, max_rss_mb)
+        #results are written synchronously, a message put before a worker is killed is not lost
+        self._results = self.context.SimpleQueue()
+        self._queue = deque()  #tasks waiting for an idle worker
+        self._futures = {}     #task id -> Future
+        self._running = {}     #pid -> task id of the task handed to the worker
+        self._processes = {}   #pid -> Process
+        self._inboxes = {}     #pid -> Queue of the tasks of the worker
+        self._idle = set()     #pids of the workers waiting for a task
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self.recycled = 0
+        self.crashed = 0
+
+        with self._lock:
+            for _ in range(self.max_workers):
+                self._start_worker()
+        self._supervisor = threading.Thread(target=self._supervise, daemon=True)
+        self._supervisor.start()
+
+
+
+    def _start_worker(self):
+        """Starts a worker and hands it a task if there is one (called with the lock held)."""
+        inbox = self.context.Queue()
+        process = self.context.Process(target=_worker_loop, args=(inbox, self._results, *self._worker_args),
+                                       daemon=True)
+        process.start()
+        self._processes[process.pid] = process
+        self._inboxes[process.pid] = inbox
+        self._idle.add(process.pid)
+        self._dispatch()
+
+
+
+    def _dispatch(self):
+        """Hands the queued tasks (then the shutdown sentinels) to the idle workers (called with the lock held)."""
+        while self._idle and (self._queue or self._shutdown):
+            pid = self._idle.pop()
+            task = self._queue.popleft() if self._queue else None
+            if task is not None:
+                self._running[pid] = task[0]
+            self._inboxes[pid].put(task)
+
+
+
+    def _remove_worker(self, pid: int):
+        """Forgets a worker that exited or died (called with the lock held)."""
+        self._processes.pop(pid)
+        self._idle.discard(pid)
+        inbox = self._inboxes.pop(pid)
+        #a dead worker may leave a task in its inbox, the feeder thread must not wait for it to be read
+        inbox.cancel_join_thread()
+        inbox.close()
+
+
+
+    def submit(self, function, *args) -> Future:
+        if self._shutdown:
+            raise RuntimeError("cannot submit tasks to a pool that was shut down")
+        future = Future()
+        with self._lock:
+            task_id = self._next_id
+            self._next_id += 1
+            self._futures[task_id] = future
+            self._queue.append((task_id, function, args))
+            self._dispatch()
+        return future
+
+
+
+    def _supervise(self):
+        """Resolves the futures from the messages of the workers, and replaces the workers that exit or die."""
+        while True:
+            with self._lock:
+                if not self._processes:
+                    break
+                sentinels = [process.sentinel for process in self._processes.values()]
+            ready = connection.wait([self._results._reader, *sentinels], timeout=1)
+            if self._results._reader not in ready:
+                self._replace_dead_workers()
+                continue
+
+            message, pid, task_id, payload, retiring = self._results.get()
+            with self._lock:
+                if message == _EXITED:
+                    self._processes[pid].join()
+                    self._remove_worker(pid)
+                    if payload != "shutdown":
+                        self.recycled += 1
+                        logging.info(f"Worker Pool: worker {pid} {payload}, starting a new one.")
+                        self._start_worker()
+                    continue
+                self._running.pop(pid, None)
+                if not retiring:
+                    self._idle.add(pid)
+                    self._dispatch()
+                future = self._futures.pop(task_id, None)
+            if future is None: #already failed as the task of a dead worker
+                continue
+            if message == _DONE:
+                future.set_result(payload)
+            else:
+                exception, tb = payload
+                exception.__cause__ = _RemoteTraceback(f"\n(in worker {pid})\n{tb}")
+                future.set_exception(exception)
+
+
+
+    def _replace_dead_workers(self):
+        """Replace the workers that died without their exit message (a clean exit is handled on its message)."""
+        with self._lock:
+            for pid, process in list(self._processes.items()):
+                if process.is_alive() or process.exitcode == 0:
+                    continue
+                #the messages it wrote before dying come first
+                if not self._results.empty():
+                    return
+                self._remove_worker(pid)
+                self.crashed += 1
+                task_id = self._running.pop(pid, None)
+                logging.error(f"Worker Pool: worker {pid} died (exit code {process.exitcode}), starting a new one.")
+                future = self._futures.pop(task_id, None) if task_id is not None else None
+                if future is not None:
+                    future.set_exception(BrokenProcessPool(f"worker {pid} died (exit code {process.exitcode}) running this task"))
+                #at shutdown, a replacement is only needed for the tasks still queued
+                if not self._shutdown or self._queue:
+                    self._start_worker()
+
+
+
+    def shutdown(self, wait: bool = True):
+        """Let the workers finish the queued tasks, then stop them (each one runs on_exit)."""
+        if self._shutdown:
+            return
+        with self._lock:
+            self._shutdown = True
+            #the idle workers get their sentinel now, the others once the queued tasks are done
+            self._dispatch()
+        if wait:
+            self._supervisor.join()
+            logging.info(f"Worker Pool: stopped ({self.recycled} workers recycled, {self.crashed} crashed).")
+
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
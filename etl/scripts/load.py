@@ -1,7 +1,9 @@
 from typing import Optional
 
 from modules.neo4j import Neo4jConnector
-from config.settings import NEO4J_AUTH, NEO4J_URI
+from modules.load_state import LoadState
+from modules.bulk_import import write_import_files, run_import
+from config.settings import NEO4J_AUTH, NEO4J_URI, NEO4J_HOME
 
 
 
@@ -11,7 +13,13 @@ def load_to_Neo4j(labels_to_load:Optional[list[str]] = None,
                 reltypes_to_load:Optional[list[str]] = None,
                 rels_clean_csv:Optional[str] = None,
 
-                load_batch_size = 1000):
+                load_batch_size = 1000,
+                incremental: bool = False,
+                bulk_import: bool = False):
+        """incremental = if True, only the nodes and relations that are new or changed since the last load are sent
+        (the loaded rows are recorded in any case, see modules/load_state.py).
+        bulk_import = if True, the graph is rebuilt offline by neo4j-admin from both CSV files instead
+        (see modules/bulk_import.py), the database of the local Neo4j installation must be stopped."""
     
         nodes_args_provided = bool(labels_to_load) and bool(ents_clean_csv)
         rels_args_provided = bool(reltypes_to_load) and bool(rels_clean_csv) 
@@ -19,10 +27,26 @@ def load_to_Neo4j(labels_to_load:Optional[list[str]] = None,
         if not (nodes_args_provided or rels_args_provided):
             raise ValueError("Must provide either (labels_to_load AND ents_clean_csv) or (reltypes_to_load AND rels_clean_csv) or both")
 
+        if bulk_import:
+            if incremental:
+                raise ValueError("A bulk import rebuilds the whole graph, it can't be incremental.")
+            if not (nodes_args_provided and rels_args_provided):
+                raise ValueError("A bulk import needs both the nodes and the relations (labels_to_load, ents_clean_csv, reltypes_to_load and rels_clean_csv)")
+            run_import(NEO4J_HOME, write_import_files(ents_clean_csv, rels_clean_csv, labels_to_load, reltypes_to_load,
+                                                      only_related))
+            #the fingerprints of the previous loads don't describe the rebuilt graph, the next load sends everything
+            load_state = LoadState()
+            load_state.clear()
+            load_state.save()
+            return
+
+        load_state = LoadState()
         try:
             with Neo4jConnector(uri=NEO4J_URI,
                                     auth=NEO4J_AUTH,
-                                    load_batch_size=load_batch_size) as connector:
+                                    load_batch_size=load_batch_size,
+                                    load_state=load_state,
+                                    incremental=incremental) as connector:
                 if nodes_args_provided:
                     connector.load_ents_to_Neo4j(labels_to_load, ents_clean_csv, only_related, rels_clean_csv)
                 
@@ -33,5 +57,8 @@ def load_to_Neo4j(labels_to_load:Optional[list[str]] = None,
             raise
         except Exception:
             raise
+        finally:
+            #only the rows Neo4j accepted were recorded
+            load_state.save()
     
         
\ No newline at end of file
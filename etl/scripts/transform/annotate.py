@@ -1,24 +1,109 @@
+import gc
 import logging
+import multiprocessing
 
+from pathlib import Path
 from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
 from modules.mongo import MongoConnector
-from modules.umls_api import UMLSNormalizer
+from modules.umls_api import UMLSNormalizer, reset_inflight_dir
+from modules.umls_local import LocalUMLSNormalizer
+from modules.umls_ann import ApproximateConceptLinker, CONCEPT_TABLES
+from modules.mesh_mapper import MeshMapper
 from modules.nlp import StreamingOptimizedNLP
+from modules.worker_pool import RecyclingWorkerPool
+from modules.bulk_normalization import normalize_deferred_entities
+from modules.doc_store import list_shards, reset_doc_store, doc_key
+from modules.dedup import reset_bloom_filter
+from modules.pattern_profiler import reset_profiling_dir, write_pattern_report
+from modules.nlp_output import reset_output_dir
+from modules.chunking import split_text, ChunkStitcher
+from modules.metrics import get_metrics, reset_metrics_dir, write_snapshot, MetricsServer
 
-from config.settings import MONGO_CONNECTION_STR
+from config.settings import MONGO_CONNECTION_STR, UMLS_LOCAL_INDEX, UMLS_ANN_INDEX
+from config.nlp_config import (ENTITIES_OUTPUT_DIR, RELATIONS_OUTPUT_DIR, NLP_CHUNK_CHARS, METRICS_SNAPSHOT_PATH, DOC_STORE_DIR,
+                               DEDUP_BLOOM_PATH)
 
 
 
+def get_normalizer():
+    "Offline UMLS index if configured, UMLS API otherwise."
+    if UMLS_LOCAL_INDEX:
+        return LocalUMLSNormalizer(UMLS_LOCAL_INDEX)
+    return UMLSNormalizer()
+
+
+def get_local_linker():
+    "Approximate matching tier, in front of the normalizer (the API one too), if its index is configured."
+    "It maps its matches with the concept tables copied in its directory (or those of an older build's UMLS index)."
+    if not UMLS_ANN_INDEX:
+        return None
+    for tables_dir in [UMLS_ANN_INDEX, UMLS_LOCAL_INDEX]:
+        if tables_dir and all((Path(tables_dir) / table).exists() for table in CONCEPT_TABLES):
+            return ApproximateConceptLinker(LocalUMLSNormalizer(tables_dir), UMLS_ANN_INDEX)
+    logging.warning(f"Annotation: no concept tables in {UMLS_ANN_INDEX}, rebuild it with python -m modules.umls_ann, "
+                    "the approximate matching tier is disabled.")
+    return None
+
+
+def get_mesh_mapper():
+    "MeSH descriptors to concepts table, only available if it was built in the offline UMLS index."
+    if UMLS_LOCAL_INDEX and (Path(UMLS_LOCAL_INDEX) / "mesh.marisa").exists():
+        return MeshMapper(UMLS_LOCAL_INDEX)
+    return None
+
+
 global_annotator = None
+#extra StreamingOptimizedNLP arguments, set in each worker by the pool initializer
+annotator_options = {}
+def init_worker(options: dict):
+    "Process Pool initializer, stores the annotator options of the run in the worker."
+    global annotator_options
+    annotator_options = options
+    #forked from a parent that preloaded the annotator, the worker starts warm
+    if global_annotator is not None:
+        global_annotator.after_fork()
+
+
+def preload_annotator(options: dict):
+    "Loads the annotator (model, matchers, normalizer tables) once in the parent, the workers are forked from it"
+    " and share its pages copy-on-write instead of each loading its own copy."
+    global annotator_options
+    annotator_options = options
+    get_annotator().prepare_fork()
+    #objects of the parent are moved to a permanent generation, the garbage collections of the workers
+    #don't touch their reference counts (which would copy the shared pages)
+    gc.collect()
+    gc.freeze()
+
+
+def close_worker():
+    "Exit hook of the workers (recycled or at the end of the run): flush the buffers, save the caches"
+    " and close the part files explicitly instead of relying on finalizers."
+    if global_annotator is not None:
+        global_annotator.close()
+    get_metrics().save(force=True)
+
+
+def release_annotator():
+    "Drops the preloaded annotator of the parent once the workers are done."
+    global global_annotator
+    global_annotator = None
+    gc.unfreeze()
+    gc.collect()
+
+
 def get_annotator():
     "Creates a Singloton annotator"
     global global_annotator
     if global_annotator == None: 
         global_annotator = StreamingOptimizedNLP(
-        normalizer=UMLSNormalizer(),
-        entities_output_path= "data/extracted_entities.csv",
-          relations_output_path= "data/extracted_relations.csv"
+        normalizer=get_normalizer(),
+        local_linker=get_local_linker(),
+        mesh_mapper=get_mesh_mapper(),
+        entities_output_path= ENTITIES_OUTPUT_DIR,
+          relations_output_path= RELATIONS_OUTPUT_DIR,
+        **annotator_options
     )
     return global_annotator
 
@@ -28,15 +113,54 @@ def combiner( text, article):
     " can be passed to Process Pool Executor, "
     "this should be defined at top level because of the way processpool works (look this up, about pickle etc.)"
     annotator = get_annotator()
-    (annotator.extract_and_normalize_entities(text, article_metadata= article)
-                    .extract_relations(text, article_metadata= article))  
+    #one pipeline run per article, entities and relations share the same Doc
+    #MeSH headings and keywords are curated terms, they are mapped without NLP
+    mesh_headings = article.pop('mesh_headings', None)
+    keywords = article.pop('keywords', None)
+    annotator.process_article(text, article_metadata= article, mesh_headings=mesh_headings, keywords=keywords)
+
+
+def chunk_combiner(text, offset, article, chunk, mesh_headings=None, keywords=None):
+    "same as combiner for a chunk of a long article, returns its (entities, relations) to be stitched by the parent"
+    "the curated terms are only passed with the first chunk, so they are mapped once per article"
+    annotator = get_annotator()
+    return annotator.annotate_chunk(text, offset, article_metadata= article, mesh_headings=mesh_headings, keywords=keywords,
+                                    chunk=chunk)
+
+
+def rematch_combiner(shard_path):
+    "annotate --rematch task: extract entities and relations again from a shard of stored Docs, without NER nor parsing"
+    "returns the results of the chunks of long articles in the shard, to be stitched by the parent"
+    annotator = get_annotator()
+    return annotator.rematch_shard(shard_path)
                 
 
-def annotate_mongo_articles():
-    
-    connector = MongoConnector(connection_str=MONGO_CONNECTION_STR)
-    #list[dict] each dict is an article
-    articles = connector.fetch_articles_from_(query={})
+def annotate_mongo_articles(profile_patterns: bool = False, two_pass: bool = False, sentence_cache: bool = False,
+                            metrics_port: int = None, defer_normalization: bool = False,
+                            store_docs: bool = False, rematch: bool = False):
+    """Apply NER, normalization and RE to all the articles stored in MongoDB.
+    profile_patterns = if True, record the time, matches and yield of each relation pattern,
+                       and write a report to data/profiling/ (see modules/pattern_profiler.py).
+    two_pass = if True, the dependency parser only runs on the sentences the dependency patterns can match.
+    sentence_cache = if True, annotate sentence per sentence and reuse the cached annotations of the sentences already seen.
+    metrics_port = if set, serve the live metrics of the run in the Prometheus format on localhost:metrics_port/metrics
+                   (a JSON snapshot is written to METRICS_SNAPSHOT_PATH at the end of the run in any case).
+    defer_normalization = if True, the workers only run NER and RE, the unique entity strings of the whole corpus
+                          are normalized afterwards in one pass (see modules/bulk_normalization.py).
+    store_docs = if True, the processed Docs are stored (see modules/doc_store.py) for a later --rematch.
+    rematch = if True, the articles are not read from MongoDB: the Docs stored by the last --store-docs run are
+              matched again (after a change of the patterns or of the generic entities), without NER nor parsing."""
+
+    if rematch:
+        shards = list_shards(DOC_STORE_DIR)
+        if not shards:
+            raise FileNotFoundError(f"no stored Docs in {DOC_STORE_DIR}, run annotate --store-docs first.")
+        articles = []
+    else:
+        shards = []
+        connector = MongoConnector(connection_str=MONGO_CONNECTION_STR)
+        #list[dict] each dict is an article
+        articles = connector.fetch_articles_from_(query={})
         
     #one for all so entities and relations could be saved in the class attr.
     #normalizer = UMLSNormalizer()
@@ -47,12 +171,71 @@ def annotate_mongo_articles():
     # )
 
 
+    options = {"profile_patterns": profile_patterns, "two_pass": two_pass, "sentence_cache": sentence_cache,
+               "defer_normalization": defer_normalization, "store_docs": store_docs and not rematch}
+    #the workers only append their own part files, the outputs of the previous run are removed here, once.
+    reset_output_dir(ENTITIES_OUTPUT_DIR)
+    reset_output_dir(RELATIONS_OUTPUT_DIR)
+    #the coalesced UMLS lookups of the previous runs are not reused (the normalization cache keeps the results)
+    reset_inflight_dir()
+    #the dedup Bloom filter only holds the keys of the run, like the outputs
+    if DEDUP_BLOOM_PATH:
+        reset_bloom_filter(DEDUP_BLOOM_PATH)
+    if profile_patterns:
+        reset_profiling_dir()
+    if store_docs and not rematch:
+        reset_doc_store(DOC_STORE_DIR)
+    #the metrics of the parent start with the run, the workers save theirs next to it
+    reset_metrics_dir()
+    get_metrics()
+    #with fork (Linux), the annotator is loaded once here and the workers are forked from this warm state,
+    #otherwise (spawn) each worker loads its own on its first article
+    fork = "fork" in multiprocessing.get_all_start_methods()
+    if fork:
+        logging.info("Annotation: preloading the annotator in the parent process.")
+        preload_annotator(options)
+    metrics_server = MetricsServer(metrics_port).start() if metrics_port else None
+
     logging.info("Annotation Process Started.")
     try:
-        with ProcessPoolExecutor() as executor: 
-            futures = [executor.submit(combiner, article.pop('text'), article) 
-                       for article in articles]
-            for future in tqdm(futures, desc="Applying NLP over Mongo docs:"): future.result()
+        #long articles are split in chunks annotated in parallel, the parent stitches their results (see modules/chunking.py)
+        #workers are recycled after WORKER_MAX_TASKS tasks or above WORKER_MAX_RSS_MB, so their memory stays bounded
+        with RecyclingWorkerPool(mp_context=multiprocessing.get_context("fork") if fork else None,
+                                 initializer=init_worker, initargs=(options,), on_exit=close_worker) as executor, \
+             ChunkStitcher(ENTITIES_OUTPUT_DIR, RELATIONS_OUTPUT_DIR) as stitcher:
+            chunks_of = {}  #future -> (article id, chunk index) for the chunks of long articles
+            rematched = {}  #article key -> article id of the long articles whose chunk Docs are rematched
+            #one task per shard of stored Docs when rematching
+            futures = [executor.submit(rematch_combiner, str(shard)) for shard in shards]
+            for article in articles:
+                text = article.pop('text')
+                chunks = split_text(text, NLP_CHUNK_CHARS)
+                if len(chunks) == 1:
+                    futures.append(executor.submit(combiner, text, article))
+                    continue
+                article_id = stitcher.expect(len(chunks))
+                curated = (article.pop('mesh_headings', None), article.pop('keywords', None))
+                key = doc_key(text, article)
+                for index, (offset, chunk) in enumerate(chunks):
+                    future = executor.submit(chunk_combiner, chunk, offset, article,
+                                             {"key": key, "index": index, "count": len(chunks)},
+                                             *(curated if index == 0 else ()))
+                    chunks_of[future] = (article_id, index)
+                    futures.append(future)
+            if chunks_of:
+                logging.info(f"Annotation: {len(chunks_of)} chunks submitted for "
+                             f"{len({article_id for article_id, _ in chunks_of.values()})} long articles.")
+
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Applying NLP over Mongo docs:"):
+                result = future.result()
+                if future in chunks_of:
+                    stitcher.add(*chunks_of.pop(future), result)
+                elif rematch:
+                    #the chunks of an article can be in several shards, it is stitched with its last one
+                    for key, index, count, chunk_result in result:
+                        if key not in rematched:
+                            rematched[key] = stitcher.expect(count)
+                        stitcher.add(rematched[key], index, chunk_result)
         # for article in tqdm(articles, desc="Applying NLP over Mongo docs:"):
         #     text = article.pop('text')
         #         #we are able to chain methods as we return self from each one
@@ -62,4 +245,22 @@ def annotate_mongo_articles():
     except KeyboardInterrupt: 
         logging.error("Annotation Process Interrupted Manually.")
         raise
+    finally:
+        if metrics_server is not None:
+            metrics_server.stop()
+        if fork:
+            release_annotator()
+
+    if defer_normalization:
+        logging.info("Annotation: normalizing the deferred entities of the corpus.")
+        normalize_deferred_entities(ENTITIES_OUTPUT_DIR, get_normalizer(), get_local_linker())
+
+    #the workers saved their last metrics when the pool shut down
+    get_metrics().save(force=True)
+    snapshot = write_snapshot(METRICS_SNAPSHOT_PATH)
+    print(f"Annotation metrics: {snapshot['rates']} (full snapshot: {METRICS_SNAPSHOT_PATH})")
+
+    if profile_patterns:
+        report_path = write_pattern_report()
+        print(f"Relation patterns report: {report_path}")
     
\ No newline at end of file
@@ -1,30 +1,70 @@
-import pandas as pd 
+import pandas as pd
 
-import uuid
+import json
+import shutil
+import hashlib
 import logging
 import os
 from pathlib import Path
 
-def prepare_data_for_neo4j(raw_ents_path="data/extracted_entities.csv", 
-                raw_rels_path="data/extracted_relations.csv", 
-                saving_dir="data/ready_for_neo4j"):
-	"""Parameters: 
-	raw_ents_path = path to the raw extracted entities csv
-	raw_rels_path = path to raw extracted relations csv
-	saving_dir = path of the directory to which cleaned data will be saved"""
-	try:
-		entities = pd.read_csv(Path(raw_ents_path))
-		relations = pd.read_csv(Path(raw_rels_path))
-	except FileNotFoundError: 
-		raise FileNotFoundError("Raw entities or relations not found, did you run the previous stages?")
+from modules.pattern_profiler import save_clean_stats, write_pattern_report
+from modules.nlp_output import read_output, read_parts, readable_parts, unseen_articles, article_ids
+from modules.columnar_clean import clean_with_duckdb
+from modules.clean_state import CleanState, part_fingerprint, relation_keys
+from config.nlp_config import ENTITIES_OUTPUT_DIR, RELATIONS_OUTPUT_DIR
+from config.clean_config import (CLEAN_ENGINE, CLEAN_CSV_DATE_FORMAT, CLEAN_TEXT_ID_PREFIX, CLEAN_EDGE_MAX_EVIDENCE,
+                                 CLEAN_EVIDENCE_SEPARATOR)
 
-	if 'Unnamed: 0' in entities.columns: entities.drop(columns=['Unnamed: 0'], inplace=True)
-	if 'Unnamed: 0' in relations.columns: relations.drop(columns=['Unnamed: 0'], inplace=True)
+#relation endpoints that are not entities, with the number of relations dropped for them, written next to the CSV files
+UNRESOLVED_ENDPOINTS_FILE = "unresolved_endpoints.csv"
 
+#columns read from the annotation output, and their names for Neo4j
+ENTITY_COLUMNS = {'text': 'name', 'label': ':LABEL', 'pmid': 'pmid', 'pmcid': 'pmcid', 'fetching_date': 'fetching_date',
+				  'cui': 'cui', 'normalized_name': 'normalized_name', 'normalization_source': 'normalization_source', 'url': 'url'}
+RELATION_COLUMNS = ['ent1', 'relation', 'ent2', 'pmid', 'pmcid', 'fetching_date', 'pattern']
+#columns of the relations CSV file, one edge per (start, type, end) with the evidence of all its mentions
+EDGE_KEY = [":START_ID", ":TYPE", ":END_ID"]
+EDGE_COLUMNS = [":START_ID", ":END_ID", ":TYPE", "evidence_count", "pmids", "pmcids", "first_seen", "last_seen"]
 
-	#entities cleaning
-	print("entities records before:", entities.shape[0])
-	logging.info(f"Entities: Before Cleaning: {len(entities)}")
+
+def entity_ids(entities: pd.DataFrame) -> pd.Series:
+	"""Deterministic node ids of the cleaned entities (columns named for Neo4j): the CUI when there is one,
+	otherwise a hash of the label and the lowercased name, so the same entity gets the same id on every run
+	and the loader's MERGE updates it instead of creating a duplicate node.
+	(modules/columnar_clean.py computes the same ids in SQL.)"""
+	labels = entities[':LABEL'].astype(object).where(entities[':LABEL'].notna(), '')
+	text_ids = [CLEAN_TEXT_ID_PREFIX + hashlib.md5(f"{label}|{name}".encode('utf-8')).hexdigest()
+				for label, name in zip(labels, entities['name'])]
+	return entities['cui'].astype(object).where(entities['cui'].notna(), pd.Series(text_ids, index=entities.index))
+
+
+def missing_cuis(cuis: pd.Series) -> pd.Series:
+	"""CUIs with the empty ones missing: the annotator writes '' for the skipped strings and failed lookups,
+	they would all get the same empty node id. (modules/columnar_clean.py does the same in SQL.)"""
+	return cuis.map(lambda cui: (cui.strip() or None) if isinstance(cui, str) else cui)
+
+
+def save_unresolved_endpoints(counts: pd.Series, path: str):
+	"""Writes the names of the unresolved relation endpoints (name -> number of endpoints), most frequent first."""
+	(counts.rename_axis('name').reset_index(name='endpoints')
+		   .sort_values(['endpoints', 'name'], ascending=[False, True], kind='stable')
+		   .to_csv(path, index=False))
+
+
+def delta_path(path: str) -> str:
+	"""Delta file of a CSV file for Neo4j: the rows the last clean added to it (see prepare_data_for_neo4j)."""
+	return str(Path(path).with_suffix(".delta.csv"))
+
+
+def clean_fingerprint() -> str:
+	"""Fingerprint of what decides the content of the cleaned files, a state of another fingerprint is not reused."""
+	return hashlib.md5(json.dumps([ENTITY_COLUMNS, RELATION_COLUMNS, EDGE_COLUMNS, CLEAN_TEXT_ID_PREFIX,
+								   CLEAN_EDGE_MAX_EVIDENCE, CLEAN_EVIDENCE_SEPARATOR]).encode()).hexdigest()
+
+
+def deduplicate_entities(entities: pd.DataFrame) -> pd.DataFrame:
+	"""One entity per CUI, then per lowercased text (the entities with a CUI come first)."""
+	entities = entities.assign(cui=missing_cuis(entities['cui']))
 	#separate rows without CUI, because we will be deduplicating using CUI column as subset,
 	#  which will cause to lose them as pandas will consider them duplicates.
 	rows_with_cui_missing = entities[entities['cui'].isna()]
@@ -40,63 +80,248 @@ def prepare_data_for_neo4j(raw_ents_path="data/extracted_entities.csv",
 	entities['text'] = entities['text'].str.lower()
 	entities.drop_duplicates(subset=['text'],inplace=True, ignore_index=True)
 	logging.info("Entities: Drop ['text'] Duplicates.")
+	return entities
+
+
+def to_nodes(entities: pd.DataFrame) -> pd.DataFrame:
+	"""Cleaned entities to the nodes CSV format."""
+	#renaming columns for Neo4j (by name, whatever their order)
+	entities = entities.rename(columns=ENTITY_COLUMNS)
+	#adding a deterministic id column
+	entities.insert(
+		loc = 0,
+		column= ":ID",
+		value= entity_ids(entities)
+		)
+	logging.info("Entities: Rename Columns & Add IDs.")
+	return entities
+
+
+def map_relations(relations: pd.DataFrame, names: pd.Index, ids) -> tuple[pd.DataFrame, pd.Series]:
+	"""Maps the lowercased ent1/ent2 of the relations to node ids, returns the mapped relations (with their pattern)
+	and the endpoints that are not entities.
+	names = unique names of the nodes, ids = their ids (same order)."""
+	#the names are unique after cleaning, so they are a dictionary (name -> position) and ent1/ent2 are looked up
+	#in it, -1 for an endpoint that is not an entity (the inner join dropped them silently)
+	start = names.get_indexer(relations['ent1'])
+	end = names.get_indexer(relations['ent2'])
+	resolved = (start >= 0) & (end >= 0)
+	unresolved = pd.concat([relations.loc[start < 0, 'ent1'], relations.loc[end < 0, 'ent2']])
+	logging.info(f"Relations: {int((~resolved).sum())} relations dropped, their endpoint is not an entity "
+				 f"({unresolved.nunique()} names, see {UNRESOLVED_ENDPOINTS_FILE}).")
+
+	#only the columns for Neo4j (and the pattern for the stats), the relations keep their own pmid, pmcid and fetching_date
+	mapped = pd.DataFrame({
+		":START_ID": ids[start[resolved]],
+		":END_ID": ids[end[resolved]],
+		":TYPE": relations['relation'].to_numpy()[resolved],
+		**{column: relations[column].to_numpy()[resolved] for column in ["pmid", "pmcid", "fetching_date", "pattern"]},
+	})
+	logging.info("Relations: Map To Entities & Rename Columns.")
+	return mapped, unresolved
+
+
+def aggregate_edges(relations: pd.DataFrame) -> pd.DataFrame:
+	"""Collapses the mapped relations into one edge per (start, type, end), in the order of their first mention, with:
+	evidence_count = number of mentions,
+	pmids/pmcids = the first CLEAN_EDGE_MAX_EVIDENCE distinct ids of the articles that mention it (joined),
+	first_seen/last_seen = fetching dates of its first and last mention."""
+	edges = relations.groupby(EDGE_KEY, sort=False, dropna=False).agg(
+		evidence_count=(":START_ID", "size"), first_seen=("fetching_date", "min"), last_seen=("fetching_date", "max"))
+	for column, ids in [("pmid", "pmids"), ("pmcid", "pmcids")]:
+		#distinct ids of each edge in the order of their first mention, bounded
+		evidence = relations.dropna(subset=[column]).drop_duplicates(EDGE_KEY + [column])
+		evidence = evidence[evidence.groupby(EDGE_KEY, sort=False, dropna=False).cumcount() < CLEAN_EDGE_MAX_EVIDENCE]
+		edges[ids] = evidence.groupby(EDGE_KEY, sort=False, dropna=False)[column].agg(CLEAN_EVIDENCE_SEPARATOR.join)
+	logging.info("Relations: Aggregate Mentions To Edges.")
+	return edges.reset_index()[EDGE_COLUMNS]
+
+
+def merge_edge(edge: dict, update: dict) -> dict:
+	"""An edge of the CSV file (strings) with the evidence of its new mentions (dates formatted) added."""
+	def ids(*values):
+		merged = [i for value in values if isinstance(value, str) for i in value.split(CLEAN_EVIDENCE_SEPARATOR)]
+		return CLEAN_EVIDENCE_SEPARATOR.join(list(dict.fromkeys(merged))[:CLEAN_EDGE_MAX_EVIDENCE]) or None
+	dates = lambda *values: [value for value in values if isinstance(value, str)]
+	return {**edge,
+			"evidence_count": int(edge["evidence_count"]) + int(update["evidence_count"]),
+			"pmids": ids(edge["pmids"], update["pmids"]),
+			"pmcids": ids(edge["pmcids"], update["pmcids"]),
+			"first_seen": min(dates(edge["first_seen"], update["first_seen"]), default=None),
+			"last_seen": max(dates(edge["last_seen"], update["last_seen"]), default=None)}
+
+
+def update_edges(rels_path: str, updates: dict) -> pd.DataFrame:
+	"""Adds the new evidence of the edges already written (relation key -> aggregated edge) to the relations CSV file,
+	rewritten by chunks, and returns the updated edges."""
+	temp = f"{rels_path}.tmp"
+	updated = []
+	pd.DataFrame(columns=EDGE_COLUMNS).to_csv(temp, index=False)
+	for chunk in pd.read_csv(rels_path, dtype=str, keep_default_na=False, na_values=[""], chunksize=500_000):
+		keys = relation_keys(chunk)
+		hit = keys.isin(list(updates))
+		if hit.any():
+			merged = pd.DataFrame([merge_edge(edge, updates[key]) for edge, key
+								   in zip(chunk[hit].to_dict('records'), keys[hit])], columns=EDGE_COLUMNS)
+			chunk = chunk.astype(object)
+			chunk.loc[hit, EDGE_COLUMNS] = merged.to_numpy()
+			updated.append(merged)
+		chunk.to_csv(temp, mode='a', header=False, index=False)
+	os.replace(temp, rels_path)
+	return pd.concat(updated, ignore_index=True) if updated else pd.DataFrame(columns=EDGE_COLUMNS)
+
+
+
+def prepare_data_for_neo4j(raw_ents_path=ENTITIES_OUTPUT_DIR,
+                raw_rels_path=RELATIONS_OUTPUT_DIR,
+                saving_dir="data/ready_for_neo4j",
+                engine=CLEAN_ENGINE,
+                incremental=False):
+	"""Parameters:
+	raw_ents_path = path to the raw extracted entities Parquet dataset (directory)
+	raw_rels_path = path to raw extracted relations Parquet dataset (directory)
+	saving_dir = path of the directory to which cleaned data will be saved
+	engine = "pandas" (everything in memory) or "duckdb" (same steps and output, out of core, see modules/columnar_clean.py)
+	incremental = if True, only the articles that were not cleaned yet are cleaned, against the state of the previous
+				  cleans (see modules/clean_state.py), and their nodes and relations are appended to the CSV files.
+	Each clean also writes the rows it added to the CSV files in delta files (see delta_path()), for the loader."""
+	os.makedirs(name=Path(saving_dir), exist_ok=True)
+	ents_path = f"{Path(saving_dir)}/entities4neo4j.csv"
+	rels_path = f"{Path(saving_dir)}/relations4neo4j.csv"
+	try:
+		parts = readable_parts(raw_ents_path) + readable_parts(raw_rels_path)
+	except FileNotFoundError:
+		raise FileNotFoundError("Raw entities or relations not found, did you run the previous stages?")
+
+	if incremental:
+		state = CleanState.load()
+		if state is not None and state.usable(clean_fingerprint(), (ents_path, rels_path)):
+			clean_increment(state, raw_ents_path, raw_rels_path, saving_dir, ents_path, rels_path)
+			return ents_path, rels_path
+		logging.info("Clean State: no state of a previous clean of these files, running a full clean.")
+
+	if engine == "duckdb":
+		clean_with_duckdb(raw_ents_path, raw_rels_path, ents_path, rels_path, ENTITY_COLUMNS, RELATION_COLUMNS, EDGE_COLUMNS,
+						  unresolved_path=f"{Path(saving_dir)}/{UNRESOLVED_ENDPOINTS_FILE}")
+		logging.info(f"Cleaning & Preparation Process Completed (duckdb engine). Repo: {Path(saving_dir)}.")
+	else:
+		clean_with_pandas(raw_ents_path, raw_rels_path, saving_dir, ents_path, rels_path)
+
+	#a full clean adds everything, the next incremental cleans continue from its state
+	shutil.copyfile(ents_path, delta_path(ents_path))
+	shutil.copyfile(rels_path, delta_path(rels_path))
+	state = CleanState.from_output([part_fingerprint(part) for part in parts], ents_path, rels_path, clean_fingerprint())
+	for part in parts:
+		state.add_articles(article_ids(read_parts([part], columns=["pmid", "pmcid"])))
+	state.save()
+	return ents_path, rels_path
+
+
+
+def clean_with_pandas(raw_ents_path, raw_rels_path, saving_dir, ents_path, rels_path):
+	"""Full clean in memory, see prepare_data_for_neo4j()."""
+	entities = read_output(raw_ents_path, columns=list(ENTITY_COLUMNS))
+	relations = read_output(raw_rels_path, columns=RELATION_COLUMNS)
+
+	#entities cleaning
+	print("entities records before:", entities.shape[0])
+	logging.info(f"Entities: Before Cleaning: {len(entities)}")
+	entities = deduplicate_entities(entities)
 	print("entities records after:", entities.shape[0])
 	logging.info(f"Entities: After Cleaning: {len(entities)}")
 	#relations cleaning
 	print("relations records before:", relations.shape[0])
 	logging.info(f"Relations: Before Cleaning: {len(relations)}")
-	#drop duplicates by ent1 & ent2, I assume here that two entities can only have one relation per direction
 	relations['ent1'] = relations['ent1'].str.lower()
 	relations['ent2'] = relations['ent2'].str.lower()
-	relations.drop_duplicates(subset=['ent1', 'ent2'], inplace=True, ignore_index=True)
-	logging.info("Relations: Drop ['ent1', 'ent2'] Duplicates.")
+	#relations extracted with --profile-patterns carry the pattern that produced them
+	profiled = relations['pattern'].notna().any()
+	if profiled: raw_relations = relations[['pattern']].copy()
+
+	entities = to_nodes(entities)
+	relations, unresolved = map_relations(relations, pd.Index(entities['name']), entities[':ID'].to_numpy())
+	save_unresolved_endpoints(unresolved.value_counts(dropna=False), f"{Path(saving_dir)}/{UNRESOLVED_ENDPOINTS_FILE}")
+	if profiled:
+		save_clean_stats(raw_relations, relations)
+		write_pattern_report()
+	#the duplicate mentions of a relation are its evidence, they are collapsed into one weighted edge
+	relations = aggregate_edges(relations)
 	print("relations records after:", relations.shape[0])
 	logging.info(f"Relations: After Cleaning: {len(relations)}")
 
-
-	#renaming columns for Neo4j
-	entities.columns = ['name', ':LABEL', 'pmid', 'pmcid', 'fetching_date', 'cui', 'normalized_name', 'normalization_source', 'url']
-	#adding an id column 
-	entities.insert(
-		loc = 0, 
-		column= ":ID",
-		value= [str(uuid.uuid4()) for _ in range(len(entities))]
-		)
-	logging.info("Entities: Rename Columns & Add UUID.")
-	#mapping relations to names
-	#select * from relations r join entities e on r.ent1 = a.name 
-	
-	relations = relations.merge(entities,
-								left_on='ent1', #on which column of the relations
-								right_on= 'name', #on which column of entities
-								)
-	#select * from relations r join entities e on r.ent2 = a.name 
-	relations = relations.merge(entities, 
-								left_on= "ent2", 
-								right_on = "name", 
-								#now we will have cui_start cui_end, id_start id_end, etc.. 
-								suffixes= ("_start", "_end") 
-								)
-
-	#rename columns for Neo4j
-	relations = relations.rename(columns={
-		":ID_start": ":START_ID",
-		":ID_end": ":END_ID",
-		"relation": ":TYPE"
-	})
-	logging.info("Relations: Map To Entities & Rename Columns.")
-	#now keep only relation related columns.
-	relations = relations[[":START_ID", ":END_ID", ":TYPE", "pmid", "pmcid", "fetching_date"]]
-
 	#export again:
-	try: 
-		os.makedirs(name=Path(saving_dir), exist_ok=True)
-		ents_path = f"{Path(saving_dir)}/entities4neo4j.csv"
-		rels_path = f"{Path(saving_dir)}/relations4neo4j.csv"
-		entities.to_csv(Path(ents_path), index=False)
-		relations.to_csv(Path(rels_path), index = False)
+	try:
+		entities.to_csv(Path(ents_path), index=False, date_format=CLEAN_CSV_DATE_FORMAT)
+		relations.to_csv(Path(rels_path), index = False, date_format=CLEAN_CSV_DATE_FORMAT)
 		logging.info(f"Cleaning & Preparation Process Completed. Repo: {Path(saving_dir)}.")
-	except Exception as e: 
+	except Exception as e:
 		logging.error(f"Cleaning & Preparation Process Failed: {e}")
 
-	return ents_path, rels_path
\ No newline at end of file
+
+
+def clean_increment(state: CleanState, raw_ents_path, raw_rels_path, saving_dir, ents_path, rels_path):
+	"""Cleans the rows of the articles the state doesn't have (in the part files it has not read yet, annotate writes
+	new ones on each run), against the nodes and edges of the previous cleans: an article annotated again is skipped,
+	the entities whose CUI or name is already a node are dropped (the nodes already written are kept as they are),
+	the mentions of an edge already written are added to its evidence, the new nodes and edges are appended to the
+	CSV files. The delta files get the new nodes, the new and updated edges, and the nodes the new edges connect
+	that had no relation yet (so the delta files can be loaded on their own, even with only the related nodes)."""
+	fingerprints = {part: part_fingerprint(part) for part in readable_parts(raw_ents_path) + readable_parts(raw_rels_path)}
+	entity_parts = [part for part in readable_parts(raw_ents_path) if fingerprints[part] not in state.parts]
+	relation_parts = [part for part in readable_parts(raw_rels_path) if fingerprints[part] not in state.parts]
+	logging.info(f"Clean State: {len(entity_parts)} entities and {len(relation_parts)} relations part files to read.")
+	#only the rows of the articles not cleaned yet, the filter is built before the state gets the new articles
+	unseen = unseen_articles(state.pmids, state.pmcids)
+	entities = (read_parts(entity_parts, columns=list(ENTITY_COLUMNS), filters=unseen) if entity_parts
+				else pd.DataFrame(columns=list(ENTITY_COLUMNS)))
+	relations = (read_parts(relation_parts, columns=RELATION_COLUMNS, filters=unseen) if relation_parts
+				 else pd.DataFrame(columns=RELATION_COLUMNS))
+	state.add_articles(article_ids(entities))
+	state.add_articles(article_ids(relations))
+
+	#entities cleaning, the ones already in the nodes are dropped first
+	print("new entities records:", entities.shape[0])
+	entities = entities.assign(cui=missing_cuis(entities['cui']))
+	entities = entities[~entities['cui'].isin(state.cuis) & ~entities['text'].str.lower().isin(state.names.keys())]
+	entities = to_nodes(deduplicate_entities(entities))
+	print("new nodes:", entities.shape[0])
+	logging.info(f"Entities: {len(entities)} New Nodes.")
+	state.add_nodes(entities)
+
+	#relations cleaning, mapped with the names of all the nodes, then aggregated to edges
+	print("new relations records:", relations.shape[0])
+	relations['ent1'] = relations['ent1'].str.lower()
+	relations['ent2'] = relations['ent2'].str.lower()
+	node_ids = pd.Series(state.names, dtype=object) #name -> id
+	relations, unresolved = map_relations(relations, node_ids.index, node_ids.to_numpy())
+	save_unresolved_endpoints(unresolved.value_counts(dropna=False), f"{Path(saving_dir)}/{UNRESOLVED_ENDPOINTS_FILE}")
+	edges = aggregate_edges(relations)
+	#dates as written in the CSV file, to be compared with the dates of the edges already written
+	for column in ["first_seen", "last_seen"]:
+		if pd.api.types.is_datetime64_any_dtype(edges[column]):
+			edges[column] = edges[column].dt.strftime(CLEAN_CSV_DATE_FORMAT)
+	keys = relation_keys(edges)
+	known = keys.isin(state.relations)
+	updated = (update_edges(rels_path, dict(zip(keys[known], edges[known].to_dict('records')))) if known.any()
+			   else pd.DataFrame(columns=EDGE_COLUMNS))
+	relations = edges[~known]
+	print("new relations:", relations.shape[0], "updated relations:", updated.shape[0])
+	logging.info(f"Relations: {len(relations)} New Relations, {len(updated)} Relations With New Evidence.")
+
+	#nodes of the previous cleans that get their first relation
+	endpoints = set(relations[':START_ID']) | set(relations[':END_ID'])
+	newly_related = endpoints - state.related - set(entities[':ID'])
+	entities.to_csv(delta_path(ents_path), index=False, date_format=CLEAN_CSV_DATE_FORMAT)
+	if newly_related:
+		for chunk in pd.read_csv(ents_path, dtype=str, keep_default_na=False, chunksize=500_000):
+			chunk[chunk[':ID'].isin(newly_related)].to_csv(delta_path(ents_path), mode='a', header=False, index=False)
+	state.add_relations(relations)
+
+	updated.to_csv(delta_path(rels_path), index=False)
+	relations.to_csv(delta_path(rels_path), mode='a', header=False, index=False)
+	entities.to_csv(ents_path, mode='a', header=False, index=False, date_format=CLEAN_CSV_DATE_FORMAT)
+	relations.to_csv(rels_path, mode='a', header=False, index=False)
+	#the fingerprints of the part files that no longer exist are dropped
+	state.parts = set(fingerprints.values())
+	state.save()
+	logging.info(f"Cleaning & Preparation Process Completed (incremental). Repo: {Path(saving_dir)}.")